@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+End to end benchmark of the acquisition path, run against the simulated
+Keithley (keithley_sim), so it needs no hardware. It measures
+- command round trip latency (a short query),
+- readings per second for sweeps of 10 to 2500 points, ASCII and binary,
+- the parse cost per element of parse_data and parse_binary,
+- the peak memory allocated by one sweep,
+and prints the results as JSON so they can be kept and compared.
+
+Run from the top of the repo:
+    python benchmarks/bench_acquisition.py --out results.json
+
+--time-scale 0 takes the simulated instrument and port timing out, leaving
+only the cost of the Python side.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import keithley_control as kc
+import keithley_sim as sim
+
+# A step that is exact in binary, so (stop - start)/step is exactly points
+sweep_step = 2.**-7
+
+def median_time(function, repeat):
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t0)
+    return float(np.median(times))
+
+def bench_latency(keithley, repeat):
+    return {'query': ':TRIG:COUN?',
+            'seconds': median_time(lambda: keithley.get_num_triggers(),
+                                   repeat)}
+
+def bench_sweep(keithley, points, data_format, repeat):
+    keithley.set_data_format(data_format)
+
+    def run():
+        return keithley.sweep(start=0, stop=points*sweep_step,
+                              step=sweep_step, delay=0)
+
+    data = run()
+    seconds = median_time(run, repeat)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'points': points,
+            'format': data_format,
+            'readings': len(data),
+            'seconds': seconds,
+            'readings_per_s': len(data)/seconds,
+            'bytes_read': keithley.last_read_stats.get('bytes', 0),
+            'peak_memory': peak}
+
+def bench_parse(num_readings, repeat):
+    elements = kc.elements_for(None)
+    values = np.random.RandomState(0).standard_normal(
+        num_readings*len(elements))
+    text = ','.join('%+.6E' %value for value in values)
+    block = values.astype('<f4').tobytes()
+    results = []
+    for data_format, function in [
+            ('ascii', lambda: kc.parse_data(text, elements=elements)),
+            ('sreal', lambda: kc.parse_binary(block, elements=elements))]:
+        seconds = median_time(function, repeat)
+        results.append({'format': data_format,
+                        'elements': values.size,
+                        'seconds': seconds,
+                        'seconds_per_element': seconds/values.size})
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--time-scale', type=float, default=1.,
+                        help='simulator timing, 0 for none (default 1)')
+    parser.add_argument('--points', type=int, nargs='+',
+                        default=[10, 100, 1000, 2500])
+    parser.add_argument('--formats', nargs='+', default=['ascii', 'sreal'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out', help='write the JSON here, not to stdout')
+    args = parser.parse_args(argv)
+
+    keithley = kc.Keithley('sim://resistor?resistance=1e6&time_scale=%s'
+                           %args.time_scale)
+    results = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'platform': platform.platform(),
+                        'time_scale': args.time_scale,
+                        'baudrate': keithley.ser.instrument.baudrate},
+               'latency': bench_latency(keithley, max(args.repeat, 10)),
+               'sweeps': [bench_sweep(keithley, points, data_format,
+                                      args.repeat)
+                          for data_format in args.formats
+                          for points in args.points],
+               'parse': bench_parse(max(args.points), max(args.repeat, 10))}
+    keithley.close_serial()
+
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return results
+
+if __name__ == '__main__':
+    main()
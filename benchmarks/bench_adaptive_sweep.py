@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Adaptive sweeps (Keithley.adaptive_sweep) against evenly spaced ones, on
+the simulated device models (keithley_sim). For each model it reports the
+points, time and error of
+- an adaptive sweep,
+- an even sweep with the same number of points,
+- the even sweep it takes to get the error down to that of the adaptive
+  one,
+and prints the results as JSON. The error is the largest difference
+between the straight lines through the readings and the model itself,
+as a fraction of the range of the measured quantity.
+
+Run from the top of the repo:
+    python benchmarks/bench_adaptive_sweep.py --out results.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import keithley_control as kc
+
+# Device, sweep range and compliance for each case
+cases = [('diode', 'sim://diode?noise=0&noise_floor=0&time_scale=%s',
+          -1., 1., .1),
+         ('resistor', 'sim://resistor?resistance=1e3&noise=0&noise_floor=0'
+          '&time_scale=%s', -1., 1., .1)]
+
+def sweep_error(data, model, start, stop, compliance):
+    volts = np.linspace(start, stop, 20001)
+    exact = np.clip(model.current(volts), -compliance, compliance)
+    fitted = np.interp(volts, data['volt'], data['curr'])
+    return float(np.max(np.abs(fitted - exact))/np.ptp(exact))
+
+def run(keithley, function):
+    t0 = time.perf_counter()
+    data = function()
+    return data, time.perf_counter() - t0
+
+def bench_case(name, url, start, stop, compliance, time_scale, tolerance,
+               delay):
+    keithley = kc.Keithley(url %time_scale)
+    keithley.set_current_compliance(compliance)
+    model = keithley.ser.instrument.model
+
+    def even(points):
+        return keithley.list_sweep(np.linspace(start, stop, points),
+                                   delay=delay)
+
+    def result(data, seconds):
+        return {'points': len(data), 'seconds': seconds,
+                'error': sweep_error(data, model, start, stop, compliance)}
+
+    adaptive = result(*run(keithley, lambda: keithley.adaptive_sweep(
+        start, stop, tolerance=tolerance, delay=delay)))
+    same = result(*run(keithley, lambda: even(adaptive['points'])))
+    # Smallest even sweep (within 2500 points) as good as the adaptive one
+    matched = None
+    for points in [50, 100, 200, 500, 1000, 2500]:
+        matched = result(*run(keithley, lambda: even(points)))
+        if matched['error'] <= adaptive['error']:
+            break
+    keithley.close_serial()
+    return {'model': name, 'start': start, 'stop': stop,
+            'tolerance': tolerance, 'adaptive': adaptive,
+            'even_same_points': same, 'even_same_error': matched}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--time-scale', type=float, default=.1,
+                        help='simulator timing, 0 for none (default .1)')
+    parser.add_argument('--tolerance', type=float, default=.02)
+    parser.add_argument('--delay', type=float, default=.001)
+    parser.add_argument('--out', help='write the JSON here, not to stdout')
+    args = parser.parse_args(argv)
+
+    results = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        'time_scale': args.time_scale},
+               'cases': [bench_case(name, url, start, stop, compliance,
+                                    args.time_scale, args.tolerance,
+                                    args.delay)
+                         for name, url, start, stop, compliance in cases]}
+
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return results
+
+if __name__ == '__main__':
+    main()
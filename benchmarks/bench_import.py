@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Start-up time of the driver modules and the keithley-run command line,
+each in a fresh interpreter (best of --repeats runs), against a bare
+interpreter, with the heavy modules (numpy, h5py, pyvisa, yaml, pyqtgraph)
+each one has really loaded. Prints the results as JSON; with --limit it
+exits with 1 if keithley-run --dry-run takes longer than that many
+milliseconds over the bare interpreter.
+
+Run from the top of the repo:
+    python benchmarks/bench_import.py --out results.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+top = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+modules = ['keithley_control', 'keithley_recipe', 'keithley_storage',
+           'keithley_metrics', 'keithley_run']
+heavy = ['numpy', 'h5py', 'pyvisa', 'yaml', 'pyqtgraph']
+
+recipe = {'name': 'bench_import', 'source': 'VOLT', 'mode': 'sweep',
+          'start': 0., 'stop': 1., 'points': 11}
+
+# Run in the fresh interpreter: times code, then reports what got loaded
+probe = """
+import sys, time, json
+t0 = time.perf_counter()
+%s
+seconds = time.perf_counter() - t0
+import keithley_lazy
+print(json.dumps({'seconds': seconds, 'loaded': [name for name in %r
+                  if keithley_lazy.is_loaded(name)]}))
+"""
+
+def run(code, repeats):
+    env = dict(os.environ, PYTHONPATH=top)
+    best = None
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         env=env, cwd=top)
+        wall = time.perf_counter() - t0
+        result = json.loads(output.decode().strip().split('\n')[-1] or '{}')
+        result['wall_seconds'] = wall
+        if best is None or wall < best['wall_seconds']:
+            best = result
+    return best
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--limit', type=float,
+                        help='fail over this many ms for keithley-run')
+    parser.add_argument('--out', help='write the JSON here, not to stdout')
+    args = parser.parse_args(argv)
+
+    # Compiled once first, so the runs don't time writing .pyc files
+    subprocess.check_call([sys.executable, '-m', 'compileall', '-q', top])
+    bare = run('print("{}")', args.repeats)['wall_seconds']
+    results = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        'python': sys.version.split()[0],
+                        'repeats': args.repeats, 'bare_seconds': bare},
+               'imports': {}}
+    for name in modules:
+        results['imports'][name] = run(probe %('import ' + name, heavy),
+                                       args.repeats)
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                     delete=False) as f:
+        json.dump(recipe, f)
+    try:
+        code = ("import keithley_run, io, contextlib\n"
+                "with contextlib.redirect_stdout(io.StringIO()):\n"
+                "    keithley_run.main([%r, '--dry-run'])" %f.name)
+        dry_run = run(probe %(code, heavy), args.repeats)
+    finally:
+        os.remove(f.name)
+    dry_run['over_bare_ms'] = 1000*(dry_run['wall_seconds'] - bare)
+    results['keithley_run_dry_run'] = dry_run
+
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.limit is not None and dry_run['over_bare_ms'] > args.limit:
+        print("keithley-run took %.0f ms over a bare interpreter, limit %g"
+              %(dry_run['over_bare_ms'], args.limit))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
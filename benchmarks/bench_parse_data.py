@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of keithley_control.parse_data against the old zip based parser,
+on ASCII payloads like the ones :FETCH? returns.
+
+Run from the top of the repo:
+    python benchmarks/bench_parse_data.py
+"""
+
+import os
+import sys
+import timeit
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import keithley_control as kc
+
+
+"""
+The parser as it was before it was vectorized, kept here only to compare
+against (list() and float added so it runs on Python 3 and new NumPy).
+"""
+def legacy_parse_data(data, data_type=None):
+    data = data.replace(' ', '').split(',')
+    if data_type in ['v', 'c', 'r']:
+        cols = 2
+    else:
+        cols = 4
+    data = list(zip(*[iter(data)]*cols))
+    data = np.array(data).astype(float)
+    return np.array([data[:,3], data[:,0], data[:,1], data[:,2]])
+
+"""
+A :FETCH? reply with num_elements values, formatted like the 2400 does.
+"""
+def make_payload(num_elements, seed=0):
+    values = np.random.RandomState(seed).standard_normal(num_elements)
+    return ','.join('%+.6E' %value for value in values)
+
+def bench(function, payload, repeat=5):
+    number = max(1, int(2e5 // len(payload)))
+    best = min(timeit.repeat(lambda: function(payload), number=number,
+                             repeat=repeat))
+    return best/number
+
+if __name__ == '__main__':
+    for num_elements in [2500, 100000]:
+        payload = make_payload(num_elements)
+        old = bench(legacy_parse_data, payload)
+        new = bench(kc.parse_data, payload)
+        print("%7s elements: legacy %8.3f ms, parse_data %8.3f ms, %5.1fx"
+              %(num_elements, old*1e3, new*1e3, old/new))
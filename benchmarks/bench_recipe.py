@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Recipes (keithley_recipe) against the same measurement sent by hand, on
+the simulated Keithley (keithley_sim). It times compiling a recipe, and
+for
+- the hand written setup (the Keithley setters and sweep),
+- the first run of the compiled plan,
+- runs of the plan replayed on the same Keithley,
+reports the time per run and the commands and bytes written (from
+keithley_metrics), and prints the results as JSON.
+
+Run from the top of the repo:
+    python benchmarks/bench_recipe.py --out results.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import keithley_control as kc
+import keithley_metrics as km
+import keithley_recipe as kr
+
+recipe = {'name': 'bench_iv', 'source': 'VOLT', 'mode': 'sweep',
+          'start': 0., 'stop': 1., 'points': 101, 'compliance': .1,
+          'nplc': .01, 'elements': ['volt', 'curr']}
+
+"""
+Returns: time per run, and commands and bytes written per run.
+"""
+def measure(keithley, function, repeats):
+    keithley.instrumentation.clear()
+    t0 = time.perf_counter()
+    for i in range(repeats):
+        data = function()
+        assert data is not None
+    seconds = time.perf_counter() - t0
+    stats = keithley.instrumentation.commands.values()
+    return {'seconds': seconds/repeats,
+            'commands': sum(s.count for s in stats)/float(repeats),
+            'bytes_written': sum(s.bytes_written for s in stats)/
+                             float(repeats)}
+
+def by_hand(keithley):
+    keithley.set_current_compliance(recipe['compliance'])
+    keithley.set_elements(recipe['elements'])
+    return keithley.sweep(start=recipe['start'], stop=recipe['stop'],
+                          step=.01)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--time-scale', type=float, default=0.,
+                        help='simulator timing, 0 for none (default)')
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--out', help='write the JSON here, not to stdout')
+    args = parser.parse_args(argv)
+
+    url = 'sim://resistor?time_scale=%s' %args.time_scale
+    t0 = time.perf_counter()
+    kr._plans.clear()
+    plan = kr.compile_recipe(recipe)
+    compile_time = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    cached = kr.compile_recipe(recipe)
+    cached_time = time.perf_counter() - t0
+    assert cached is plan
+
+    keithley = kc.Keithley(url, instrumentation=km.Instrumentation())
+    hand = measure(keithley, lambda: by_hand(keithley), args.repeats)
+    keithley.close_serial()
+
+    keithley = kc.Keithley(url, instrumentation=km.Instrumentation())
+    first = measure(keithley, lambda: plan.run(keithley), 1)
+    replay = measure(keithley, lambda: plan.run(keithley), args.repeats)
+    keithley.close_serial()
+
+    results = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        'time_scale': args.time_scale,
+                        'repeats': args.repeats, 'recipe': recipe,
+                        'plan': str(plan).split('\n')},
+               'compile_seconds': compile_time,
+               'cached_compile_seconds': cached_time,
+               'by_hand': hand, 'plan_first_run': first,
+               'plan_replay': replay}
+
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return results
+
+if __name__ == '__main__':
+    main()
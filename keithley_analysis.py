@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+"""
+Analysis of the structured arrays of readings that Keithley.sweep (and
+parse_data/parse_binary) return, with fields like data['volt'] and
+data['curr']. Everything works on whole arrays at once:
+
+    data = keithley.sweep(start=0, stop=1, step=.01, num_sweeps=5)
+    sweeps = split_sweeps(data, num_sweeps=5)    # a view, nothing copied
+    mean, std = average_sweeps(sweeps)
+    fit = fit_diode(mean)
+    hits = compliance_hits(data)
+
+Large batches of results can be fanned out over processes with
+analyze_batch.
+"""
+
+# Bit 3 of the status word, set when the source was held at compliance
+compliance_bit = 1 << 3
+# Boltzmann constant over the electron charge (V/K)
+k_over_q = 8.617333e-5
+
+"""
+Split readings of several back to back sweeps into one row per sweep.
+Give num_sweeps or points (readings per sweep); with neither, each new
+sweep is found where field (the source) jumps back against the direction
+it sweeps in.
+Returns: a (num_sweeps, points) view of data, nothing is copied.
+Raises ValueError if data does not split into equal sweeps.
+"""
+def split_sweeps(data, num_sweeps=None, points=None, field='volt'):
+    if points is None and num_sweeps is None:
+        steps = np.diff(data[field])
+        direction = np.sign(np.sum(steps))
+        restarts = np.nonzero(np.sign(steps) == -direction)[0]
+        points = restarts[0] + 1 if len(restarts) else len(data)
+    elif points is None:
+        points = len(data) // num_sweeps
+    if points == 0 or len(data) % points:
+        raise ValueError("%d readings do not split into sweeps of %d"
+                         %(len(data), points))
+    return data.reshape(-1, points)
+
+"""
+Average sweeps (as from split_sweeps) point by point.
+Returns: (mean, std), structured arrays of one sweep each. The status
+words are combined with a bitwise or, in both, so a flag set in any
+sweep shows.
+"""
+def average_sweeps(sweeps):
+    mean = np.zeros(sweeps.shape[1], dtype=sweeps.dtype)
+    std = np.zeros(sweeps.shape[1], dtype=sweeps.dtype)
+    for name in sweeps.dtype.names:
+        if name == 'stat':
+            status = np.bitwise_or.reduce(sweeps[name].astype(np.int64),
+                                          axis=0)
+            mean[name] = std[name] = status
+        else:
+            mean[name] = sweeps[name].mean(axis=0)
+            std[name] = sweeps[name].std(axis=0)
+    return mean, std
+
+"""
+Returns: boolean array, True for the readings taken at compliance.
+"""
+def compliance_hits(data):
+    if 'stat' not in data.dtype.names:
+        return np.zeros(len(data), dtype=bool)
+    return (data['stat'].astype(np.int64) & compliance_bit) != 0
+
+"""
+Returns: V/I of each reading. Where no current flows it is +inf or -inf,
+with the sign of the voltage, and NaN if there is no voltage either.
+"""
+def resistance(data):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return data['volt']/data['curr']
+
+"""
+Returns: I/V of each reading. Where there is no voltage it is +inf or
+-inf, with the sign of the current, and NaN if no current flows either.
+"""
+def conductance(data):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return data['curr']/data['volt']
+
+"""
+dI/dV along a sweep, from central differences (one sided at the ends).
+Repeated voltages give NaN.
+"""
+def differential_conductance(data):
+    volts = data['volt']
+    amps = data['curr']
+    if len(volts) < 2:
+        return np.full(len(volts), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.empty(len(volts))
+        slope[1:-1] = (amps[2:] - amps[:-2])/(volts[2:] - volts[:-2])
+        slope[0] = (amps[1] - amps[0])/(volts[1] - volts[0])
+        slope[-1] = (amps[-1] - amps[-2])/(volts[-1] - volts[-2])
+    slope[~np.isfinite(slope)] = np.nan
+    return slope
+
+def _fit_mask(data, mask, skip_compliance):
+    if mask is None:
+        mask = np.ones(len(data), dtype=bool)
+    if skip_compliance:
+        mask = mask & ~compliance_hits(data)
+    return mask
+
+"""
+Least squares fit of I = V/R + I0. Readings at compliance are left out
+unless skip_compliance is False, mask picks the readings to fit.
+Returns: dict with 'resistance', 'offset' (I0, amps), 'rms' residual
+(amps) and 'points' fitted; None if fewer than 2 points are left.
+"""
+def fit_linear(data, mask=None, skip_compliance=True):
+    mask = _fit_mask(data, mask, skip_compliance)
+    volts = data['volt'][mask]
+    amps = data['curr'][mask]
+    if len(volts) < 2:
+        return None
+    matrix = np.column_stack([volts, np.ones(len(volts))])
+    slope, offset = np.linalg.lstsq(matrix, amps, rcond=None)[0]
+    rms = np.sqrt(np.mean((matrix.dot([slope, offset]) - amps)**2))
+    return {'resistance': 1./slope if slope else np.inf,
+            'offset': offset, 'rms': rms, 'points': len(volts)}
+
+"""
+Fit the forward biased part of a diode curve,
+V = n*kT/q*ln(I/Is) + I*Rs, which is linear in n, ln(Is) and Rs.
+Only readings with more than min_current are used (by default a
+millionth of the largest current), leaving out compliance as for
+fit_linear.
+Returns: dict with 'ideality' n, 'saturation_current' Is, 'series_resistance'
+Rs, 'rms' residual (volts) and 'points'; None if fewer than 3 points are
+left.
+"""
+def fit_diode(data, temperature=300., min_current=None, mask=None,
+              skip_compliance=True):
+    mask = _fit_mask(data, mask, skip_compliance)
+    amps = data['curr']
+    if min_current is None:
+        min_current = 1e-6*np.max(np.abs(amps)) if len(amps) else 0.
+    mask = mask & (amps > min_current)
+    volts = data['volt'][mask]
+    amps = amps[mask]
+    if len(volts) < 3:
+        return None
+    matrix = np.column_stack([np.log(amps), np.ones(len(amps)), amps])
+    slope, offset, series = np.linalg.lstsq(matrix, volts, rcond=None)[0]
+    rms = np.sqrt(np.mean((matrix.dot([slope, offset, series]) - volts)**2))
+    return {'ideality': slope/(k_over_q*temperature),
+            'saturation_current': np.exp(-offset/slope),
+            'series_resistance': series,
+            'rms': rms, 'points': len(volts)}
+
+"""
+The usual numbers for one sweep, see analyze_batch.
+"""
+def summarize(data):
+    hits = compliance_hits(data)
+    return {'points': len(data),
+            'compliance_hits': int(hits.sum()),
+            'linear': fit_linear(data),
+            'diode': fit_diode(data)}
+
+"""
+Run function (summarize by default) on every item of datasets, spread
+over a pool of processes. function has to be defined at the top of a
+module so it can be sent to the processes.
+Returns: list of the results, in the order of datasets.
+"""
+def analyze_batch(datasets, function=summarize, processes=None,
+                  chunksize=1):
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(function, datasets, chunksize=chunksize))
@@ -0,0 +1,637 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+import contextlib
+import numpy as np
+import keithley_serial as ks
+import keithley_transport as kt
+import keithley_control as kc
+
+"""
+An asyncio version of the Keithley object, so one event loop can drive
+several SourceMeters at once and a GUI can stay responsive during sweeps.
+
+    keithley = await AsyncKeithley.open('/dev/tty.KeySerial1')
+    data = await keithley.sweep(start=-1, stop=1, step=.1)
+
+It takes the same ports as Keithley (see keithley_transport), the
+simulator included: AsyncKeithley.open('sim://diode').
+"""
+
+# Longest response the reader will hold, a full :FETCH? is well over the
+# asyncio default of 64 kB
+read_limit = 2**24
+# How long one read of the port waits for bytes, so the reading thread
+# notices when the port is closed
+poll = .05
+
+"""
+Open the port with keithley_transport.open_transport, as Keithley does.
+Returns: (reader, writer), an asyncio StreamReader and a TransportWriter.
+Raises OSError or serial.SerialException if the port can not be opened.
+"""
+async def open_connection(port='/dev/tty.KeySerial1', baudrate=57600):
+    ser = kt.open_transport(port, baudrate=baudrate, timeout=poll)
+    reader = asyncio.StreamReader(limit=read_limit)
+    return reader, TransportWriter(ser, reader, asyncio.get_running_loop())
+
+"""
+The writing half of a port, written to directly. Not every transport can
+be waited on by the event loop (the simulator, GPIB), so a thread reads
+the port and feeds what arrives to the reader.
+"""
+class TransportWriter(object):
+
+    def __init__(self, ser, reader, loop):
+        self.ser = ser
+        self.loop = loop
+        self._closing = False
+        self.thread = threading.Thread(target=self._read_port,
+                                       args=(reader,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read_port(self, reader):
+        try:
+            while not self._closing:
+                data = self.ser.read(max(self.ser.in_waiting, 1))
+                if data:
+                    self.loop.call_soon_threadsafe(reader.feed_data, data)
+        except ks.transport_errors as error:
+            print("Lost the port (%s)..." %error)
+        finally:
+            self._closing = True
+            self.ser.close()
+            try:
+                self.loop.call_soon_threadsafe(reader.feed_eof)
+            except RuntimeError:
+                # The loop has already been closed
+                pass
+
+    def write(self, data):
+        self.ser.write(data)
+
+    async def drain(self):
+        pass
+
+    def is_closing(self):
+        return self._closing
+
+    """
+    The reading thread closes the port once it has seen this.
+    """
+    def close(self):
+        self._closing = True
+
+    async def wait_closed(self):
+        await self.loop.run_in_executor(None, self.thread.join)
+
+
+class AsyncKeithley(object):
+
+    max_line_length = kc.Keithley.max_line_length
+
+    """
+    reader and writer come from open_connection, or use AsyncKeithley.open.
+    The other arguments are as for Keithley.
+    """
+    def __init__(self, reader, writer, completion='opc', timeout=10.,
+                 data_format='ascii', byte_order='swap', verify_cache=False):
+        self.reader = reader
+        self.writer = writer
+        self.port = None
+        self.baudrate = 57600
+        self.completion = completion
+        self.timeout = timeout
+        self.last_read_stats = {}
+        self._batch = None
+        self.data_format = data_format
+        self.byte_order = byte_order
+        self.elements = None
+        self.cache = kc.StateCache()
+        self.verify_cache = verify_cache
+        # One query at a time, so responses go to the task that asked
+        self._lock = asyncio.Lock()
+        # As for Keithley._resync: markers not answered yet, and whether a
+        # response that timed out may still be on its way
+        self._markers = 0
+        self._out_of_step = False
+
+    """
+    Open the port and run the start up commands.
+    Returns: the AsyncKeithley.
+    """
+    @classmethod
+    async def open(cls, port, baudrate=57600, **kwargs):
+        reader, writer = await open_connection(port, baudrate=baudrate)
+        keithley = cls(reader, writer, **kwargs)
+        keithley.port = port
+        # The port may know better, e.g. 'sim://diode?baudrate=9600'
+        keithley.baudrate = getattr(writer.ser, 'baudrate', None) or baudrate
+        await keithley.run_start_up_commands()
+        return keithley
+
+    async def run_start_up_commands(self):
+        await self.send_commands(kc.start_up_commands)
+        self.elements = None
+        # *RST sets the data format back to ASCII
+        if self.data_format != 'ascii':
+            await self.set_data_format(self.data_format, self.byte_order)
+
+    async def open_serial(self):
+        if self.port is None:
+            print("Don't know which port to open...")
+            return
+        await self.close_serial()
+        self.reader, self.writer = await open_connection(
+            self.port, baudrate=self.baudrate)
+        self.cache.clear()
+        self._markers = 0
+        self._out_of_step = False
+
+    """
+    As Keithley.reconnect: open the port again after it went away, *RST,
+    and send every setting in the cache again. The output is left off.
+    Returns: True if the port is back.
+    """
+    async def reconnect(self):
+        settings = list(self.cache.settings.items())
+        try:
+            await self.open_serial()
+        except ks.transport_errors as error:
+            print("Could not reconnect: %s" %error)
+            return False
+        if not self.is_open():
+            return False
+        async with self.batch():
+            await self.send_command('*RST')
+            for header, value in settings:
+                await self.send_command('%s %s' %(header, value))
+        return True
+
+    async def close_serial(self):
+        if not self.writer.is_closing():
+            self.writer.close()
+            await self.writer.wait_closed()
+
+    def is_open(self):
+        return not self.writer.is_closing()
+
+    async def _write(self, command):
+        self.writer.write((command + '\r').encode('ascii'))
+        await self.writer.drain()
+
+    async def send_command(self, command):
+        if self._batch is not None:
+            self._batch.append(command)
+            return None
+        if not await self._should_send(command):
+            return None
+        if self.is_open():
+            await self._write(command)
+        else:
+            print("Port is closed...")
+
+    async def _read(self, timeout):
+        try:
+            line = await asyncio.wait_for(self.reader.readuntil(b'\r'),
+                                          timeout)
+        except asyncio.TimeoutError:
+            print("Timed out waiting for a response...")
+            # The response may still come, see _resync
+            self._out_of_step = True
+            return ''
+        self.last_read_stats['bytes'] = len(line)
+        return line[:-1].decode('ascii')
+
+    """
+    As Keithley._resync: after a timeout, send a marker query and throw
+    away everything up to its response. Call with the lock held.
+    Returns: True when back in step, False if the marker did not come
+    back within timeout.
+    """
+    async def _resync(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        await self._write(kc.resync_query)
+        self._markers += 1
+        while self._markers > 0:
+            try:
+                line = await asyncio.wait_for(
+                    self.reader.readuntil(b'\r'), deadline - loop.time())
+            except asyncio.LimitOverrunError as error:
+                line = await self.reader.read(error.consumed)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                return False
+            self._markers -= line.upper().count(kc.resync_marker)
+        self._markers = 0
+        self._out_of_step = False
+        return True
+
+    """
+    Write a query, once back in step after any earlier timeout. Call with
+    the lock held.
+    Returns: False if still waiting for an earlier response.
+    """
+    async def _send_query(self, command):
+        if self._out_of_step and not await self._resync():
+            print("Still waiting for an earlier response...")
+            return False
+        await self._write(command)
+        return True
+
+    async def get_response(self, command, pause=None, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        if not self.is_open():
+            print("Port is closed...")
+            return None
+        # Before taking the lock: with verify_cache the batch is checked
+        # with queries of its own
+        await self._flush_batch()
+        async with self._lock:
+            if not await self._send_query(command):
+                return None
+            if pause:
+                await asyncio.sleep(pause)
+            response = await self._read(timeout)
+        if response != '':
+            return response
+        else:
+            return None
+
+    async def _flush_batch(self):
+        if self._batch and self.is_open():
+            commands, self._batch = self._batch, []
+            commands = [com for com in commands
+                        if await self._should_send(com)]
+            for line in kc.join_commands(commands, self.max_line_length):
+                await self._write(line)
+
+    async def send_commands(self, commands, check_errors=True):
+        if not self.is_open():
+            print("Port is closed...")
+            return []
+        commands = [com for com in commands if await self._should_send(com)]
+        for line in kc.join_commands(commands, self.max_line_length):
+            await self._write(line)
+        if check_errors and commands:
+            return await self.get_errors()
+        return []
+
+    async def _should_send(self, command):
+        if self.cache.update(command):
+            return True
+        if not self.verify_cache:
+            return False
+        header, value = kc.split_command(command)
+        response = await self.get_response(header + '?')
+        if response is not None and kc.same_setting(response, value):
+            return False
+        self.cache.forget(header)
+        self.cache.update(command)
+        return True
+
+    """
+    As Keithley.batch, use with 'async with' and await send_command inside.
+    """
+    @contextlib.asynccontextmanager
+    async def batch(self, check_errors=True):
+        if self._batch is not None:
+            yield
+            return
+        self._batch = []
+        try:
+            yield
+        except:
+            self._batch = None
+            raise
+        commands, self._batch = self._batch, None
+        await self.send_commands(commands, check_errors=check_errors)
+
+    async def get_errors(self):
+        response = await self.get_response(':SYST:ERR:ALL?')
+        if response is None:
+            return []
+        errors = kc.parse_errors(response)
+        for code, message in errors:
+            print("Keithley error %s: %s" %(code, message))
+        return errors
+
+    async def wait_for_completion(self, timeout=None, interval=.005):
+        if timeout is None:
+            timeout = self.timeout
+        if not self.is_open():
+            print("Port is closed...")
+            return False
+        await self._flush_batch()
+        if self.completion != 'stb':
+            response = await self.get_response('*OPC?', timeout=timeout)
+            return response is not None and response.strip() == '1'
+        # Same as keithley_serial.poll_status_byte, without blocking the
+        # loop. Armed with the lock held, between other tasks' queries.
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        async with self._lock:
+            await self._write('*ESE 1;*OPC')
+        if await self.get_errors():
+            return False
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                print("Timed out waiting for the status byte...")
+                return False
+            response = await self.get_response('*STB?', timeout=remaining)
+            if response is not None and int(response) & 32:
+                await self.get_response('*ESR?', timeout=remaining)
+                return True
+            await asyncio.sleep(interval)
+
+    """   The setters, with the commands from the Keithley ones   """
+
+    async def _send_each(self, commands):
+        for command in commands:
+            await self.send_command(command)
+
+    async def reset(self):
+        await self.send_command('*RST')
+        self.elements = None
+        self.cache.clear()
+
+    async def set_output_on(self):
+        await self.send_command(':OUTP ON')
+
+    async def set_output_off(self):
+        await self.send_command(':OUTP OFF')
+
+    async def set_source_type(self, source_type):
+        await self._send_each(kc.source_type_commands(source_type))
+
+    async def set_source_voltage(self, voltage):
+        await self._send_each(kc.source_voltage_commands(voltage))
+
+    async def set_source_current(self, current):
+        await self._send_each(kc.source_current_commands(current))
+
+    async def set_sensor_type(self, sensor_type):
+        await self._send_each(kc.sensor_type_commands(sensor_type))
+        return kc.sensor_name(sensor_type)
+
+    async def set_sensor_range(self, sensor_type, sensor_range):
+        await self._send_each(kc.sensor_range_commands(sensor_type,
+                                                       sensor_range))
+
+    async def set_voltage_compliance(self, limit):
+        await self._send_each(kc.compliance_commands('VOLT', limit))
+
+    async def set_current_compliance(self, limit):
+        await self._send_each(kc.compliance_commands('CURR', limit))
+
+    async def set_num_triggers(self, num):
+        await self._send_each(kc.num_triggers_commands(num))
+
+    async def set_data_format(self, data_format='ascii', byte_order='swap'):
+        commands = kc.data_format_commands(data_format, byte_order)
+        if not commands:
+            return
+        async with self.batch():
+            await self._send_each(commands)
+        self.data_format = data_format.lower()
+        self.byte_order = byte_order.lower()
+
+    async def set_elements(self, data_type=None):
+        elements = kc.elements_for(data_type)
+        await self.send_command(kc.elements_command(elements))
+        self.elements = elements
+
+    async def configure_sweep(self, data_type=None, start=-10, stop=10,
+                              step=1, num_sweeps=1, delay=0.1):
+        commands, num_trigs = kc.sweep_commands(data_type, start, stop, step,
+                                                num_sweeps, delay)
+        async with self.batch():
+            await self._send_each(commands)
+        self.elements = kc.elements_for(data_type)
+        return num_trigs
+
+    async def configure_list_sweep(self, values, source='VOLT',
+                                   data_type=None, num_sweeps=1, delay=0.1):
+        commands, num_trigs = kc.list_sweep_commands(values, source,
+                                                     data_type, num_sweeps,
+                                                     delay,
+                                                     self.max_line_length)
+        if num_trigs is None:
+            return None
+        async with self.batch():
+            await self._send_each(commands)
+        self.elements = kc.elements_for(data_type)
+        return num_trigs
+
+    async def configure_trace(self, block_size=2500, data_type=None):
+        commands, block_size = kc.trace_commands(block_size, data_type)
+        async with self.batch():
+            await self._send_each(commands)
+        self.elements = kc.elements_for(data_type)
+        return block_size
+
+    async def stop_trace(self):
+        async with self.batch(check_errors=False):
+            await self._send_each(kc.stop_trace_commands)
+
+    async def get_num_triggers(self):
+        response = await self.get_response(':TRIG:COUN?')
+        if response is None:
+            return None
+        return int(float(response.replace(' ', '')))
+
+    async def get_elements(self):
+        response = await self.get_response(':FORM:ELEM?')
+        if response is None:
+            return None
+        self.elements = kc.elements_for(response.replace(' ', '').split(','))
+        return self.elements
+
+    async def read(self, data_type=None, timeout=None):
+        await self.set_elements(data_type)
+        if self.data_format != 'ascii':
+            num_trigs = await self.get_num_triggers()
+        else:
+            num_trigs = None
+        await self.send_command(':OUTP ON')
+        await self.send_command(':INIT')
+        data = None
+        if await self.wait_for_completion(timeout=timeout):
+            data = await self.fetch(num_readings=num_trigs)
+        await self.send_command(':OUTP OFF')
+        return data
+
+    async def sweep(self, data_type=None, start=-10, stop=10, step=1,
+                    num_sweeps=1, delay=0.1):
+        num_trigs = await self.configure_sweep(data_type, start, stop, step,
+                                               num_sweeps, delay)
+        await self.send_command(':OUTP ON')
+        await self.send_command(':INIT')
+        data = None
+        # Allow for the source delays
+        if await self.wait_for_completion(
+                timeout=self.timeout + num_trigs*delay):
+            data = await self.fetch(num_readings=int(num_trigs))
+        await self.send_command(':OUTP OFF')
+        return data
+
+    async def list_sweep(self, values, source='VOLT', data_type=None,
+                         num_sweeps=1, delay=0.1):
+        num_trigs = await self.configure_list_sweep(values, source, data_type,
+                                                    num_sweeps, delay)
+        if num_trigs is None:
+            return None
+        await self.send_command(':OUTP ON')
+        await self.send_command(':INIT')
+        data = None
+        if await self.wait_for_completion(
+                timeout=self.timeout + num_trigs*delay):
+            data = await self.fetch(num_readings=num_trigs)
+        await self.send_command(':OUTP OFF')
+        return data
+
+    """
+    As Keithley.adaptive_sweep.
+    """
+    async def adaptive_sweep(self, start=-10, stop=10, source='VOLT',
+                             coarse_points=21, tolerance=.05, min_step=None,
+                             max_points=2500, max_passes=8, delay=0.1):
+        sweep = kc.AdaptiveSweep(start, stop, source, coarse_points,
+                                 tolerance, min_step, max_points)
+        for i in range(max_passes):
+            if len(sweep.values) == 0:
+                break
+            data = await self.list_sweep(sweep.values, sweep.source,
+                                         data_type=sweep.elements,
+                                         delay=delay)
+            if data is None:
+                break
+            sweep.add(data)
+        return sweep.result()
+
+    async def _read_block(self, nbytes, timeout):
+        header = await self.reader.readexactly(2)
+        if header[:1] != b'#' or not header[1:2].isdigit():
+            print("Bad binary block header...")
+            self._out_of_step = True
+            return b''
+        digits = int(header[1:2])
+        if digits > 0:
+            nbytes = int(await self.reader.readexactly(digits))
+        elif nbytes is None:
+            print("Need the number of bytes for an indefinite block...")
+            return b''
+        block = await self.reader.readexactly(nbytes + 1)
+        self.last_read_stats['bytes'] = 2 + digits + len(block)
+        return block[:-1]
+
+    async def fetch(self, query=':FETCH?', num_readings=None, timeout=None):
+        elements = self.elements
+        if elements is None:
+            elements = await self.get_elements()
+        if timeout is None:
+            timeout = self.timeout
+        if num_readings is not None:
+            timeout += kc.transfer_time(num_readings, elements,
+                                        self.data_format,
+                                        getattr(self, 'baudrate', 57600))
+        if self.data_format == 'ascii':
+            response = await self.get_response(query, timeout=timeout)
+            if response is None:
+                return None
+            return kc.parse_data(response, elements=elements)
+        if not self.is_open():
+            print("Port is closed...")
+            return None
+        nbytes = None
+        if num_readings is not None:
+            size = 4 if self.data_format == 'sreal' else 8
+            nbytes = num_readings*len(elements)*size
+        await self._flush_batch()
+        async with self._lock:
+            if not await self._send_query(query):
+                return None
+            try:
+                block = await asyncio.wait_for(
+                    self._read_block(nbytes, timeout), timeout)
+            except asyncio.TimeoutError:
+                print("Timed out waiting for a response...")
+                self._out_of_step = True
+                return None
+        if block == b'':
+            return None
+        return kc.parse_binary(block, data_format=self.data_format,
+                               byte_order=self.byte_order, elements=elements)
+
+    """
+    As Keithley.iter_trace_blocks, use with 'async for'.
+    """
+    async def iter_trace_blocks(self, block_size=2500, num_blocks=None,
+                                data_type=None, timeout=None, sink=None):
+        if timeout is None:
+            timeout = self.timeout
+        block_size = await self.configure_trace(block_size, data_type)
+        await self.send_command(':OUTP ON')
+        await self.send_command(':INIT')
+        count = 0
+        try:
+            while num_blocks is None or count < num_blocks:
+                count += 1
+                if not await self.wait_for_completion(timeout=timeout):
+                    return
+                query = [':TRAC:DATA?']
+                if num_blocks is None or count < num_blocks:
+                    query += kc.trace_rearm_commands
+                data = await self.fetch(query=';'.join(query),
+                                        num_readings=block_size,
+                                        timeout=timeout)
+                if data is None:
+                    return
+                if sink is not None:
+                    sink.extend(data)
+                yield data
+        finally:
+            await self.stop_trace()
+
+    async def trace(self, num_points, block_size=2500, data_type=None,
+                    timeout=None, sink=None):
+        num_blocks = -(-num_points // min(block_size, 2500))
+        block_size = -(-num_points // num_blocks)
+        blocks = [block async for block in
+                  self.iter_trace_blocks(block_size, num_blocks,
+                                         data_type=data_type,
+                                         timeout=timeout, sink=sink)]
+        if not blocks:
+            return None
+        return np.concatenate(blocks)[:num_points]
+
+    async def stream_chunks(self, chunk_size=100, num_chunks=None,
+                            data_type=None, buffer=None, timeout=None,
+                            sink=None):
+        async for chunk in self.iter_trace_blocks(chunk_size, num_chunks,
+                                                  data_type=data_type,
+                                                  timeout=timeout, sink=sink):
+            if buffer is not None:
+                buffer.extend(chunk)
+            yield chunk
+
+    async def stream(self, chunk_size=100, num_readings=None, data_type=None,
+                     buffer=None, timeout=None, sink=None):
+        num_chunks = None
+        if num_readings is not None:
+            num_chunks = -(-num_readings // chunk_size)
+        count = 0
+        async for chunk in self.stream_chunks(chunk_size, num_chunks,
+                                              data_type=data_type,
+                                              buffer=buffer, timeout=timeout,
+                                              sink=sink):
+            for reading in chunk:
+                if num_readings is not None and count == num_readings:
+                    return
+                count += 1
+                yield reading
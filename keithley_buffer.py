@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+"""
+A fixed size ring buffer of readings, so that long streams of data from the
+Keithley (see Keithley.stream_chunks) can be kept for plotting or logging
+with memory that stays flat no matter how long the run is.
+"""
+
+class RingBuffer(object):
+
+    """
+    size is the number of readings kept. dtype is the structured dtype of a
+    reading; if it is None it is taken from the first extend, and the
+    buffer grows (doubling) as readings come in rather than taking all of
+    size at once, so a short run in a large buffer uses little memory.
+    """
+    def __init__(self, size, dtype=None):
+        self.size = int(size)
+        self.data = None
+        # Next position to write, and readings written since the start
+        self.index = 0
+        self.count = 0
+        if dtype is not None:
+            self.data = np.zeros(self.size, dtype=dtype)
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def clear(self):
+        self.index = 0
+        self.count = 0
+
+    """
+    Copy readings into the buffer, overwriting the oldest ones.
+    """
+    def extend(self, readings):
+        n = len(readings)
+        self._reserve(readings.dtype, min(self.count + n, self.size))
+        if n >= self.size:
+            self.data[:] = readings[n - self.size:]
+            self.index = 0
+        else:
+            first = min(n, self.size - self.index)
+            self.data[self.index:self.index + first] = readings[:first]
+            self.data[:n - first] = readings[first:]
+            self.index = (self.index + n) % self.size
+        self.count += n
+
+    """
+    Make room for needed readings. Until the buffer is full size nothing
+    has wrapped, so the readings are all at the start.
+    """
+    def _reserve(self, dtype, needed):
+        if self.data is not None and len(self.data) >= needed:
+            return
+        length = 0 if self.data is None else len(self.data)
+        data = np.zeros(min(max(needed, 2*length), self.size),
+                        dtype=dtype if self.data is None else self.data.dtype)
+        if self.data is not None:
+            data[:self.index] = self.data[:self.index]
+        self.data = data
+
+    """
+    The last n readings (all that are kept if n is None), oldest first.
+    This is a copy, so it stays valid as the buffer is written.
+    Returns None if nothing was ever written to an unallocated buffer.
+    """
+    def latest(self, n=None):
+        if self.data is None:
+            return None
+        if n is None or n > len(self):
+            n = len(self)
+        start = (self.index - n) % self.size
+        if start + n <= self.size:
+            return self.data[start:start + n].copy()
+        return np.concatenate([self.data[start:], self.data[:self.index]])
+
+
+"""
+Thin out y (and x with it) for plotting to at most about 2*bins points,
+keeping the smallest and largest value of each of bins equal slices in
+the order they came, so peaks and glitches still show up. bins would
+usually be the width of the plot in pixels.
+Returns: (x, y), as they are if they are short enough already.
+"""
+def decimate_minmax(x, y, bins):
+    x = np.asarray(x)
+    y = np.asarray(y)
+    n = len(y)
+    if bins < 1 or n <= 2*bins:
+        return x, y
+    per = n // bins
+    end = per*bins
+    slices = y[:end].reshape(bins, per)
+    lowest = slices.argmin(axis=1)
+    highest = slices.argmax(axis=1)
+    starts = np.arange(bins)*per
+    index = np.empty(2*bins, dtype=int)
+    index[0::2] = starts + np.minimum(lowest, highest)
+    index[1::2] = starts + np.maximum(lowest, highest)
+    index = np.concatenate([index, np.arange(end, n)])
+    return x[index], y[index]
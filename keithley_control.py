@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import re
 import time
+import warnings
+import contextlib
 import keithley_serial as ks
-import numpy as np
+import keithley_transport as kt
+from keithley_lazy import lazy_import
+
+# numpy is only loaded once readings are parsed
+np = lazy_import('numpy')
 
 """
 The keithley object that will manage the transmission of data and commands.
@@ -16,48 +23,480 @@ class Keithley:
     # creation of more than one keithley object at a time!
     # This is it, but currently it does nothing
     keithleyExists = False
+    # Longest line we send at once, to stay inside the input buffer
+    max_line_length = 250
 
-    def __init__(self, port):
+    def __init__(self, port, completion='opc', timeout=10.,
+                 data_format='ascii', byte_order='swap', verify_cache=False,
+                 instrumentation=None, retries=2, auto_reconnect=True,
+                 query_timeout=None, baudrate=57600):
         keithleyExists = True
-        self.ser = ks.start_serial(port=port)
+        # port is a port name (see keithley_transport.open_transport) or
+        # a transport object, e.g. a keithley_transport.LoopbackTransport
+        self.port = port
+        self.baudrate = baudrate
+        self.ser = ks.start_serial(port=port, baudrate=baudrate)
+        if getattr(self.ser, 'baudrate', None):
+            # The port may know better, e.g. 'sim://diode?baudrate=9600'
+            self.baudrate = self.ser.baudrate
+        # How to wait for the Keithley to finish: 'opc' asks with *OPC?,
+        # 'stb' polls the status byte. timeout is the longest wait (seconds).
+        self.completion = completion
+        self.timeout = timeout
+        # Timeout for short queries (errors, settings), timeout if None
+        self.query_timeout = query_timeout
+        # Extra tries for queries that are safe to repeat (see
+        # is_idempotent), and whether to reopen a port that went away
+        self.retries = retries
+        self.auto_reconnect = auto_reconnect
+        self.counters = {'timeouts': 0, 'retries': 0, 'reconnects': 0,
+                         'port_errors': 0}
+        self._reconnecting = False
+        # Marker queries (see _resync) not answered yet, and whether a
+        # reply that timed out may still be on its way
+        self._markers = 0
+        self._out_of_step = False
+        # Bytes and serial reads used by the most recent response
+        self.last_read_stats = {}
+        # Commands collected inside a batch() block, None when not batching
+        self._batch = None
+        # How readings are transferred, see set_data_format
+        self.data_format = data_format
+        self.byte_order = byte_order
+        # Elements set with :FORM:ELEM, None until known
+        self.elements = None
+        # Settings already sent, so they are not sent again. With
+        # verify_cache the Keithley is asked before a command is skipped.
+        self.cache = StateCache()
+        self.verify_cache = verify_cache
+        # Optional timing of every transaction, see keithley_metrics
+        self.instrumentation = instrumentation
         # Now run start up commands
         self.run_start_up_commands()
 
     def run_start_up_commands(self):
-        for com in start_up_commands:
-            self.send_command(com)
-            time.sleep(.01)
+        self.send_commands(start_up_commands)
+        self.elements = None
+        # *RST sets the data format back to ASCII
+        if self.data_format != 'ascii':
+            self.set_data_format(self.data_format, self.byte_order)
 
     def open_serial(self):
-        ks.close_serial(self.ser)
+        ks.open_serial(self.ser)
+        # Can't know what happened to the settings while disconnected
+        self.cache.clear()
 
     def close_serial(self):
         ks.close_serial(self.ser)
 
-    def send_command(self, command):
-        if self.ser.isOpen():
-            response = ks.write(self.ser, command)
-            if response != '':
-                return response
-            else:
+    """
+    Returns: True if the port is open, False if it could not be opened or
+    has been closed.
+    """
+    def is_open(self):
+        return self.ser is not None and self.ser.isOpen()
+
+    """
+    Open the port again after it went away, and put the Keithley back the
+    way it was: *RST, then every setting in the cache is sent again in the
+    order it was first made. The output is left off.
+    Returns: True if the port is back.
+    """
+    def reconnect(self):
+        if self._reconnecting:
+            return False
+        self._reconnecting = True
+        self.counters['reconnects'] += 1
+        try:
+            settings = list(self.cache.settings.items())
+            if self.ser is not None:
+                try:
+                    ks.close_serial(self.ser)
+                except ks.transport_errors:
+                    pass
+            self.ser = ks.start_serial(port=self.port, baudrate=self.baudrate)
+            if self.ser is None:
+                return False
+            self._discard_input()
+            self.cache.clear()
+            with self.batch():
+                self.send_command('*RST')
+                for header, value in settings:
+                    self.send_command('%s %s' %(header, value))
+            return True
+        except ks.transport_errors as error:
+            print("Could not reconnect: %s" %error)
+            return False
+        finally:
+            self._reconnecting = False
+
+    def _lost_port(self, error):
+        print("Lost the port (%s)..." %error)
+        self.counters['port_errors'] += 1
+        return self.auto_reconnect and self.reconnect()
+
+    """
+    Change the baud rate of the Keithley, and of the port with it. Only
+    for links whose rate is set from this end (see
+    keithley_transport.can_set_baudrate).
+    If the Keithley does not answer at the new rate it is told (at the new
+    rate, which it may have taken) to go back to the old one; failing that
+    the rate is searched for with find_baudrate.
+    Returns: True if the Keithley answers at the new rate, False if the
+    link ended up at another one (printed, and kept in baudrate), None if
+    the Keithley answers at none.
+    """
+    def set_baudrate(self, baudrate):
+        if baudrate not in kt.baudrates:
+            print("Baud rate must be one of %s" %kt.baudrates)
+            return False
+        if not kt.can_set_baudrate(self.port):
+            print("The baud rate of this link is set at the far end...")
+            return False
+        old = self.ser.baudrate
+        self.send_command(':SYST:COMM:SER:BAUD %d' %baudrate)
+        # The command has to be out before the port changes speed
+        self.ser.flush()
+        if self._answers_at(baudrate):
+            return True
+        # Commands may still get through where the answers do not
+        self.send_command(':SYST:COMM:SER:BAUD %d' %old)
+        self.ser.flush()
+        if not self._answers_at(old) and self.find_baudrate() is None:
+            self.ser.baudrate = self.baudrate
+            print("The Keithley does not answer at any baud rate...")
+            return None
+        print("The Keithley does not answer at %d baud, staying at %d"
+              %(baudrate, self.baudrate))
+        return False
+
+    def _answers_at(self, baudrate, timeout=.5):
+        self.ser.baudrate = baudrate
+        self._discard_input()
+        retries, self.retries = self.retries, 0
+        try:
+            answer = self.get_response('*OPC?', timeout=timeout)
+        finally:
+            self.retries = retries
+        if answer is not None and answer.strip() == '1':
+            self.baudrate = baudrate
+            return True
+        return False
+
+    """
+    Move the link up to the fastest baud rate the Keithley takes, up to
+    max_baudrate, stepping down until one works. Bulk transfers like
+    :FETCH? are bound by the baud rate.
+    Returns: the baud rate in use, None if the Keithley was lost on the way
+    (see set_baudrate).
+    """
+    def negotiate_baudrate(self, max_baudrate=None):
+        for baudrate in reversed(kt.baudrates):
+            if max_baudrate is not None and baudrate > max_baudrate:
+                continue
+            if baudrate == self.baudrate:
+                return self.baudrate
+            changed = self.set_baudrate(baudrate)
+            if changed:
+                return self.baudrate
+            if changed is None:
                 return None
+        return self.baudrate
+
+    """
+    Find the baud rate the Keithley is set to, trying each in turn
+    from the fastest, e.g. after opening the port at the wrong one.
+    Returns: the baud rate, None if it answers at none of them.
+    """
+    def find_baudrate(self, timeout=.2):
+        if not kt.can_set_baudrate(self.port):
+            return None
+        for baudrate in reversed(kt.baudrates):
+            if self._answers_at(baudrate, timeout):
+                return baudrate
+        return None
+
+    def send_command(self, command):
+        if self._batch is not None:
+            self._batch.append(command)
+            return None
+        if not self._should_send(command):
+            return None
+        if self.is_open():
+            self._write(command)
         else:
             print("Port is closed...")
 
-    def get_response(self, command, pause=.25):
-        if self.ser.isOpen():
-            response = ks.write_and_read(self.ser, command, pause=pause)
-            if response != '':
+    """
+    Write one line. If the port goes away it is reopened, and the
+    settings (this one included, if it is cached) are sent again.
+    """
+    def _write(self, command):
+        start = time.time()
+        try:
+            ks.write(self.ser, command)
+        except ks.transport_errors as error:
+            self._lost_port(error)
+            return
+        self._record(command, start, time.time())
+
+    """
+    Hand the timing of one transaction to the instrumentation, if any.
+    start and written are when the write began and ended, read_stats the
+    stats of the read that followed (see keithley_serial.read).
+    """
+    def _record(self, command, start, written, sleep=0., read_stats=None):
+        if self.instrumentation is None:
+            return
+        end = time.time()
+        bytes_read = 0
+        first_byte = None
+        if read_stats is not None:
+            bytes_read = read_stats.get('bytes', 0)
+            if read_stats.get('first_byte') is not None:
+                first_byte = (end - read_stats['seconds'] +
+                              read_stats['first_byte'] - start)
+        self.instrumentation.record(command, bytes_written=len(command) + 1,
+                                    bytes_read=bytes_read,
+                                    write_time=written - start,
+                                    first_byte=first_byte,
+                                    total=end - start, sleep=sleep)
+
+    def get_response(self, command, pause=None, timeout=None):
+        if timeout is None:
+            timeout = self.query_timeout or self.timeout
+        self._flush_batch()
+        if self.is_open():
+            response = self._query(command, lambda: ks.read(
+                self.ser, stats=self.last_read_stats, timeout=timeout),
+                pause=pause)
+            if response:
                 return response
             else:
                 return None
         else:
             print("Port is closed...")
 
+    """
+    Write command and get its response with read(). A query that is safe
+    to repeat (see is_idempotent) is tried again, up to retries times, if
+    it times out or the port goes away (which reopens it, see reconnect).
+    Returns: the response, empty if there was none.
+    """
+    def _query(self, command, read, pause=None):
+        tries = 1 + (self.retries if is_idempotent(command) else 0)
+        response = ''
+        for attempt in range(tries):
+            if attempt:
+                self.counters['retries'] += 1
+            if self._out_of_step and not self._resync():
+                print("Still waiting for an earlier response...")
+                return ''
+            start = time.time()
+            try:
+                ks.write(self.ser, command)
+                written = time.time()
+                if pause:
+                    time.sleep(pause)
+                response = read()
+            except ks.transport_errors as error:
+                if not self._lost_port(error):
+                    return ''
+                continue
+            self._record(command, start, written, sleep=pause or 0.,
+                         read_stats=self.last_read_stats)
+            if response:
+                return response
+            self.counters['timeouts'] += 1
+            # The response may still come, see _resync
+            self._out_of_step = True
+        return response
+
+    """
+    After a query timed out its response may still come (or the rest of
+    it), and would be taken for the response to the next query. Send a
+    marker query, whose response is easy to tell apart, and throw away
+    everything up to that response. The Keithley answers queries in
+    order, so anything late has come by then.
+    Returns: True when back in step, False if the marker did not come
+    back within the query timeout (the next query tries again).
+    """
+    def _resync(self):
+        try:
+            ks.write(self.ser, resync_query)
+            self._markers += 1
+            deadline = time.time() + (self.query_timeout or self.timeout)
+            while self._markers > 0:
+                lines = ks.read(self.ser, raw=True,
+                                timeout=max(deadline - time.time(), 0))
+                if not lines:
+                    return False
+                self._markers -= lines.upper().count(resync_marker)
+        except ks.transport_errors as error:
+            # Reopening the port starts afresh, see _discard_input
+            return self._lost_port(error)
+        self._markers = 0
+        self._out_of_step = False
+        return True
+
+    """
+    Throw away everything received, and any responses still owed, e.g.
+    when the port was reopened or changed speed.
+    """
+    def _discard_input(self):
+        ks.discard_input(self.ser)
+        self._markers = 0
+        self._out_of_step = False
+
+    """
+    Queries need everything batched before them to be sent first.
+    """
+    def _flush_batch(self):
+        if self._batch and self.is_open():
+            commands, self._batch = self._batch, []
+            commands = self.pending_commands(commands)
+            for line in join_commands(commands, self.max_line_length):
+                self._write(line)
+
+    """
+    Send a list of commands joined with ';' into as few lines as the
+    input buffer allows, then check for errors once with :SYST:ERR:ALL?.
+    The error query also makes sure every command has been processed.
+    Settings that are already in place are left out (see StateCache).
+    Returns: list of (code, message) errors, empty if there were none.
+    """
+    def send_commands(self, commands, check_errors=True):
+        if not self.is_open():
+            print("Port is closed...")
+            return []
+        commands = self.pending_commands(commands)
+        return self.send_lines(join_commands(commands, self.max_line_length),
+                               check_errors)
+
+    """
+    Write lines of commands as they are (already joined, see
+    join_commands), without looking at the cache, and check for errors.
+    Returns: list of (code, message) errors, empty if there were none.
+    """
+    def send_lines(self, lines, check_errors=True):
+        if not self.is_open():
+            print("Port is closed...")
+            return []
+        for line in lines:
+            self._write(line)
+        if check_errors and lines:
+            return self.get_errors()
+        return []
+
+    """
+    Check a command against the cache of settings already sent.
+    With verify_cache a setting is only skipped if the Keithley agrees it
+    is in place.
+    Returns: True if the command needs to be sent.
+    """
+    def _should_send(self, command):
+        if self.cache.update(command):
+            return True
+        if not self.verify_cache:
+            return False
+        header, value = split_command(command)
+        response = self.get_response(header + '?')
+        if response is not None and same_setting(response, value):
+            return False
+        self.cache.forget(header)
+        self.cache.update(command)
+        return True
+
+    """
+    Leave out of commands the settings the Keithley already has (see
+    StateCache). The rest are taken to be sent from here on, so send them.
+    Returns: list of the commands still to send, in order.
+    """
+    def pending_commands(self, commands):
+        return [com for com in commands if self._should_send(com)]
+
+    """
+    Collect every send_command inside the with block, and send them
+    together with send_commands when the block ends. For example:
+        with keithley.batch():
+            keithley.set_source_voltage(1)
+            keithley.set_current_compliance(.1)
+    """
+    @contextlib.contextmanager
+    def batch(self, check_errors=True):
+        if self._batch is not None:
+            # Already batching, the outer block sends everything
+            yield
+            return
+        self._batch = []
+        try:
+            yield
+        except:
+            self._batch = None
+            raise
+        commands, self._batch = self._batch, None
+        self.send_commands(commands, check_errors=check_errors)
+
+    """
+    Read (and so clear) the error queue.
+    Returns: list of (code, message) errors, empty if there were none.
+    """
+    def get_errors(self):
+        response = self.get_response(':SYST:ERR:ALL?')
+        if response is None:
+            return []
+        errors = parse_errors(response)
+        for code, message in errors:
+            print("Keithley error %s: %s" %(code, message))
+        return errors
+
+    """
+    Wait until the Keithley has finished all pending commands (batched
+    ones too), instead of sleeping for a fixed time: with *OPC?, or by
+    polling the status byte if completion is 'stb'.
+    Returns: True when complete, False on timeout or errors.
+    """
+    def wait_for_completion(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        if not self.is_open():
+            print("Port is closed...")
+            return False
+        self._flush_batch()
+        if self.completion != 'stb':
+            response = self.get_response('*OPC?', timeout=timeout)
+            return response is not None and response.strip() == '1'
+        # *OPC sets the bit that is polled for, see poll_status_byte
+        if self.send_commands(['*ESE 1', '*OPC']):
+            return False
+        start = time.time()
+        stats = {}
+        try:
+            done = ks.poll_status_byte(self.ser, timeout=timeout, stats=stats)
+        except ks.transport_errors as error:
+            self._lost_port(error)
+            return False
+        self._record('*OPC', start, start, sleep=stats['sleep'])
+        if not done:
+            # The reply to the last *STB? may still come, see _resync
+            self._out_of_step = True
+        return done
+
     """   Here I'm turning all the useful commands into methods   """
+    # The commands themselves come from the module level builders below
+    # (source_voltage_commands, ...), which keithley_async uses as well
+
+    """
+    send_command each of commands in turn.
+    """
+    def _send_each(self, commands):
+        for command in commands:
+            self.send_command(command)
 
     def reset(self):
         self.send_command('*RST')
+        self.elements = None
+        self.cache.clear()
 
     def set_output_on(self):
         self.send_command(':OUTP ON')
@@ -66,200 +505,975 @@ class Keithley:
         self.send_command(':OUTP OFF')
 
     def set_source_type(self, source_type):
-        source_type = source_type.lower()
-        if source_type == 'current' or source_type == 'curr' or source_type == 'c':
-            self.send_command(':SOUR:FUNC CURRENT')
-        elif source_type == 'voltage' or source_type == 'volt' or source_type == 'v':
-            self.send_command(':SOUR:FUNC VOLT')
-        else:
-            print("Unknown source setting!")
+        self._send_each(source_type_commands(source_type))
 
     def set_source_voltage(self, voltage):
-        if type(voltage) == int or type(voltage) == float:
-            if voltage > 200:
-                voltage = 200
-                print("Voltage limits are  +/- 200 V")
-            if voltage < -200:
-                voltage = -200
-                print("Voltage limits are  +/- 200 V")
-            self.set_source_type('voltage')
-            self.send_command(':SOUR:VOLT %s' %voltage)
-        else:
-            print("Bad voltage sent")
+        self._send_each(source_voltage_commands(voltage))
 
     def set_source_current(self, current):
-        if type(current) == int or type(current) == float:
-            if current > 1:
-                current = 1
-                print("Current limits are  +/- 1 A")
-            if current < -1:
-                current = -1
-                print("Current limits are  +/- 1 A")
-            self.set_source_type('current')
-            self.send_command(':SOUR:CURR %s' %current)
-        else:
-            print("Bad current sent")
+        self._send_each(source_current_commands(current))
 
     def set_sensor_type(self, sensor_type):
-        sensor_type = sensor_type.lower()
-        if sensor_type == 'current' or sensor_type == 'curr' or sensor_type == 'c':
-            self.send_command(':SENS:FUNC "CURR"')
-            return 'current'
-        elif sensor_type == 'voltage' or sensor_type == 'volt' or sensor_type == 'v':
-            self.send_command(':SENS:FUNC "VOLT"')
-            return 'voltage'
-        else:
-            print("Unknown sensor setting!")
-            return None
+        self._send_each(sensor_type_commands(sensor_type))
+        return sensor_name(sensor_type)
 
     def set_sensor_range(self, sensor_type, sensor_range):
-        sensor_type = self.set_sensor_type(sensor_type)
-        print("Sensor type set to %s" %sensor_type)
-        if type(sensor_range) == int or type(sensor_range) == float:
-            order = int(('%.2E' %sensor_range)[5:])
-            if sensor_type == 'voltage':
-                self.send_command(':SENS:VOLT:RANG 10E%s' %order)
-            elif sensor_type == 'current':
-                self.send_command(':SENS:CURR:RANG 10E%s' %order)
-            else:
-                print("Shouldn't get here!")
-        else:
-            print("Bad range sent.")
+        self._send_each(sensor_range_commands(sensor_type, sensor_range))
 
     def set_voltage_compliance(self, limit):
-        if type(limit) == int or type(limit) == float:
-            coeff = float(('%.2E' %limit)[:3])
-            order = int(('%.2E' %limit)[5:])
-            self.send_command(':SENS:VOLT:PROT %sE%s' %(coeff, order))
-        else:
-            print("Bad compliance value sent.")
+        self._send_each(compliance_commands('VOLT', limit))
 
     def set_current_compliance(self, limit):
-        if type(limit) == int or type(limit) == float:
-            coeff = float(('%.2E' %limit)[:3])
-            order = int(('%.2E' %limit)[5:])
-            self.send_command(':SENS:CURR:PROT %sE%s' %(coeff, order))
-        else:
-            print("Bad compliance value sent.")
+        self._send_each(compliance_commands('CURR', limit))
 
     def set_num_triggers(self, num):
-        if type(num) == int:
-            if num < 1:
-                print("Number of triggers must be between 1-2500")
-                print("Triggers set to 1")
-                num = 1
-            if num > 2500:
-                print("Number of triggers must be between 1-2500")
-                print("Triggers set to 2500")
-                num = 2500
-            self.send_command(':TRIG:COUN %s' %num)
-        else:
-            print("Bad trigger value sent.")
+        self._send_each(num_triggers_commands(num))
+
+    """
+    Choose how readings are transferred: 'ascii', or binary 'sreal'
+    (32 bit) or 'dreal' (64 bit) floats. byte_order 'swap' sends them
+    little-endian, which NumPy can use directly on a PC, 'norm' big-endian.
+    """
+    def set_data_format(self, data_format='ascii', byte_order='swap'):
+        commands = data_format_commands(data_format, byte_order)
+        if not commands:
+            return
+        with self.batch():
+            self._send_each(commands)
+        self.data_format = data_format.lower()
+        self.byte_order = byte_order.lower()
+
+    """
+    Set the elements of each reading with :FORM:ELEM, from a data_type
+    ('v', 'c', 'r' or None for all but status) or a list of element names
+    ('volt', 'curr', 'res', 'time', 'stat').
+    """
+    def set_elements(self, data_type=None):
+        elements = elements_for(data_type)
+        self.send_command(elements_command(elements))
+        self.elements = elements
+
+    """
+    Ask the Keithley which elements it is sending.
+    """
+    def get_elements(self):
+        response = self.get_response(':FORM:ELEM?')
+        if response is None:
+            return None
+        self.elements = elements_for(response.replace(' ', '').split(','))
+        return self.elements
 
     def get_num_triggers(self):
         response = self.get_response(':TRIG:COUN?')
-        return int(response.replace(' ', ''))
-
-    def read(self, data_type=None):
-        if data_type == None:
-            self.send_command(':FORM:ELEM TIME, VOLT, CURR, RES')
-        elif data_type.lower() == 'v':
-            self.send_command(':FORM:ELEM TIME, VOLT')
-        elif data_type.lower() == 'c':
-            self.send_command(':FORM:ELEM TIME, CURR')
-        elif data_type.lower() == 'r':
-            self.send_command(':FORM:ELEM TIME, RES')
+        if response is None:
+            return None
+        return int(float(response.replace(' ', '')))
+
+    def read(self, data_type=None, timeout=None):
+        self.set_elements(data_type)
+        if self.data_format != 'ascii':
+            num_trigs = self.get_num_triggers()
         else:
-            self.send_command(':FORM:ELEM TIME, VOLT, CURR, RES')
+            num_trigs = None
         self.send_command(':OUTP ON')
-        time.sleep(.25)
         self.send_command(':INIT')
-        time.sleep(.25)
-        # FETCH? waits for INIT to complete
-        response = self.get_response(':FETCH?')
-        time.sleep(.25)
+        data = None
+        if self.wait_for_completion(timeout=timeout):
+            data = self.fetch(num_readings=num_trigs)
         self.send_command(':OUTP OFF')
-        return parse_data(response, data_type=data_type)
-
-    def sweep(self, data_type=None, start=-10, stop=10, step=1, num_sweeps=1):
-        sweep_points = (stop-start)/step
-        num_trigs = num_sweeps*sweep_points
-        if data_type == None:
-            self.send_command(':FORM:ELEM TIME, VOLT, CURR, RES')
-        elif data_type.lower() == 'v':
-            self.send_command(':FORM:ELEM TIME, VOLT')
-        elif data_type.lower() == 'c':
-            self.send_command(':FORM:ELEM TIME, CURR')
-        elif data_type.lower() == 'r':
-            self.send_command(':FORM:ELEM TIME, RES')
-        else:
-            self.send_command(':FORM:ELEM TIME, VOLT, CURR, RES')
-        self.send_command(':SOUR:FUNC VOLT')
-        time.sleep(.1)
-        self.send_command(":SENS:FUNC 'CURR:DC'")
-        time.sleep(.1)
-        self.send_command(':SENS:CURR:PROT 0.5')
-        time.sleep(.1)
-        self.send_command(':SOUR:VOLT:START %s' %start)
-        time.sleep(.1)
-        self.send_command(':SOUR:VOLT:STOP %s' %stop)
-        time.sleep(.1)
-        self.send_command(':SOUR:VOLT:STEP %s' %step)
-        time.sleep(.1)
-        self.send_command(':SOUR:VOLT:MODE SWE')
-        time.sleep(.1)
-        self.send_command(':SOUR:SWE:RANG AUTO')
-        time.sleep(.1)
-        self.send_command(':SOUR:SWE:SPAC LIN')
-        time.sleep(.1)
-        self.send_command(':SOUR:SWE:POIN %s' %sweep_points)
-        time.sleep(.1)
-        self.send_command(':TRIG:COUN %s' %num_trigs)
-        time.sleep(.1)
-        self.send_command(':SOUR:DEL 0.1')
-        time.sleep(.1)
+        return data
+
+    def sweep(self, data_type=None, start=-10, stop=10, step=1, num_sweeps=1,
+              delay=0.1):
+        num_trigs = self.configure_sweep(data_type, start, stop, step,
+                                         num_sweeps, delay)
+        self.send_command(':OUTP ON')
+        self.send_command(':INIT')
+        data = None
+        # Allow for the source delays
+        if self.wait_for_completion(timeout=self.timeout + num_trigs*delay):
+            data = self.fetch(num_readings=int(num_trigs))
+        self.send_command(':OUTP OFF')
+        return data
+
+    """
+    Send the setup for a linear voltage sweep, without starting it.
+    delay is the source delay (seconds) before each reading.
+    Returns: the number of triggers (readings) the sweep will take.
+    """
+    def configure_sweep(self, data_type=None, start=-10, stop=10, step=1,
+                        num_sweeps=1, delay=0.1):
+        commands, num_trigs = sweep_commands(data_type, start, stop, step,
+                                             num_sweeps, delay)
+        with self.batch():
+            self._send_each(commands)
+        self.elements = elements_for(data_type)
+        return num_trigs
+
+    """
+    The same voltage sweep as sweep, in blocks of at most block_size
+    readings that come back as they are taken, e.g. for plotting a slow
+    sweep as it goes. The Keithley starts a sweep (or source list) again
+    at every :INIT and does not answer while it runs, so each block is a
+    list sweep (see list_sweep) through the next source values.
+    sink is as for iter_trace_blocks.
+    Yields: a structured array of readings per block; the time stamps
+    start again with each block.
+    """
+    def iter_sweep_blocks(self, data_type=None, start=-10, stop=10, step=1,
+                          num_sweeps=1, delay=0.1, block_size=100,
+                          sink=None):
+        values = np.tile(sweep_values(start, stop, step), num_sweeps)
+        block_size = min(max(block_size, 1), list_max_points)
+        for first in range(0, len(values), block_size):
+            data = self.list_sweep(values[first:first + block_size], 'VOLT',
+                                   data_type=data_type, delay=delay)
+            if data is None:
+                return
+            if sink is not None:
+                sink.extend(data)
+            yield data
+
+    """
+    Sweep through an arbitrary list of source values (log spacing, pulses,
+    custom waveforms...), timed by the Keithley rather than from Python.
+    values is a sequence or array of volts (source='VOLT') or amps
+    (source='CURR'), at most list_max_points of them; each gets one
+    reading, after the source delay.
+    Returns: the readings, as for sweep.
+    """
+    def list_sweep(self, values, source='VOLT', data_type=None, num_sweeps=1,
+                   delay=0.1):
+        num_trigs = self.configure_list_sweep(values, source, data_type,
+                                              num_sweeps, delay)
+        if num_trigs is None:
+            return None
         self.send_command(':OUTP ON')
-        time.sleep(.1)
         self.send_command(':INIT')
-        # FETCH? waits for INIT to complete
-        response = self.get_response(':FETCH?')
-        time.sleep(.25)
+        data = None
+        if self.wait_for_completion(timeout=self.timeout + num_trigs*delay):
+            data = self.fetch(num_readings=num_trigs)
         self.send_command(':OUTP OFF')
-        return parse_data(response, data_type=data_type)
+        return data
+
+    """
+    Sweep from start to stop with fine steps only where the curve changes.
+    A coarse pass of coarse_points evenly spaced points comes first; then,
+    pass after pass, extra points go wherever the curve still moves too
+    far between neighbouring points (see refine_points), each pass as one
+    list sweep, until it is fine enough everywhere, or max_points or
+    max_passes is reached. Points that would go over max_points are left
+    out where the curve bends least (and a message is printed). source is
+    'VOLT' (volts measured in amps) or 'CURR'; tolerance and min_step are
+    as for refine_points.
+    Returns: all the readings, in order of the source value.
+    """
+    def adaptive_sweep(self, start=-10, stop=10, source='VOLT',
+                       coarse_points=21, tolerance=.05, min_step=None,
+                       max_points=2500, max_passes=8, delay=0.1):
+        sweep = AdaptiveSweep(start, stop, source, coarse_points, tolerance,
+                              min_step, max_points)
+        for i in range(max_passes):
+            if len(sweep.values) == 0:
+                break
+            data = self.list_sweep(sweep.values, sweep.source,
+                                   data_type=sweep.elements, delay=delay)
+            if data is None:
+                break
+            sweep.add(data)
+        return sweep.result()
+
+    """
+    Upload a source list (see list_sweep) and set up the sweep through it,
+    without starting it. The list goes in as many :SOUR:LIST commands as
+    the Keithley needs, see list_commands. The sense function is the
+    other of volts/amps; the compliance is left as it is.
+    Returns: the number of triggers (readings), or None if the list is
+    empty or too long.
+    """
+    def configure_list_sweep(self, values, source='VOLT', data_type=None,
+                             num_sweeps=1, delay=0.1):
+        commands, num_trigs = list_sweep_commands(values, source, data_type,
+                                                  num_sweeps, delay,
+                                                  self.max_line_length)
+        if num_trigs is None:
+            return None
+        with self.batch():
+            self._send_each(commands)
+        self.elements = elements_for(data_type)
+        return num_trigs
+
+    """
+    Ask for readings (':FETCH?' by default) and decode them in the current
+    data format, as a structured array with one field per element
+    ('volt', 'curr', 'res', 'time', 'stat'), see parse_data and parse_binary.
+    The layout comes from the elements last set with :FORM:ELEM, asking the
+    Keithley if they are not known.
+    num_readings is needed for binary data, as the 2400 does not send the
+    block length. timeout is the longest wait (seconds) for the readings to
+    be ready; when num_readings is known the time they take to come over
+    the port is added to it.
+    """
+    def fetch(self, query=':FETCH?', num_readings=None, timeout=None):
+        elements = self.elements
+        if elements is None:
+            elements = self.get_elements()
+        if timeout is None:
+            timeout = self.timeout
+        if num_readings is not None:
+            timeout += transfer_time(num_readings, elements,
+                                     self.data_format,
+                                     getattr(self.ser, 'baudrate', None) or
+                                     57600)
+        if not self.is_open():
+            print("Port is closed...")
+            return None
+        self._flush_batch()
+        response = self._query(query, lambda: self._read_data(
+            elements, num_readings, timeout))
+        return self._parse_data(response, elements)
+
+    """
+    Read the response to a data query (:FETCH?, :TRAC:DATA?) that has
+    been sent. num_readings is needed for binary data, see fetch.
+    Returns: str of ASCII data, or bytes of binary data; empty on timeout.
+    """
+    def _read_data(self, elements, num_readings, timeout):
+        if self.data_format == 'ascii':
+            return ks.read(self.ser, stats=self.last_read_stats,
+                           timeout=timeout)
+        nbytes = None
+        if num_readings is not None:
+            size = 4 if self.data_format == 'sreal' else 8
+            nbytes = num_readings*len(elements)*size
+        return ks.read_block(self.ser, nbytes=nbytes,
+                             stats=self.last_read_stats, timeout=timeout)
+
+    def _parse_data(self, response, elements):
+        if not response:
+            return None
+        if self.data_format == 'ascii':
+            return parse_data(response, elements=elements)
+        return parse_binary(response, data_format=self.data_format,
+                            byte_order=self.byte_order, elements=elements)
+
+    """
+    Acquire readings block by block through the trace buffer, for runs
+    longer than one :FETCH? can hold. Each block of block_size readings
+    (at most 2500, the size of the buffer) is stored with :TRAC:FEED SENS.
+    The download and the re-arm for the next block go out in one line, so
+    the Keithley starts acquiring the next block while the previous one is
+    still being sent over the port. Only one block is asked for at a time:
+    on GPIB a second query before the first has been read would interrupt
+    it (and lose its readings).
+    num_blocks=None keeps acquiring until the generator is closed.
+    timeout is the longest wait (seconds) for one block.
+    sink is handed every block as it arrives, with sink.extend(block);
+    a keithley_storage.BackgroundWriter keeps writing them to disk out of
+    the way of the acquisition.
+    Yields: a structured array of readings per block, as from fetch.
+    """
+    def iter_trace_blocks(self, block_size=2500, num_blocks=None,
+                          data_type=None, timeout=None, sink=None):
+        if timeout is None:
+            timeout = self.timeout
+        block_size = self.configure_trace(block_size, data_type)
+        self.send_command(':OUTP ON')
+        self.send_command(':INIT')
+        count = 0
+        try:
+            while num_blocks is None or count < num_blocks:
+                count += 1
+                if not self.wait_for_completion(timeout=timeout):
+                    return
+                query = [':TRAC:DATA?']
+                if num_blocks is None or count < num_blocks:
+                    query += trace_rearm_commands
+                data = self.fetch(query=';'.join(query),
+                                  num_readings=block_size, timeout=timeout)
+                if data is None:
+                    return
+                if sink is not None:
+                    sink.extend(data)
+                yield data
+        finally:
+            self.stop_trace()
+
+    """
+    Send the setup for acquiring blocks of block_size readings into the
+    trace buffer, without starting it.
+    Returns: the block size used (at most 2500).
+    """
+    def configure_trace(self, block_size=2500, data_type=None):
+        commands, block_size = trace_commands(block_size, data_type)
+        with self.batch():
+            self._send_each(commands)
+        self.elements = elements_for(data_type)
+        return block_size
+
+    def stop_trace(self):
+        with self.batch(check_errors=False):
+            self._send_each(stop_trace_commands)
+
+    """
+    Stream readings in chunks of chunk_size as they come off the port, using
+    the trace buffer (see iter_trace_blocks), for as long as the generator
+    is used (or num_chunks). Nothing is kept between chunks, so memory
+    stays flat for runs of any length. If buffer is a RingBuffer (see
+    keithley_buffer) every chunk is also copied into it, so the latest
+    readings are at hand for plotting. sink is as for iter_trace_blocks.
+    Yields: a structured array of readings per chunk.
+    """
+    def stream_chunks(self, chunk_size=100, num_chunks=None, data_type=None,
+                      buffer=None, timeout=None, sink=None):
+        for chunk in self.iter_trace_blocks(chunk_size, num_chunks,
+                                            data_type=data_type,
+                                            timeout=timeout, sink=sink):
+            if buffer is not None:
+                buffer.extend(chunk)
+            yield chunk
+
+    """
+    Stream single readings, see stream_chunks.
+    Yields: one reading at a time, with fields like data['volt'].
+    """
+    def stream(self, chunk_size=100, num_readings=None, data_type=None,
+               buffer=None, timeout=None, sink=None):
+        num_chunks = None
+        if num_readings is not None:
+            num_chunks = -(-num_readings // chunk_size)
+        count = 0
+        for chunk in self.stream_chunks(chunk_size, num_chunks,
+                                        data_type=data_type, buffer=buffer,
+                                        timeout=timeout, sink=sink):
+            for reading in chunk:
+                if num_readings is not None and count == num_readings:
+                    return
+                count += 1
+                yield reading
+
+    """
+    Acquire num_points readings through the trace buffer, see
+    iter_trace_blocks, and return them as one structured array.
+    """
+    def trace(self, num_points, block_size=2500, data_type=None, timeout=None,
+              sink=None):
+        # Spread the points evenly over as few blocks as possible
+        num_blocks = -(-num_points // min(block_size, 2500))
+        block_size = -(-num_points // num_blocks)
+        blocks = list(self.iter_trace_blocks(block_size, num_blocks,
+                                             data_type=data_type,
+                                             timeout=timeout, sink=sink))
+        if not blocks:
+            return None
+        return np.concatenate(blocks)[:num_points]
+
+
+"""   The commands for each setting, checked and formatted   """
+
+def source_type_commands(source_type):
+    source_type = source_type.lower()
+    if source_type == 'current' or source_type == 'curr' or source_type == 'c':
+        return [':SOUR:FUNC CURRENT']
+    elif source_type == 'voltage' or source_type == 'volt' or source_type == 'v':
+        return [':SOUR:FUNC VOLT']
+    else:
+        print("Unknown source setting!")
+        return []
+
+def source_voltage_commands(voltage):
+    if type(voltage) == int or type(voltage) == float:
+        if voltage > 200:
+            voltage = 200
+            print("Voltage limits are  +/- 200 V")
+        if voltage < -200:
+            voltage = -200
+            print("Voltage limits are  +/- 200 V")
+        return source_type_commands('voltage') + [':SOUR:VOLT %s' %voltage]
+    else:
+        print("Bad voltage sent")
+        return []
+
+def source_current_commands(current):
+    if type(current) == int or type(current) == float:
+        if current > 1:
+            current = 1
+            print("Current limits are  +/- 1 A")
+        if current < -1:
+            current = -1
+            print("Current limits are  +/- 1 A")
+        return source_type_commands('current') + [':SOUR:CURR %s' %current]
+    else:
+        print("Bad current sent")
+        return []
+
+"""
+Returns: 'current' or 'voltage' for a sensor type ('curr', 'v', ...),
+None if it is neither.
+"""
+def sensor_name(sensor_type):
+    sensor_type = sensor_type.lower()
+    if sensor_type == 'current' or sensor_type == 'curr' or sensor_type == 'c':
+        return 'current'
+    elif sensor_type == 'voltage' or sensor_type == 'volt' or sensor_type == 'v':
+        return 'voltage'
+    return None
+
+def sensor_type_commands(sensor_type):
+    sensor_type = sensor_name(sensor_type)
+    if sensor_type == 'current':
+        return [':SENS:FUNC "CURR"']
+    elif sensor_type == 'voltage':
+        return [':SENS:FUNC "VOLT"']
+    else:
+        print("Unknown sensor setting!")
+        return []
+
+def sensor_range_commands(sensor_type, sensor_range):
+    commands = sensor_type_commands(sensor_type)
+    sensor_type = sensor_name(sensor_type)
+    print("Sensor type set to %s" %sensor_type)
+    if type(sensor_range) == int or type(sensor_range) == float:
+        order = int(('%.2E' %sensor_range)[5:])
+        if sensor_type == 'voltage':
+            commands.append(':SENS:VOLT:RANG 10E%s' %order)
+        elif sensor_type == 'current':
+            commands.append(':SENS:CURR:RANG 10E%s' %order)
+        else:
+            print("Shouldn't get here!")
+    else:
+        print("Bad range sent.")
+    return commands
+
+"""
+The compliance limit on the sensed function, 'VOLT' or 'CURR'.
+"""
+def compliance_commands(function, limit):
+    if type(limit) == int or type(limit) == float:
+        coeff = float(('%.2E' %limit)[:3])
+        order = int(('%.2E' %limit)[5:])
+        return [':SENS:%s:PROT %sE%s' %(function, coeff, order)]
+    else:
+        print("Bad compliance value sent.")
+        return []
+
+def num_triggers_commands(num):
+    if type(num) == int:
+        if num < 1:
+            print("Number of triggers must be between 1-2500")
+            print("Triggers set to 1")
+            num = 1
+        if num > 2500:
+            print("Number of triggers must be between 1-2500")
+            print("Triggers set to 2500")
+            num = 2500
+        return [':TRIG:COUN %s' %num]
+    else:
+        print("Bad trigger value sent.")
+        return []
+
+"""
+See Keithley.set_data_format.
+Returns: the commands, empty if the format or byte order is unknown.
+"""
+def data_format_commands(data_format='ascii', byte_order='swap'):
+    data_format = data_format.lower()
+    byte_order = byte_order.lower()
+    if data_format not in ['ascii', 'sreal', 'dreal']:
+        print("Unknown data format!")
+        return []
+    if byte_order not in ['swap', 'norm']:
+        print("Unknown byte order!")
+        return []
+    commands = [':FORM:DATA %s' %data_format.upper()]
+    if data_format != 'ascii':
+        commands.append(':FORM:BORD %s' %byte_order.upper())
+    return commands
+
+def elements_command(elements):
+    return ':FORM:ELEM %s' %', '.join(name.upper() for name in elements)
+
+"""
+See Keithley.configure_sweep.
+Returns: (commands, number of triggers).
+"""
+def sweep_commands(data_type=None, start=-10, stop=10, step=1, num_sweeps=1,
+                   delay=0.1):
+    sweep_points = (stop-start)/step
+    num_trigs = num_sweeps*sweep_points
+    commands = [elements_command(elements_for(data_type)),
+                ':SOUR:FUNC VOLT',
+                ":SENS:FUNC 'CURR:DC'",
+                ':SENS:CURR:PROT 0.5',
+                ':SOUR:VOLT:START %s' %start,
+                ':SOUR:VOLT:STOP %s' %stop,
+                ':SOUR:VOLT:STEP %s' %step,
+                ':SOUR:VOLT:MODE SWE',
+                ':SOUR:SWE:RANG AUTO',
+                ':SOUR:SWE:SPAC LIN',
+                ':SOUR:SWE:POIN %s' %sweep_points,
+                ':TRIG:COUN %s' %num_trigs,
+                ':SOUR:DEL %s' %delay]
+    return commands, num_trigs
+
+"""
+The source values of a linear sweep from start to stop in steps of step,
+both ends included.
+"""
+def sweep_values(start, stop, step):
+    points = int(round(abs((stop - start)/float(step)))) + 1
+    return np.linspace(start, stop, points)
+
+"""
+See Keithley.configure_list_sweep.
+Returns: (commands, number of triggers), ([], None) if the list is empty
+or too long.
+"""
+def list_sweep_commands(values, source='VOLT', data_type=None, num_sweeps=1,
+                        delay=0.1, max_length=250):
+    source = source.upper()[:4]
+    sense = 'VOLT' if source == 'CURR' else 'CURR'
+    values = np.ravel(values)
+    if len(values) == 0 or len(values) > list_max_points:
+        print("Source list must have 1 to %d points..." %list_max_points)
+        return [], None
+    num_trigs = num_sweeps*len(values)
+    commands = [elements_command(elements_for(data_type)),
+                ':SOUR:FUNC %s' %source,
+                ":SENS:FUNC '%s:DC'" %sense]
+    commands += list_commands(values, source, max_length)
+    commands += [':SOUR:%s:MODE LIST' %source,
+                 ':TRIG:COUN %d' %num_trigs,
+                 ':SOUR:DEL %s' %delay]
+    return commands, num_trigs
+
+"""
+See Keithley.configure_trace.
+Returns: (commands, the block size used).
+"""
+def trace_commands(block_size=2500, data_type=None):
+    if block_size < 1 or block_size > 2500:
+        print("Block size must be between 1-2500")
+        block_size = min(max(block_size, 1), 2500)
+    commands = [elements_command(elements_for(data_type)),
+                ':TRAC:CLE',
+                ':TRAC:POIN %s' %block_size,
+                ':TRAC:FEED SENS',
+                ':TRIG:COUN %s' %block_size,
+                ':TRAC:FEED:CONT NEXT']
+    return commands, block_size
+
+
+"""
+Split a SCPI command into its header and value, e.g. ':SOUR:VOLT 1' gives
+(':SOUR:VOLT', '1'). The header is upper case and starts with ':'.
+Returns: (header, value), with value None for common commands ('*RST')
+and commands without a value (':INIT').
+"""
+def split_command(command):
+    parts = command.strip().split(None, 1)
+    if not parts:
+        return None, None
+    header = parts[0].upper()
+    if not header.startswith((':', '*')):
+        header = ':' + header
+    if header.startswith('*') or len(parts) == 1:
+        return header, None
+    return header, parts[1].strip()
+
+"""
+The short form of a SCPI header, so ':SOURce:VOLTage' and ':SOUR:VOLT'
+are the same setting: each keyword is cut to four letters, or three if
+the fourth is a vowel (DELay, SWEep, ERRor).
+"""
+def short_header(header):
+    header = header.upper().strip()
+    if header.startswith('*'):
+        return header
+    keywords = []
+    for keyword in header.strip(':').split(':'):
+        keyword = keyword.strip('[]')
+        if len(keyword) > 4:
+            keyword = keyword[:3] if keyword[3] in 'AEIOU' else keyword[:4]
+        keywords.append(keyword)
+    header = ':' + ':'.join(keywords)
+    return header_aliases.get(header, header)
+
+# Optional nodes that are sometimes left out and sometimes put in
+header_aliases = {':FORM': ':FORM:DATA',
+                  ':OUTP:STAT': ':OUTP',
+                  ':SOUR:VOLT:LEV': ':SOUR:VOLT',
+                  ':SOUR:CURR:LEV': ':SOUR:CURR',
+                  ':SYST:ERR:NEXT': ':SYST:ERR'}
+
+"""
+Whether a setting read back from the Keithley matches the value sent,
+ignoring case, quotes and spaces, and comparing numbers as numbers.
+"""
+def same_setting(response, value):
+    response = response.replace('"', '').replace("'", '').replace(' ', '')
+    value = value.replace('"', '').replace("'", '').replace(' ', '')
+    try:
+        return float(response) == float(value)
+    except ValueError:
+        return response.upper() == value.upper()
+
+"""
+A shadow copy of the instrument settings, by SCPI header (in its short
+form, see short_header), so that writes that would not change anything
+can be skipped. Commands without a value (':INIT') are actions and always
+sent, and so are the headers in uncached_headers. Anything that resets
+the Keithley clears the cache, and a sweep setting forgets the ones the
+Keithley works out again from it (see coupled_settings).
+"""
+class StateCache(object):
+
+    # Always sent: the output state is safety related and can be changed
+    # from the front panel, and the trace buffer stops feeding by itself
+    # once it is full.
+    uncached_headers = [':OUTP', ':TRAC:FEED:CONT']
+    # Source lists are built up by appending, so always sent as well
+    uncached_headers += [':SOUR:LIST:VOLT', ':SOUR:LIST:CURR',
+                         ':SOUR:LIST:VOLT:APP', ':SOUR:LIST:CURR:APP']
+    # The baud rate goes with the port, see Keithley.set_baudrate
+    uncached_headers += [':SYST:COMM:SER:BAUD']
+    # Commands that put the settings back to their defaults
+    resetting_headers = ['*RST', '*RCL', ':SYST:PRES', ':SYST:POS']
+    # Sweep settings changed by the Keithley when the key is written:
+    # the step follows from start, stop (or center, span) and the points,
+    # and the points from the step
+    coupled_settings = {'STAR': ['CENT', 'SPAN', 'STEP'],
+                        'STOP': ['CENT', 'SPAN', 'STEP'],
+                        'CENT': ['STAR', 'STOP', 'STEP'],
+                        'SPAN': ['STAR', 'STOP', 'STEP'],
+                        'STEP': ['POIN'],
+                        'POIN': ['STEP']}
+
+    def __init__(self):
+        self.settings = {}
+
+    def clear(self):
+        self.settings = {}
+
+    def forget(self, header):
+        self.settings.pop(short_header(header), None)
+
+    """
+    Record a command.
+    Returns: False if it sets a value that is already in place,
+    True if it needs to be sent.
+    """
+    def update(self, command):
+        header, value = split_command(command)
+        header = short_header(header)
+        if header in self.resetting_headers:
+            self.clear()
+            return True
+        if value is None or header in self.uncached_headers:
+            return True
+        if self.settings.get(header) == value:
+            return False
+        self.settings[header] = value
+        for other in self._coupled(header):
+            self.settings.pop(other, None)
+        return True
+
+    """
+    Returns: the headers of the sweep settings that writing header
+    changes on the Keithley.
+    """
+    def _coupled(self, header):
+        keywords = header.split(':')
+        if header == ':SOUR:SWE:POIN':
+            return [':SOUR:VOLT:STEP', ':SOUR:CURR:STEP']
+        if (len(keywords) != 4 or keywords[1] != 'SOUR' or
+                keywords[2] not in ['VOLT', 'CURR']):
+            return []
+        prefix = ':'.join(keywords[:3])
+        return [':SOUR:SWE:POIN' if name == 'POIN' else prefix + ':' + name
+                for name in self.coupled_settings.get(keywords[3], [])]
+
+"""
+Join SCPI commands with ';' into lines no longer than max_length.
+A command that does not start at the root (':') or is not a common
+command ('*') gets a leading ':' so it is not read relative to the
+command before it. A command longer than max_length is sent on its own.
+Returns: list of command lines.
+"""
+def join_commands(commands, max_length=250):
+    lines = []
+    line = ''
+    for com in commands:
+        com = com.strip()
+        if not com.startswith((':', '*')):
+            com = ':' + com
+        if line and len(line) + 1 + len(com) > max_length:
+            lines.append(line)
+            line = ''
+        line = com if not line else line + ';' + com
+    if line:
+        lines.append(line)
+    return lines
+
+# The 2400 takes at most 100 values in one :SOUR:LIST command, and keeps
+# up to 2500 in the list
+list_chunk_points = 100
+list_max_points = 2500
+
+"""
+The commands that load values into the source list of function
+('VOLT' or 'CURR'): the first replaces the list, the rest append to it.
+Each has at most list_chunk_points values and, as far as possible, is no
+longer than max_length so it can go on a line of its own.
+Returns: list of commands.
+"""
+def list_commands(values, function='VOLT', max_length=250):
+    commands = []
+    chunk = []
+    length = 0
+    for value in np.ravel(values):
+        text = '%.7g' %value
+        header = ':SOUR:LIST:%s%s ' %(function, ':APP' if commands else '')
+        if chunk and (len(chunk) == list_chunk_points or
+                      len(header) + length + 1 + len(text) > max_length):
+            commands.append(header + ','.join(chunk))
+            chunk = []
+            length = 0
+        chunk.append(text)
+        length += len(text) + (length > 0)
+    if chunk:
+        header = ':SOUR:LIST:%s%s ' %(function, ':APP' if commands else '')
+        commands.append(header + ','.join(chunk))
+    return commands
 
+"""
+Where to add points to a sampled curve y(x) (x sorted) so that it is
+followed closely by straight lines between them. Each interval is
+measured in units of the whole range of x and of y, and split into
+pieces no longer than tolerance, unless they would be shorter than
+min_step (in x) or the curve is straight there: neither end point lies
+off the line through its own neighbours by more than tolerance/10 of
+the range of y. Steep bends get many points, straight parts none.
+Returns: array of the new x values, sorted; with scores also an array of
+how far off straight the curve is around each (in units of the range of
+y), to pick the most needed ones.
+"""
+def refine_points(x, y, tolerance=.05, min_step=0., scores=False):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x_range = np.ptp(x) or 1.
+    y_range = np.ptp(y) or 1.
+    dx = np.diff(x)
+    length = np.hypot(dx/x_range, np.diff(y)/y_range)
+    bend = np.zeros(len(x))
+    if len(x) > 2:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chord = y[:-2] + (y[2:] - y[:-2])*(x[1:-1] - x[:-2])/(x[2:] -
+                                                                  x[:-2])
+        bend[1:-1] = np.nan_to_num(np.abs(y[1:-1] - chord))/y_range
+    pieces = np.ceil(length/tolerance)
+    interval_bend = np.maximum(bend[:-1], bend[1:])
+    pieces[interval_bend <= tolerance/10] = 1
+    if min_step > 0:
+        pieces = np.minimum(pieces, np.floor(dx/min_step))
+    split = np.nonzero(pieces > 1)[0]
+    new = [x[i] + dx[i]*np.arange(1, pieces[i])/pieces[i] for i in split]
+    if not new:
+        return (np.zeros(0), np.zeros(0)) if scores else np.zeros(0)
+    new = np.concatenate(new)
+    if scores:
+        return new, np.repeat(interval_bend[split],
+                              pieces[split].astype(int) - 1)
+    return new
+
+"""
+The bookkeeping of an adaptive sweep (see Keithley.adaptive_sweep), apart
+from taking the readings, so that Keithley and AsyncKeithley share it.
+values are the source values to measure next, empty once the curve is
+fine enough everywhere or max_points is reached; add takes their
+readings and works out the next ones.
+"""
+class AdaptiveSweep(object):
+
+    def __init__(self, start=-10, stop=10, source='VOLT', coarse_points=21,
+                 tolerance=.05, min_step=None, max_points=2500):
+        self.source = source.upper()[:4]
+        if self.source == 'CURR':
+            self.x_name, self.y_name = 'curr', 'volt'
+        else:
+            self.x_name, self.y_name = 'volt', 'curr'
+        if min_step is None:
+            min_step = abs(stop - start)*1e-4
+        self.tolerance = tolerance
+        self.min_step = min_step
+        self.max_points = min(max_points, list_max_points)
+        self.values = np.linspace(start, stop,
+                                  min(coarse_points, self.max_points))
+        self.blocks = []
+
+    @property
+    def elements(self):
+        return [self.x_name, self.y_name]
+
+    def add(self, data):
+        self.blocks.append(data)
+        data = self.result()
+        values, scores = refine_points(data[self.x_name], data[self.y_name],
+                                       self.tolerance, self.min_step,
+                                       scores=True)
+        room = max(self.max_points - len(data), 0)
+        if len(values) > room:
+            print("Reached max_points, %d of %d new points left out"
+                  %(len(values) - room, len(values)))
+            keep = np.argsort(-scores, kind='stable')[:room]
+            values = np.sort(values[keep])
+        self.values = values
+
+    """
+    Returns: all the readings so far, in order of the source value; None
+    if there are none.
+    """
+    def result(self):
+        if not self.blocks:
+            return None
+        data = np.concatenate(self.blocks)
+        return data[np.argsort(data[self.x_name], kind='stable')]
+
+# Queries that do more than read something back, so are not repeated
+triggering_queries = [':READ', ':MEAS', ':MEAS:VOLT', ':MEAS:CURR',
+                      ':MEAS:RES']
+# Queries answered only once the Keithley is done (with a sweep, ...).
+# A timeout does not mean the response is lost, so sending them again
+# would leave one more response waiting.
+deferred_queries = ['*OPC', ':FETC', ':TRAC:DATA']
+# Sent to get back in step after a timeout (see Keithley._resync), and
+# what its response contains
+resync_query = '*IDN?'
+resync_marker = b'KEITHLEY'
+
+"""
+Whether command can be sent again without changing anything: every
+command on the line is a query, none of them triggers readings and none
+waits for the Keithley to be done.
+"""
+def is_idempotent(command):
+    for com in command.split(';'):
+        header = com.strip().split(None, 1)[0] if com.strip() else ''
+        if not header.endswith('?'):
+            return False
+        header = short_header(header[:-1])
+        if header in triggering_queries or header in deferred_queries:
+            return False
+    return True
+
+_error_pattern = re.compile(r'([+-]?\d+),"([^"]*)"')
+
+"""
+Parse the reply to :SYST:ERR:ALL?, e.g. '-113,"Undefined header",0,"No error"'.
+Returns: list of (code, message), without the 'No error' entries.
+"""
+def parse_errors(response):
+    return [(int(code), message)
+            for code, message in _error_pattern.findall(response)
+            if int(code) != 0]
+
+"""
+Elements in the order the Keithley sends them, whatever order :FORM:ELEM
+lists them in (volts, amps, ohms, timestamp, status).
+"""
+element_order = ['volt', 'curr', 'res', 'time', 'stat']
+
+"""
+Elements returned for each data_type.
+"""
+data_elements = {None: ['volt', 'curr', 'res', 'time'],
+                 'v': ['volt', 'time'],
+                 'c': ['curr', 'time'],
+                 'r': ['res', 'time']}
+
+"""
+The elements for a data_type ('v', 'c', 'r' or None), or for a list of
+element names, in the order the Keithley sends them.
+"""
+def elements_for(data_type=None):
+    if data_type is None or isinstance(data_type, str):
+        if data_type is not None:
+            data_type = data_type.lower()
+        if data_type not in data_elements:
+            print("Bad data_type given, returning full data set")
+            data_type = None
+        return list(data_elements[data_type])
+    elements = [name.lower() for name in data_type]
+    return [name for name in element_order if name in elements]
+
+"""
+Roughly how long (seconds) num_readings take to come over the port, at
+about 14 characters per ASCII value and 10 bits per byte.
+"""
+def transfer_time(num_readings, elements, data_format='ascii', baudrate=57600):
+    size = {'ascii': 14, 'sreal': 4, 'dreal': 8}[data_format]
+    return num_readings*len(elements)*size*10./baudrate
+
+"""
+The NumPy structured dtype of one reading, one float field per element.
+size and byte_order ('swap' little-endian, 'norm' big-endian) describe how
+the floats arrive; ASCII readings are parsed to native doubles.
+"""
+def reading_dtype(elements, size=8, byte_order=None):
+    order = {None: '=', 'swap': '<', 'norm': '>'}[byte_order]
+    return np.dtype([(name, '%sf%s' %(order, size)) for name in elements])
 
 """
-This function parses the data returned from the Keithley.
-The data is stuctured as {Volts, Amps, Ohms, Timestamp, Status}.
-This creates an array of {Time, Volts, Amps, Ohms}.
-Each element is a column vector for easy plotting.
+This function parses the ASCII data returned from the Keithley.
+The readings are parsed in one vectorized pass and returned as a structured
+array, one float64 field per element, e.g. data['time'], data['volt'].
+The fields are views on one contiguous array of values, nothing is copied.
 KEYWORDS:
 data_type = 'v' returns only time and volts, 'c', only time and current,
 'r' only time and ohms.
+elements = the elements actually set with :FORM:ELEM, overrides data_type.
+Raises ValueError if the data does not split into whole readings.
 """
-def parse_data(data, data_type=None):
-    # Clean up the strings, splits into list
-    data = data.replace(' ', '').split(',')
-    # Reshape in sections
-    if data_type in ['v', 'c', 'r']:
-        cols = 2
-    else:
-        cols = 4
-    # NOTE If data is not returned in groups of "cols" this will drop elements!
-    data = zip(*[iter(data)]*cols)
-    # Use an array as they can be indexed, and for type conversion
-    data = np.array(data).astype(np.float)
-    if data_type == None:
-        return np.array([data[:,3], data[:,0], data[:,1], data[:,2]])
-    elif data_type.lower() == 'v':
-        return np.array([data[:,1], data[:,0]])
-    elif data_type.lower() == 'c':
-        return np.array([data[:,2], data[:,0]])
-    elif data_type.lower() == 'r':
-        return np.array([data[:,3], data[:,0]])
-    else:
-        print("Bad data_type given, returning full data set")
-        return np.array([data[:,3], data[:,0], data[:,1], data[:,2]])
+def parse_data(data, data_type=None, elements=None):
+    if elements is None:
+        elements = elements_for(data_type)
+    with warnings.catch_warnings():
+        # Bad values are reported below, not as a NumPy warning
+        warnings.simplefilter('ignore', DeprecationWarning)
+        values = np.fromstring(data, sep=',')
+    if values.size != data.count(',') + 1:
+        raise ValueError("Could not parse value %s of the Keithley data"
+                         %(values.size + 1))
+    if values.size % len(elements):
+        raise ValueError("%s values is not a whole number of %s element "
+                         "readings" %(values.size, len(elements)))
+    return values.view(reading_dtype(elements))
+
+"""
+Decode a binary block of readings without any string step.
+The array is a view on the received bytes, one field per element,
+e.g. data['volt'], data['time'].
+"""
+def parse_binary(block, data_type=None, data_format='sreal', byte_order='swap',
+                 elements=None):
+    if elements is None:
+        elements = elements_for(data_type)
+    size = 4 if data_format.lower() == 'sreal' else 8
+    dtype = reading_dtype(elements, size, byte_order.lower())
+    if len(block) % dtype.itemsize:
+        raise ValueError("%s bytes is not a whole number of %s byte readings"
+                         %(len(block), dtype.itemsize))
+    return np.frombuffer(block, dtype=dtype)
+
+"""
+Sent after each :TRAC:DATA? to start filling the trace buffer again.
+"""
+trace_rearm_commands = [':TRAC:CLE', ':TRAC:FEED:CONT NEXT', ':INIT']
+
+"""
+Stop acquiring into the trace buffer, see Keithley.stop_trace.
+"""
+stop_trace_commands = [':ABOR', ':OUTP OFF', ':TRAC:FEED:CONT NEV']
 
 """  Fast Settings  """
 start_up_commands = ["*RST",
@@ -278,9 +1492,13 @@ start_up_commands = ["*RST",
                      ":SOUR:DELAY 0.0",
                      ":DISP:ENAB OFF"]
 
-class FakeKeithley(object):
-    def __init__(self):
-        for method in Keithley.__dict__:
-            self.__dict__[method] = self.fake_method
-    def fake_method(self, *arg, **kwarg):
-        pass
+"""
+A Keithley connected to a simulated instrument instead of a port (see
+keithley_sim), e.g. FakeKeithley('diode', noise=1e-3).
+"""
+class FakeKeithley(Keithley):
+    def __init__(self, model='resistor', **options):
+        port = 'sim://%s' %model
+        if options:
+            port += '?' + '&'.join('%s=%s' %item for item in options.items())
+        Keithley.__init__(self, port)
@@ -14,15 +14,67 @@ author: T. Max Roberts
 """
 
 import sys, time
-from pyqtgraph import PlotWidget
-from pyqtgraph.Qt import QtGui, QtCore
+import numpy as np
+try:
+    from pyqtgraph import PlotWidget
+    from pyqtgraph.Qt import QtGui, QtCore
+except ImportError:
+    raise ImportError("pyqtgraph and a Qt binding (e.g. PyQt5) are needed "
+                      "for the GUI: pip install .[gui]")
 import keithley_control as kc
+import keithley_buffer as kb
+
+# Plots are redrawn at most this often (ms), whatever the data rate
+refresh_interval = 33
+# Most readings kept for the live plots; a sweep only takes what it needs
+plot_buffer_size = 2*10**6
+# Readings per block of a sweep, so the plots fill in as it goes
+sweep_block_size = 50
+
+"""
+Runs an acquisition away from the GUI thread (see Keithley_GUI.acquire),
+sending the readings back block by block through the block signal.
+function() does the acquisition, returning a generator of blocks of
+readings; after stop it is closed at the end of the current block.
+"""
+class AcquisitionWorker(QtCore.QObject):
+
+    block = QtCore.Signal(object)
+    failed = QtCore.Signal(str)
+    finished = QtCore.Signal()
+
+    def __init__(self, function):
+        super(AcquisitionWorker, self).__init__()
+        self.function = function
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        try:
+            blocks = self.function()
+            for data in blocks:
+                if data is not None:
+                    self.block.emit(data)
+                if self.stopped:
+                    blocks.close()
+                    break
+        except Exception as error:
+            self.failed.emit(str(error))
+        self.finished.emit()
+
 
 class Keithley_GUI(QtGui.QMainWindow):
 
     def __init__(self, port, connected=True):
-        super(Example, self).__init__()
+        super(Keithley_GUI, self).__init__()
 
+        self.worker = None
+        self.thread = None
+        self.buffer = None
+        self.time_offset = 0.
+        self.new_data = False
         self.initKeithley(port, connected=connected)
         self.initUI()
 
@@ -71,9 +123,9 @@ class Keithley_GUI(QtGui.QMainWindow):
         grid.addLayout(vbox, 0, 3, 8, 12)
 
         # Make reset button
-        button = QtGui.QPushButton("reset")
-        button.clicked.connect(self.buttonClicked)
-        grid.addWidget(button, 0, 1)
+        self.resetButton = QtGui.QPushButton("reset")
+        self.resetButton.clicked.connect(self.buttonClicked)
+        grid.addWidget(self.resetButton, 0, 1)
 
         #############  Trigger Field and Label #################
         self.num_trig = self.keithley.get_num_triggers()
@@ -139,6 +191,20 @@ class Keithley_GUI(QtGui.QMainWindow):
         self.startSweepButton.clicked.connect(self.buttonClicked)
         grid.addWidget(self.startSweepButton, 7, 0)
 
+        #############  Stream and Stop Buttons #################
+        self.streamButton = QtGui.QPushButton('Stream')
+        self.streamButton.clicked.connect(self.buttonClicked)
+        grid.addWidget(self.streamButton, 8, 0)
+        self.stopAcqButton = QtGui.QPushButton('Stop')
+        self.stopAcqButton.clicked.connect(self.buttonClicked)
+        self.stopAcqButton.setEnabled(False)
+        grid.addWidget(self.stopAcqButton, 8, 1)
+
+        # Redraw the plots on a timer rather than on every block
+        self.plotTimer = QtCore.QTimer(self)
+        self.plotTimer.timeout.connect(self.updatePlots)
+        self.plotTimer.start(refresh_interval)
+
         ##############################################
         #############  Overall Layout ################
         ##############################################
@@ -175,12 +241,105 @@ class Keithley_GUI(QtGui.QMainWindow):
             stop = int(self.stopEdit.text())
             step = float(self.stepEdit.text())
             num_sweeps = int(self.numSweepsEdit.text())
-            sweep_data = self.keithley.sweep(start=start,  stop=stop,
-                                        step=step, num_sweeps=num_sweeps)
-            print(sweep_data[0])
-            if sweep_data != None:
-                self.a0.setData(sweep_data[0], sweep_data[1])
-                self.a1.setData(sweep_data[1], sweep_data[2])
+
+            num_readings = num_sweeps*len(kc.sweep_values(start, stop, step))
+            self.acquire(lambda: self.keithley.iter_sweep_blocks(
+                start=start, stop=stop, step=step, num_sweeps=num_sweeps,
+                block_size=sweep_block_size), num_readings)
+
+        if sender.text() == "Stream":
+            self.acquire(lambda: self.keithley.stream_chunks(
+                chunk_size=250))
+
+        if sender.text() == "Stop":
+            if self.worker is not None:
+                self.worker.stop()
+                self.statusBar().showMessage("Stopping...")
+
+    """
+    Start function (see AcquisitionWorker) on a thread of its own, with the
+    controls that talk to the Keithley disabled until it is done.
+    num_readings is how many readings the run takes, None if it goes on
+    until stopped; the plots keep at most plot_buffer_size of them.
+    """
+    def acquire(self, function, num_readings=None):
+        if self.thread is not None:
+            return
+        size = plot_buffer_size
+        if num_readings is not None:
+            size = min(max(num_readings, 1), size)
+        self.buffer = kb.RingBuffer(size)
+        self.time_offset = 0.
+        self.thread = QtCore.QThread(self)
+        self.worker = AcquisitionWorker(function)
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        self.worker.block.connect(self.addBlock)
+        self.worker.failed.connect(self.statusBar().showMessage)
+        self.worker.finished.connect(self.acquisitionDone)
+        self.setControlsEnabled(False)
+        self.statusBar().showMessage("Acquiring...")
+        self.thread.start()
+
+    def acquisitionDone(self):
+        if self.thread is None:
+            return
+        self.stopAcquisition()
+        self.setControlsEnabled(True)
+        self.statusBar().showMessage("Done, %d readings" %self.buffer.count)
+
+    """
+    Stop the acquisition, if there is one, and wait for its thread to end.
+    """
+    def stopAcquisition(self):
+        if self.thread is None:
+            return
+        self.worker.stop()
+        self.thread.quit()
+        self.thread.wait()
+        self.thread = None
+        self.worker = None
+
+    def setControlsEnabled(self, enabled):
+        for widget in [self.output, self.resetButton, self.trigButton,
+                       self.startSweepButton,
+                       self.streamButton, self.startButton, self.stopButton,
+                       self.stepButton, self.numSweepsButton]:
+            widget.setEnabled(enabled)
+        self.stopAcqButton.setEnabled(not enabled)
+
+    """
+    Keep a block of readings for plotting. The Keithley time stamps start
+    again with each block of a sweep, so they are carried on from the last
+    block.
+    """
+    def addBlock(self, data):
+        if 'time' in data.dtype.names and len(data):
+            data = data.copy()
+            data['time'] += self.time_offset
+            self.time_offset = data['time'][-1]
+        self.buffer.extend(data)
+        self.new_data = True
+
+    """
+    Redraw the plots if new readings came in, decimated to about two
+    points per pixel so long runs stay quick to draw.
+    """
+    def updatePlots(self):
+        if not self.new_data or self.buffer is None:
+            return
+        self.new_data = False
+        data = self.buffer.latest()
+        if data is None or not len(data):
+            return
+        names = data.dtype.names
+        x = data['time'] if 'time' in names else np.arange(len(data))
+        if 'volt' in names:
+            self.a0.setData(*kb.decimate_minmax(
+                x, data['volt'], self.plotWidget1.width()))
+        if 'volt' in names and 'curr' in names:
+            self.a1.setData(*kb.decimate_minmax(
+                data['volt'], data['curr'], self.plotWidget2.width()))
 
     def toggleOutput(self, state):
 
@@ -205,6 +364,7 @@ class Keithley_GUI(QtGui.QMainWindow):
             QtGui.QMessageBox.No, QtGui.QMessageBox.No)
 
         if reply == QtGui.QMessageBox.Yes:
+            self.stopAcquisition()
             self.keithley.set_output_off()
             time.sleep(.25)
             self.keithley.close_serial()
@@ -213,14 +373,23 @@ class Keithley_GUI(QtGui.QMainWindow):
         else:
             event.ignore()
 
-if __name__ == '__main__':
+"""
+Start the GUI, for the port given on the command line (keithley-gui port,
+or python keithley_gui.py port). With --fake it runs on a FakeKeithley,
+without an instrument.
+"""
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    args = [arg for arg in argv[1:] if arg != '--fake']
+    connected = '--fake' not in argv
+    if connected and not args:
+        print("Need to specify port for the SourceMeter.")
+        print("Something like: keithley-gui port_for_keithley")
+        return 1
+    app = QtGui.QApplication(argv)
+    ex = Keithley_GUI(args[0] if args else None, connected=connected)
+    return app.exec_()
 
-    # if len(sys.argv) > 1:
-    #     port = float(sys.argv[1])
-    # else:
-    #     print("Need to specify port for the SourceMeter.")
-    #     print("Something like: python keithley_gui.py port_for_keithley")
-    #     sys.exit()
-    app = QtGui.QApplication(sys.argv)
-    ex = Keithley_GUI(port, connected=True)  ##### CHANGE THIS TO TRUE!!!
-    sys.exit(app.exec_())
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import types
+import threading
+import importlib
+import importlib.util
+
+"""
+Imports that wait until the module is first used, so that importing the
+driver (or running keithley_run) does not pay for numpy, h5py, pyvisa or
+PyYAML until they are needed:
+
+    np = lazy_import('numpy')
+    h5py = lazy_import('h5py', optional=True)   # None if not installed
+
+The first use loads the module under a lock, so threads (a KeithleyRack,
+a BackgroundWriter, the GUI worker) can all be first to touch it.
+"""
+
+# Held while a lazily imported module is really loaded
+_lock = threading.RLock()
+
+"""
+Stands in for a module until one of its attributes is used, then loads
+it and takes on its attributes, so later uses cost no more than with a
+plain import.
+"""
+class _LazyModule(types.ModuleType):
+
+    def __getattr__(self, attr):
+        with _lock:
+            module = importlib.import_module(self.__name__)
+            self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+"""
+Returns: the module name, loaded on first attribute access (or at once if
+it was already imported); None if it is optional and not installed.
+Raises ImportError if it is not installed and not optional.
+"""
+def lazy_import(name, optional=False):
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name) is None:
+        if optional:
+            return None
+        raise ImportError("No module named %r" %name)
+    return _LazyModule(name)
+
+"""
+Whether module name has really been loaded, not just lazily imported.
+"""
+def is_loaded(name):
+    return name in sys.modules
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import bisect
+import threading
+import keithley_control as kc
+
+"""
+Opt-in timing of every SCPI transaction, to find out where the time of a
+sweep goes. Hand an Instrumentation to Keithley and every write/query is
+recorded, aggregated per command header:
+
+    metrics = Instrumentation()
+    keithley = Keithley(port, instrumentation=metrics)
+    keithley.sweep(start=0, stop=1, step=.1)
+    print(metrics.report())
+    metrics.write_prometheus('keithley.prom')
+
+Commands are keyed by their headers with the values stripped, so
+':SOUR:VOLT 1' and ':SOUR:VOLT 2' count as the same command and a batched
+line counts as the headers it joins.
+"""
+
+# Upper edges of the latency histogram buckets, in seconds
+latency_buckets = (1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, .1, .5, 1., 5., 10.,
+                   float('inf'))
+
+"""
+The key a command is counted under: the headers of each of its
+semicolon separated commands, without their values.
+"""
+def command_key(command):
+    return ';'.join(kc.split_command(com)[0]
+                    for com in command.split(';') if com.strip())
+
+
+class CommandStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.write_time = 0.
+        self.first_byte = 0.
+        self.first_byte_count = 0
+        self.total = 0.
+        self.max = 0.
+        self.sleep = 0.
+        self.buckets = [0]*len(latency_buckets)
+
+    def add(self, bytes_written, bytes_read, write_time, first_byte, total,
+            sleep):
+        self.count += 1
+        self.bytes_written += bytes_written
+        self.bytes_read += bytes_read
+        self.write_time += write_time
+        if first_byte is not None:
+            self.first_byte += first_byte
+            self.first_byte_count += 1
+        self.total += total
+        self.max = max(self.max, total)
+        self.sleep += sleep
+        self.buckets[bisect.bisect_left(latency_buckets, total)] += 1
+
+    def as_dict(self):
+        mean_first_byte = None
+        if self.first_byte_count:
+            mean_first_byte = self.first_byte/self.first_byte_count
+        return {'count': self.count,
+                'bytes_written': self.bytes_written,
+                'bytes_read': self.bytes_read,
+                'write_time': self.write_time,
+                'mean_first_byte': mean_first_byte,
+                'total': self.total,
+                'mean': self.total/self.count if self.count else 0.,
+                'max': self.max,
+                'sleep': self.sleep,
+                'buckets': dict(zip(latency_buckets, self.buckets))}
+
+
+class Instrumentation(object):
+
+    def __init__(self):
+        self.commands = {}
+        self.lock = threading.Lock()
+
+    """
+    Record one transaction. Times are in seconds: write_time is spent
+    writing, first_byte from the start of the write to the first byte of
+    the response (None if nothing was read), total the whole transaction
+    and sleep the part of it spent in time.sleep.
+    """
+    def record(self, command, bytes_written=0, bytes_read=0, write_time=0.,
+               first_byte=None, total=0., sleep=0.):
+        key = command_key(command)
+        with self.lock:
+            if key not in self.commands:
+                self.commands[key] = CommandStats()
+            self.commands[key].add(bytes_written, bytes_read, write_time,
+                                   first_byte, total, sleep)
+
+    def clear(self):
+        with self.lock:
+            self.commands = {}
+
+    """
+    Returns: dict of the statistics of each command, by command key.
+    """
+    def summary(self):
+        with self.lock:
+            return dict((key, stats.as_dict())
+                        for key, stats in self.commands.items())
+
+    """
+    Returns: a table of the commands, the ones taking most time first.
+    """
+    def report(self):
+        summary = self.summary()
+        grand_total = sum(stats['total'] for stats in summary.values())
+        lines = ['%-40s %6s %10s %10s %10s %10s %6s'
+                 %('command', 'count', 'total s', 'mean ms', 'max ms',
+                   'sleep s', '%')]
+        for key in sorted(summary, key=lambda key: -summary[key]['total']):
+            stats = summary[key]
+            if len(key) > 40:
+                key = key[:37] + '...'
+            lines.append('%-40s %6d %10.4f %10.3f %10.3f %10.4f %6.1f'
+                         %(key, stats['count'], stats['total'],
+                           stats['mean']*1e3, stats['max']*1e3,
+                           stats['sleep'],
+                           100*stats['total']/grand_total
+                           if grand_total else 0.))
+        return '\n'.join(lines)
+
+    """
+    Returns: the statistics in the Prometheus text exposition format.
+    """
+    def prometheus_text(self, prefix='keithley_scpi'):
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, description):
+            lines.append('# HELP %s_%s %s' %(prefix, name, description))
+            lines.append('# TYPE %s_%s %s' %(prefix, name, kind))
+
+        counters = [('bytes_written', 'bytes_written_total',
+                     'Bytes written to the instrument.'),
+                    ('bytes_read', 'bytes_read_total',
+                     'Bytes read from the instrument.'),
+                    ('write_time', 'write_seconds_total',
+                     'Time spent writing commands.'),
+                    ('sleep', 'sleep_seconds_total',
+                     'Time spent sleeping while waiting for the instrument.')]
+        for field, name, description in counters:
+            metric(name, 'counter', description)
+            for key in sorted(summary):
+                lines.append('%s_%s{command="%s"} %r'
+                             %(prefix, name, escape_label(key),
+                               summary[key][field]))
+
+        metric('latency_seconds', 'histogram', 'Latency of each transaction.')
+        for key in sorted(summary):
+            stats = summary[key]
+            label = escape_label(key)
+            cumulative = 0
+            for edge in latency_buckets:
+                cumulative += stats['buckets'][edge]
+                le = '+Inf' if edge == float('inf') else repr(edge)
+                lines.append('%s_latency_seconds_bucket{command="%s",le="%s"} '
+                             '%d' %(prefix, label, le, cumulative))
+            lines.append('%s_latency_seconds_sum{command="%s"} %r'
+                         %(prefix, label, stats['total']))
+            lines.append('%s_latency_seconds_count{command="%s"} %d'
+                         %(prefix, label, stats['count']))
+        return '\n'.join(lines) + '\n'
+
+    """
+    Write prometheus_text to path, e.g. for the node exporter textfile
+    collector. The file is replaced in one step so it is never read half
+    written.
+    """
+    def write_prometheus(self, path, prefix='keithley_scpi'):
+        text = self.prometheus_text(prefix)
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(path + '.tmp', path)
+
+
+def escape_label(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import keithley_control as kc
+
+"""
+Drive several Keithleys on separate ports at once, one thread per port.
+Configuration is broadcast to every instrument, sweeps start together, and
+the readings are merged into one time-aligned array, so a rack takes as
+long as its slowest instrument rather than the sum of all of them.
+
+    rack = KeithleyRack(['/dev/ttyUSB0', '/dev/ttyUSB1'])
+    rack.broadcast('set_current_compliance', .1)
+    data = rack.sweep(start=-1, stop=1, step=.1)
+    rack.close()
+"""
+
+class KeithleyRack(object):
+
+    """
+    ports is a list of ports, or of already open Keithley objects.
+    The other keyword arguments are passed on to Keithley.
+    Results are lists in the order of ports (the same port name can come
+    more than once, e.g. several 'sim://resistor').
+    """
+    def __init__(self, ports, **kwargs):
+        self.ports = [port if isinstance(port, str) else port.port
+                      for port in ports]
+        self.pool = ThreadPoolExecutor(max_workers=max(len(self.ports), 1))
+
+        def connect(port):
+            if isinstance(port, str):
+                return kc.Keithley(port, **kwargs)
+            return port
+
+        self.keithleys = self._map(connect, ports)
+        # Timing and readings of each instrument in the last sweep/read,
+        # and how long it took all together
+        self.last_stats = []
+        self.last_data = []
+        self.last_wall = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    """
+    Call function(item) for every item (every Keithley if None) in
+    parallel.
+    Returns: list of the results, in the order of items.
+    """
+    def _map(self, function, items=None):
+        if items is None:
+            items = self.keithleys
+        futures = [self.pool.submit(function, item) for item in items]
+        return [future.result() for future in futures]
+
+    """
+    Call the same Keithley method on every instrument at once,
+    e.g. rack.broadcast('set_source_voltage', 1.).
+    Returns: list of the results, in the order of ports.
+    """
+    def broadcast(self, method, *args, **kwargs):
+        return self._map(lambda keithley:
+                         getattr(keithley, method)(*args, **kwargs))
+
+    """
+    Set up every instrument, then start them together and collect the data.
+    setup(keithley) sends the configuration and returns the number of
+    readings to expect, each taking up to delay seconds.
+    Timing for each instrument is kept in last_stats.
+    Returns: the merged readings, see merge_results.
+    """
+    def _acquire(self, setup, timeout=None, delay=0.):
+        barrier = threading.Barrier(len(self.ports))
+
+        def run(keithley):
+            t_setup = time.time()
+            try:
+                num_trigs = setup(keithley)
+            except:
+                # Don't leave the other instruments waiting
+                barrier.abort()
+                raise
+            t_ready = time.time()
+            barrier.wait()
+            keithley.send_command(':OUTP ON')
+            keithley.send_command(':INIT')
+            t_start = time.time()
+            wait = keithley.timeout if timeout is None else timeout
+            if num_trigs is not None:
+                wait += num_trigs*delay
+                num_trigs = int(num_trigs)
+            data = None
+            if keithley.wait_for_completion(timeout=wait):
+                data = keithley.fetch(num_readings=num_trigs)
+            t_data = time.time()
+            keithley.send_command(':OUTP OFF')
+            stats = {'setup': t_ready - t_setup,
+                     'acquire': t_data - t_start,
+                     'start': t_start,
+                     'bytes': keithley.last_read_stats.get('bytes', 0)}
+            return data, stats
+
+        t0 = time.time()
+        results = self._map(run)
+        self.last_wall = time.time() - t0
+        first = min(stats['start'] for data, stats in results)
+        for data, stats in results:
+            stats['skew'] = stats['start'] - first
+        self.last_data = [data for data, stats in results]
+        self.last_stats = [stats for data, stats in results]
+        return merge_results(self.last_data,
+                             [stats['start'] for stats in self.last_stats])
+
+    """
+    Run the same sweep (see Keithley.sweep) on every instrument at once.
+    """
+    def sweep(self, data_type=None, start=-10, stop=10, step=1, num_sweeps=1,
+              delay=0.1):
+        return self._acquire(lambda keithley: keithley.configure_sweep(
+            data_type, start, stop, step, num_sweeps, delay), delay=delay)
+
+    """
+    Run the same list sweep (see Keithley.list_sweep) on every instrument
+    at once.
+    """
+    def list_sweep(self, values, source='VOLT', data_type=None, num_sweeps=1,
+                   delay=0.1):
+        return self._acquire(lambda keithley: keithley.configure_list_sweep(
+            values, source, data_type, num_sweeps, delay), delay=delay)
+
+    """
+    Take readings (see Keithley.read) on every instrument at once.
+    """
+    def read(self, data_type=None, timeout=None):
+        def setup(keithley):
+            keithley.set_elements(data_type)
+            if keithley.data_format != 'ascii':
+                return keithley.get_num_triggers()
+            return None
+        return self._acquire(setup, timeout=timeout)
+
+    def close(self):
+        self._map(lambda keithley: keithley.close_serial())
+        self.pool.shutdown()
+
+
+"""
+Merge the readings of several instruments into one array in time order.
+data is a list of structured arrays (or None), one per instrument, starts
+the host time (from time.time()) at which each was triggered. The
+Keithley time stamps restart at each trigger, so host_time = start + time.
+Returns: a structured array with fields 'instrument' (index into data),
+'host_time' and every element the instruments returned (NaN where an
+instrument did not return it).
+"""
+def merge_results(data, starts):
+    names = []
+    for readings in data:
+        if readings is not None:
+            names += [name for name in readings.dtype.names
+                      if name not in names]
+    names = [name for name in kc.element_order if name in names]
+    dtype = [('instrument', int), ('host_time', float)]
+    dtype += [(name, float) for name in names]
+    parts = []
+    for index, readings in enumerate(data):
+        if readings is None:
+            continue
+        part = np.zeros(len(readings), dtype=dtype)
+        part['instrument'] = index
+        for name in names:
+            part[name] = np.nan
+        for name in readings.dtype.names:
+            part[name] = readings[name]
+        if 'time' in readings.dtype.names:
+            part['host_time'] = starts[index] + readings['time']
+        else:
+            part['host_time'] = starts[index]
+        parts.append(part)
+    if not parts:
+        return np.zeros(0, dtype=dtype)
+    merged = np.concatenate(parts)
+    return merged[np.argsort(merged['host_time'], kind='stable')]
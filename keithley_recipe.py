@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import hashlib
+import keithley_control as kc
+from keithley_lazy import lazy_import
+
+# PyYAML is optional, recipes can always be written in JSON
+yaml = lazy_import('yaml', optional=True)
+
+"""
+Measurements described as data rather than as a sequence of commands.
+A Recipe says what to source, what to sense with which compliance, NPLC
+and range, and how to trigger; compile_recipe turns it once into a Plan,
+the deduplicated SCPI setup already joined into lines, which can then be
+run on any Keithley as often as needed:
+
+    recipe = load_recipe('diode_iv.json')
+    plan = compile_recipe(recipe)
+    print(plan)                    # the lines it sends the first time
+    data = plan.run(keithley)
+
+For example diode_iv.json:
+
+    {"name": "diode_iv", "source": "VOLT", "mode": "sweep",
+     "start": 0, "stop": 1, "points": 101, "compliance": 0.1,
+     "nplc": 0.1, "source_delay": 0.001}
+
+Plans are cached by the hash of their recipe, and the Keithley's own
+StateCache leaves out whatever is already set, so a repeated run sends
+little more than :INIT.
+"""
+
+sources = ['VOLT', 'CURR']
+modes = ['fixed', 'sweep', 'list']
+
+"""
+One measurement. source is 'VOLT' or 'CURR', sensing the other; mode is
+'fixed' (count readings at level), 'sweep' (points from start to stop,
+spacing 'LIN' or 'LOG', num_sweeps times) or 'list' (through values).
+compliance is the limit on the sensed quantity, sense_range its range
+(None for auto), nplc the integration time in power line cycles.
+elements are the reading elements, as for Keithley.set_elements.
+"""
+class Recipe(object):
+
+    fields = ['name', 'source', 'mode', 'level', 'start', 'stop', 'points',
+              'spacing', 'values', 'num_sweeps', 'count', 'compliance',
+              'sense_range', 'nplc', 'auto_zero', 'source_delay',
+              'trigger_delay', 'elements', 'data_format', 'byte_order']
+
+    def __init__(self, name='recipe', source='VOLT', mode='sweep', level=0.,
+                 start=0., stop=1., points=11, spacing='LIN', values=None,
+                 num_sweeps=1, count=1, compliance=None, sense_range=None,
+                 nplc=1., auto_zero=False, source_delay=0.,
+                 trigger_delay=0., elements=None, data_format='ascii',
+                 byte_order='swap'):
+        self.name = name
+        self.source = source.upper()[:4]
+        self.mode = mode.lower()
+        self.level = level
+        self.start = start
+        self.stop = stop
+        self.points = points
+        self.spacing = spacing.upper()[:3]
+        self.values = None if values is None else [float(v) for v in values]
+        self.num_sweeps = num_sweeps
+        self.count = count
+        self.compliance = compliance
+        self.sense_range = sense_range
+        self.nplc = nplc
+        self.auto_zero = auto_zero
+        self.source_delay = source_delay
+        self.trigger_delay = trigger_delay
+        self.elements = kc.elements_for(elements)
+        self.data_format = data_format.lower()
+        self.byte_order = byte_order.lower()
+        self.check()
+
+    def __repr__(self):
+        return 'Recipe(%s)' %', '.join('%s=%r' %(name, getattr(self, name))
+                                       for name in self.fields)
+
+    """
+    Raises ValueError if the recipe can not be run.
+    """
+    def check(self):
+        if self.source not in sources:
+            raise ValueError("source must be one of %s" %sources)
+        if self.mode not in modes:
+            raise ValueError("mode must be one of %s" %modes)
+        if self.spacing not in ['LIN', 'LOG']:
+            raise ValueError("spacing must be LIN or LOG")
+        if self.mode == 'list' and not self.values:
+            raise ValueError("a list recipe needs values")
+        if not 0.01 <= self.nplc <= 10:
+            raise ValueError("nplc must be between 0.01 and 10")
+        if self.data_format not in ['ascii', 'sreal', 'dreal']:
+            raise ValueError("Unknown data format %r" %self.data_format)
+        if self.byte_order not in ['swap', 'norm']:
+            raise ValueError("Unknown byte order %r" %self.byte_order)
+        if not 1 <= self.num_readings() <= 2500:
+            raise ValueError("%d readings, the 2400 takes 1-2500"
+                             %self.num_readings())
+
+    @property
+    def sense(self):
+        return 'CURR' if self.source == 'VOLT' else 'VOLT'
+
+    def num_readings(self):
+        if self.mode == 'fixed':
+            return int(self.count)
+        if self.mode == 'list':
+            return len(self.values)*int(self.num_sweeps)
+        return int(self.points)*int(self.num_sweeps)
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.fields)
+
+    @classmethod
+    def from_dict(cls, settings):
+        unknown = set(settings) - set(cls.fields)
+        if unknown:
+            raise ValueError("Unknown recipe settings: %s"
+                             %', '.join(sorted(unknown)))
+        return cls(**settings)
+
+    """
+    Returns: a hash of everything in the recipe (its name too).
+    """
+    def digest(self):
+        text = json.dumps(self.as_dict(), sort_keys=True)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+"""
+A compiled recipe: setup is the list of SCPI commands, each header
+once, and lines the same joined into as few lines as the Keithley's
+input buffer takes. lines are sent as they are to a Keithley that has
+none of the settings yet; one that has some only gets the rest.
+"""
+class Plan(object):
+
+    def __init__(self, recipe, setup, max_line_length=250):
+        self.recipe = recipe
+        self.digest = recipe.digest()
+        self.setup = setup
+        self.max_line_length = max_line_length
+        self.lines = kc.join_commands(setup, max_line_length)
+        self.num_readings = recipe.num_readings()
+        self.elements = recipe.elements
+        # Longest wait for the readings on top of the Keithley timeout
+        self.delay = recipe.source_delay + recipe.trigger_delay
+
+    def __repr__(self):
+        return '<Plan %s %s: %d commands in %d lines, %d readings>' %(
+            self.recipe.name, self.digest[:8], len(self.setup),
+            len(self.lines), self.num_readings)
+
+    def __str__(self):
+        return '\n'.join([repr(self)] + self.lines)
+
+    """
+    Send the setup, leaving out what the Keithley already has (see
+    StateCache), and make the Keithley expect the recipe's readings.
+    Returns: list of (code, message) errors, empty if there were none.
+    """
+    def configure(self, keithley):
+        commands = keithley.pending_commands(self.setup)
+        if len(commands) == len(self.setup):
+            lines = self.lines
+        else:
+            lines = kc.join_commands(commands, self.max_line_length)
+        errors = keithley.send_lines(lines)
+        keithley.elements = list(self.elements)
+        keithley.data_format = self.recipe.data_format
+        keithley.byte_order = self.recipe.byte_order
+        return errors
+
+    """
+    Set up (see configure), take the readings and turn the output off.
+    Returns: the readings, as from Keithley.fetch; None if the setup
+    gave errors (printed by get_errors) or no readings came.
+    """
+    def run(self, keithley, timeout=None):
+        if self.configure(keithley):
+            return None
+        keithley.send_command(':OUTP ON')
+        keithley.send_command(':INIT')
+        wait = keithley.timeout if timeout is None else timeout
+        data = None
+        if keithley.wait_for_completion(
+                timeout=wait + self.num_readings*self.delay):
+            data = keithley.fetch(num_readings=self.num_readings)
+        keithley.send_command(':OUTP OFF')
+        return data
+
+
+# Compiled plans by recipe hash and line length
+_plans = {}
+
+"""
+Compile a recipe (a Recipe, or a dict of its settings) into a Plan, or
+take it from the cache if it was compiled before.
+"""
+def compile_recipe(recipe, max_line_length=250):
+    if isinstance(recipe, dict):
+        recipe = Recipe.from_dict(recipe)
+    key = (recipe.digest(), max_line_length)
+    if key not in _plans:
+        _plans[key] = Plan(recipe, setup_commands(recipe), max_line_length)
+    return _plans[key]
+
+"""
+The SCPI commands that set the Keithley up for recipe, without *RST so
+that settings already in place can be left out. A header set twice only
+keeps its last value.
+"""
+def setup_commands(recipe):
+    source = recipe.source
+    sense = recipe.sense
+    commands = [':SOUR:FUNC %s' %source,
+                ":SENS:FUNC '%s:DC'" %sense,
+                ':SENS:%s:NPLC %s' %(sense, recipe.nplc),
+                ':SYST:AZER:STAT %s' %('ON' if recipe.auto_zero else 'OFF')]
+    if recipe.compliance is not None:
+        commands.append(':SENS:%s:PROT %s' %(sense, recipe.compliance))
+    if recipe.sense_range is None:
+        commands.append(':SENS:%s:RANG:AUTO ON' %sense)
+    else:
+        commands.append(':SENS:%s:RANG %s' %(sense, recipe.sense_range))
+    commands += [':SOUR:DEL %s' %recipe.source_delay,
+                 ':TRIG:DEL %s' %recipe.trigger_delay,
+                 ':FORM:ELEM %s' %', '.join(name.upper()
+                                            for name in recipe.elements),
+                 ':FORM:DATA %s' %recipe.data_format.upper()]
+    if recipe.data_format != 'ascii':
+        commands.append(':FORM:BORD %s' %recipe.byte_order.upper())
+
+    if recipe.mode == 'fixed':
+        commands += [':SOUR:%s:MODE FIXED' %source,
+                     ':SOUR:%s %s' %(source, recipe.level)]
+    elif recipe.mode == 'sweep':
+        commands += [':SOUR:%s:STAR %s' %(source, recipe.start),
+                     ':SOUR:%s:STOP %s' %(source, recipe.stop),
+                     ':SOUR:SWE:SPAC %s' %recipe.spacing,
+                     ':SOUR:SWE:RANG AUTO',
+                     ':SOUR:SWE:POIN %d' %recipe.points,
+                     ':SOUR:%s:MODE SWE' %source]
+    else:
+        commands += kc.list_commands(recipe.values, source)
+        commands.append(':SOUR:%s:MODE LIST' %source)
+    commands.append(':TRIG:COUN %d' %recipe.num_readings())
+    return deduplicate(commands)
+
+"""
+Keep only the last command for each header, in the order of those.
+Source list commands are kept as they are, they build up the list, and
+so are commands without a value (:INIT, :TRAC:CLE), which act rather
+than set something.
+"""
+def deduplicate(commands):
+    headers = []
+    last = {}
+    for index, com in enumerate(commands):
+        header, value = kc.split_command(com)
+        header = kc.short_header(header)
+        headers.append(header)
+        if (value is not None and
+                header not in kc.StateCache.uncached_headers):
+            last[header] = index
+    return [com for index, (com, header) in enumerate(zip(commands, headers))
+            if last.get(header, index) == index]
+
+"""
+Read a recipe from a JSON or (with PyYAML) YAML file.
+"""
+def load_recipe(path):
+    with open(path) as f:
+        if path.lower().endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ImportError("PyYAML is needed for YAML recipes")
+            settings = yaml.safe_load(f)
+        else:
+            settings = json.load(f)
+    return Recipe.from_dict(settings)
+
+def save_recipe(recipe, path):
+    with open(path, 'w') as f:
+        if path.lower().endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ImportError("PyYAML is needed for YAML recipes")
+            yaml.safe_dump(recipe.as_dict(), f, default_flow_style=False)
+        else:
+            json.dump(recipe.as_dict(), f, indent=2)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import argparse
+import keithley_recipe as kr
+
+"""
+Keithley run
+
+Runs a measurement recipe (see keithley_recipe) on a Keithley without the
+GUI, for cron and batch jobs, and saves the readings:
+
+    keithley-run diode_iv.json --port /dev/ttyUSB0 --out diode_iv.npy
+
+--out takes .npy, or .h5 with h5py (see keithley_storage), and appends if
+the file is there already; the recipe and the instrument settings are
+kept with the data. Without --out the readings are printed as CSV. The
+port can also be given in the KEITHLEY_PORT environment variable.
+--dry-run only prints the commands the recipe compiles to.
+Exits with 0 if the readings were taken, 1 if not.
+"""
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='keithley-run',
+        description='Run a measurement recipe on a Keithley 2400.')
+    parser.add_argument('recipe', help='recipe file, .json or .yaml')
+    parser.add_argument('--port', default=os.environ.get('KEITHLEY_PORT'),
+                        help='serial port or URL, e.g. /dev/ttyUSB0 or '
+                             'sim://diode (default $KEITHLEY_PORT)')
+    parser.add_argument('--out', help='save the readings here (.npy, .h5)')
+    parser.add_argument('--baudrate', type=int, default=57600)
+    parser.add_argument('--timeout', type=float, default=10.,
+                        help='longest wait for the readings (seconds)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='print the compiled commands and stop')
+    args = parser.parse_args(argv)
+
+    try:
+        recipe = kr.load_recipe(args.recipe)
+    except (OSError, ValueError, ImportError) as error:
+        print("Could not load recipe %s: %s" %(args.recipe, error))
+        return 1
+    plan = kr.compile_recipe(recipe)
+    if args.dry_run:
+        print(plan)
+        return 0
+    if args.port is None:
+        print("Need to specify port for the SourceMeter, with --port or "
+              "KEITHLEY_PORT.")
+        return 1
+
+    import keithley_control as kc
+    keithley = kc.Keithley(args.port, timeout=args.timeout,
+                           baudrate=args.baudrate)
+    if not keithley.is_open():
+        return 1
+    try:
+        data = plan.run(keithley, timeout=args.timeout)
+    finally:
+        keithley.close_serial()
+    if data is None:
+        print("No readings from the Keithley.")
+        return 1
+
+    if args.out:
+        import keithley_storage
+        metadata = keithley_storage.instrument_metadata(
+            keithley, recipe=recipe.as_dict(), plan=plan.digest)
+        try:
+            keithley_storage.save(args.out, data, metadata=metadata)
+        except (OSError, ValueError, ImportError) as error:
+            print("Could not save the readings to %s: %s" %(args.out, error))
+            return 1
+    else:
+        print(','.join(data.dtype.names))
+        for row in data:
+            print(','.join('%g' %value for value in row))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
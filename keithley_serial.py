@@ -2,38 +2,35 @@
 # -*- coding: utf-8 -*-
 
 import time
+import weakref
 import serial
+import keithley_transport as kt
+
+# What a port can raise when it goes away (unplugged adapter, ...)
+transport_errors = (OSError, serial.SerialException)
+# Longest wait (seconds) for a response when no timeout is given
+default_timeout = 10.
 
 """
-Open a port for serial communication with the Keithley.
-Returns: serial object
+Open a port for communication with the Keithley: a serial port, or any
+of the links in keithley_transport (a TCP serial server, GPIB, the
+simulator with 'sim://diode', ...).
+write_timeout (seconds) bounds how long a write may block, None for ever.
+Returns: the port, None if it could not be opened.
 
 author: T. Max Roberts
 """
-def start_serial(port='/dev/tty.KeySerial1'):
-
-    # Configure the serial connections.
-    # These are specific to the Keithley 2400 SourceMeter.
-    # This device is configurable, but these are default (except for BAUD).
-    # Using a carriage return only for termination.
+def start_serial(port='/dev/tty.KeySerial1', poll=.05, baudrate=57600,
+                 write_timeout=2.):
     try:
-        ser = serial.Serial(
-            port=port,
-            baudrate=57600,
-            parity=serial.PARITY_NONE,
-            bytesize=serial.EIGHTBITS,
-            stopbits=serial.STOPBITS_ONE
-        )
-
-        # Need to set the "request to send" pin low
-        ser.setRTS(False)
-
-        return ser
-    except:
-        print("Some went wrong...")
+        return kt.open_transport(port, baudrate=baudrate, timeout=poll,
+                                 write_timeout=write_timeout)
+    except transport_errors as error:
+        print("Could not open %s: %s" %(port, error))
+        return None
 
 def write(ser, command):
-    ser.write(command + '\r')
+    ser.write((command + '\r').encode('ascii'))
 
 def open_serial(ser):
     ser.open()
@@ -41,23 +38,179 @@ def open_serial(ser):
 def close_serial(ser):
     ser.close()
 
-def read(ser):
-        out = []
-        terminated = False
-        while ser.inWaiting() > 0 or not terminated:
-            data = str(ser.read(1))
-            if data == '\r':
-                out.append('\n')
-                terminated = True
-            else:
-                out.append(data)
-
-        if out != '':
-            return ' '.join(out)
-        else:
-            return ''
-
-def write_and_read(ser, command, pause=.25):
+"""
+Throw away everything received but not read yet, e.g. the rest of a
+response that timed out, so it is not taken for the next one.
+"""
+def discard_input(ser):
+    _pending.pop(ser, None)
+    ser.reset_input_buffer()
+
+"""
+Bytes that arrived after a terminator are kept here until the next read,
+so pulling everything in_waiting never loses the start of a reply.
+"""
+_pending = weakref.WeakKeyDictionary()
+
+"""
+Read one response, up to the carriage return terminator.
+Whatever is waiting on the port is pulled in bulk, and the terminator is
+searched for only in the newly received bytes.
+If stats is a dict it is filled with the number of bytes and ser.read calls
+the response took, how long the read took ('seconds'), how long it was
+until the first byte arrived ('first_byte') and whether it 'timed_out'.
+If timeout (seconds, default_timeout if None) runs out before the
+terminator arrives, the partial response is kept for the next read and
+'' is returned.
+Returns: str (or bytes if raw=True) without the terminator.
+"""
+def read(ser, terminator=b'\r', raw=False, stats=None, timeout=None):
+    started = time.time()
+    if timeout is None:
+        timeout = default_timeout
+    deadline = started + timeout
+    buf = bytearray(_pending.pop(ser, b''))
+    first_byte = 0. if buf else None
+    reads = 0
+    start = 0
+    end = buf.find(terminator)
+    while end < 0:
+        if time.time() > deadline:
+            _pending[ser] = bytes(buf)
+            print("Timed out waiting for a response...")
+            _timed_out(stats, len(buf), reads, started, first_byte)
+            return b'' if raw else ''
+        start = max(len(buf) - len(terminator) + 1, 0)
+        buf += ser.read(max(ser.in_waiting, 1))
+        reads += 1
+        if first_byte is None and buf:
+            first_byte = time.time() - started
+        end = buf.find(terminator, start)
+
+    view = memoryview(buf)
+    if end + len(terminator) < len(buf):
+        _pending[ser] = bytes(view[end + len(terminator):])
+    response = bytes(view[:end])
+    view.release()
+
+    if stats is not None:
+        stats['bytes'] = end + len(terminator)
+        stats['reads'] = reads
+        stats['seconds'] = time.time() - started
+        stats['first_byte'] = first_byte
+        stats['timed_out'] = False
+
+    if raw:
+        return response
+    return response.decode('ascii')
+
+"""
+Read one IEEE-488.2 binary block, '#<n><length><data>' then the terminator.
+Binary data can contain the terminator byte, so the block is read by
+length rather than by searching for it. An indefinite block ('#0', which
+the 2400 sends) has no length in its header, so nbytes must be given.
+stats and timeout work as in read().
+Returns: bytes of the data, b'' on timeout or a bad header.
+"""
+def read_block(ser, nbytes=None, terminator=b'\r', stats=None, timeout=None):
+    started = time.time()
+    if timeout is None:
+        timeout = default_timeout
+    deadline = started + timeout
+    buf = bytearray(_pending.pop(ser, b''))
+    first_byte = 0. if buf else None
+    reads = 0
+    start = None
+    length = nbytes
+    while start is None or len(buf) < start + length + len(terminator):
+        if start is None and len(buf) >= 2:
+            if buf[:1] != b'#' or not buf[1:2].isdigit():
+                print("Bad binary block header...")
+                return b''
+            digits = int(buf[1:2])
+            if digits == 0 and nbytes is None:
+                print("Need the number of bytes for an indefinite block...")
+                return b''
+            if len(buf) >= 2 + digits:
+                start = 2 + digits
+                if digits > 0:
+                    length = int(buf[2:start])
+                continue
+        if time.time() > deadline:
+            _pending[ser] = bytes(buf)
+            print("Timed out waiting for a response...")
+            _timed_out(stats, len(buf), reads, started, first_byte)
+            return b''
+        buf += ser.read(max(ser.in_waiting, 1))
+        reads += 1
+        if first_byte is None and buf:
+            first_byte = time.time() - started
+
+    end = start + length + len(terminator)
+    view = memoryview(buf)
+    if end < len(buf):
+        _pending[ser] = bytes(view[end:])
+    block = bytes(view[start:start + length])
+    view.release()
+
+    if stats is not None:
+        stats['bytes'] = end
+        stats['reads'] = reads
+        stats['seconds'] = time.time() - started
+        stats['first_byte'] = first_byte
+        stats['timed_out'] = False
+
+    return block
+
+def _timed_out(stats, nbytes, reads, started, first_byte):
+    if stats is not None:
+        stats['bytes'] = nbytes
+        stats['reads'] = reads
+        stats['seconds'] = time.time() - started
+        stats['first_byte'] = first_byte
+        stats['timed_out'] = True
+
+def write_and_read(ser, command, pause=None, stats=None, timeout=None):
     write(ser, command)
-    time.sleep(pause)
-    return read(ser)
+    if pause:
+        time.sleep(pause)
+    return read(ser, stats=stats, timeout=timeout)
+
+"""
+Block until every pending operation has finished, using *OPC?.
+The Keithley only answers once the operations are complete.
+Returns: True when complete, False on timeout.
+"""
+def wait_for_opc(ser, timeout=10.):
+    return write_and_read(ser, '*OPC?', timeout=timeout).strip() == '1'
+
+"""
+Block until every pending operation has finished by polling the status byte.
+*OPC sets the OPC bit of the standard event register once the operations are
+done, and with *ESE 1 that is summarised in the ESB bit (32) of the status
+byte. Both have to be sent first (and checked for errors, see
+Keithley.wait_for_completion). Reading *ESR? afterwards clears it for the
+next wait.
+If stats is a dict it is filled with the number of polls and the time
+spent sleeping between them.
+Returns: True when complete, False on timeout.
+"""
+def poll_status_byte(ser, mask=32, timeout=10., interval=.005, stats=None):
+    if stats is not None:
+        stats['polls'] = 0
+        stats['sleep'] = 0.
+    deadline = time.time() + timeout
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            print("Timed out waiting for the status byte...")
+            return False
+        response = write_and_read(ser, '*STB?', timeout=remaining)
+        if stats is not None:
+            stats['polls'] += 1
+        if response != '' and int(response) & mask:
+            write_and_read(ser, '*ESR?', timeout=remaining)
+            return True
+        time.sleep(interval)
+        if stats is not None:
+            stats['sleep'] += interval
@@ -0,0 +1,685 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import time
+import struct
+import threading
+try:
+    from urllib.parse import urlparse, parse_qsl
+except ImportError:
+    from urlparse import urlparse, parse_qsl
+import numpy as np
+from keithley_control import short_header
+
+"""
+A simulated Keithley 2400, for running (and timing) the driver without
+hardware. It answers the SCPI subset the Keithley object uses: *RST, *OPC,
+the status registers, :SYST:ERR, :SOUR (fixed, sweep and list), :SENS,
+:TRIG:COUN, :FORM, :OUTP, :INIT, :FETCH?, :READ? and :TRAC. The device on
+the terminals is a model (Resistor, Diode) with optional noise, and
+readings take as long as the NPLC and delays say, with responses coming
+back at the baud rate.
+
+Attach it with a port name like 'sim://diode?noise=1e-6', which
+keithley_serial.start_serial understands, so
+
+    keithley = Keithley('sim://resistor?resistance=1e3')
+
+or serve it on a pseudo terminal for tools that want a real port:
+
+    port = serve_pty(SimulatedKeithley(Diode()))
+
+time_scale=0 turns the timing off, for fast tests.
+"""
+
+"""  Device models  """
+
+class Resistor(object):
+
+    def __init__(self, resistance=1e3):
+        self.resistance = float(resistance)
+
+    def current(self, voltage):
+        return voltage/self.resistance
+
+    def voltage(self, current):
+        return current*self.resistance
+
+
+"""
+Shockley diode with a series resistance,
+I = Is*(exp((V - I*Rs)/(n*Vt)) - 1).
+"""
+class Diode(object):
+
+    def __init__(self, saturation_current=1e-12, ideality=1.8,
+                 temperature=300., series_resistance=1.):
+        self.saturation_current = float(saturation_current)
+        self.ideality = float(ideality)
+        self.thermal_voltage = 8.617333e-5*float(temperature)
+        self.series_resistance = float(series_resistance)
+
+    def voltage(self, current):
+        nvt = self.ideality*self.thermal_voltage
+        current = np.maximum(current, -self.saturation_current*(1 - 1e-12))
+        return (nvt*np.log1p(current/self.saturation_current) +
+                current*self.series_resistance)
+
+    def current(self, voltage):
+        # Solve V(I) = voltage by bisection, vectorized over voltage
+        voltage = np.asarray(voltage, dtype=float)
+        low = np.full(voltage.shape, -self.saturation_current)
+        high = np.maximum(voltage/max(self.series_resistance, 1e-9), 1e-12)
+        high = np.maximum(high, self.saturation_current)
+        for i in range(200):
+            middle = (low + high)/2
+            above = self.voltage(middle) > voltage
+            high = np.where(above, middle, high)
+            low = np.where(above, low, middle)
+        return (low + high)/2
+
+models = {'resistor': Resistor, 'diode': Diode}
+
+
+"""  SCPI helpers  """
+
+def to_float(value):
+    value = value.strip().upper()
+    if value in ['ON']:
+        return 1.
+    if value in ['OFF']:
+        return 0.
+    return float(value)
+
+"""  Settings after *RST  """
+default_settings = {':SOUR:FUNC': 'VOLT',
+                    ':SOUR:VOLT': '0',
+                    ':SOUR:CURR': '0',
+                    ':SOUR:VOLT:MODE': 'FIX',
+                    ':SOUR:CURR:MODE': 'FIX',
+                    ':SOUR:VOLT:STAR': '0',
+                    ':SOUR:VOLT:STOP': '0',
+                    ':SOUR:VOLT:STEP': '0',
+                    ':SOUR:CURR:STAR': '0',
+                    ':SOUR:CURR:STOP': '0',
+                    ':SOUR:CURR:STEP': '0',
+                    ':SOUR:SWE:POIN': '2500',
+                    ':SOUR:SWE:SPAC': 'LIN',
+                    ':SOUR:SWE:RANG': 'BEST',
+                    ':SOUR:DEL': '0.001',
+                    ':SENS:FUNC': '"CURR"',
+                    ':SENS:CURR:PROT': '1.05E-4',
+                    ':SENS:VOLT:PROT': '21',
+                    ':SENS:CURR:NPLC': '1',
+                    ':SENS:VOLT:NPLC': '1',
+                    ':SENS:RES:NPLC': '1',
+                    ':SYST:AZER:STAT': 'ON',
+                    ':TRIG:COUN': '1',
+                    ':TRIG:DEL': '0',
+                    ':FORM:DATA': 'ASC',
+                    ':FORM:BORD': 'NORM',
+                    ':FORM:ELEM': 'VOLT,CURR,RES,TIME,STAT',
+                    ':OUTP': '0',
+                    ':TRAC:POIN': '100',
+                    ':TRAC:FEED': 'SENS',
+                    ':TRAC:FEED:CONT': 'NEV'}
+
+element_order = ['VOLT', 'CURR', 'RES', 'TIME', 'STAT']
+
+# Settings under these are stored and read back even if not simulated
+known_subsystems = ['SOUR', 'SENS', 'SYST', 'DISP', 'TRIG', 'ARM', 'FORM',
+                    'OUTP', 'TRAC', 'CALC', 'ROUT', 'STAT']
+
+# Baud rates the RS-232 port can be set to
+baudrates = [300, 600, 1200, 2400, 4800, 9600, 19200, 38400, 57600]
+
+# Status word bit set when the source is held at the compliance limit
+compliance_bit = 1 << 3
+
+
+class SimulatedKeithley(object):
+
+    """
+    model is the device on the terminals (Resistor, Diode, or anything
+    with current(voltage) and voltage(current)).
+    noise is the standard deviation of the measurement noise, relative to
+    the reading, plus noise_floor in absolute terms.
+    baudrate sets how fast responses come back, line_frequency how long
+    one NPLC is, and time_scale scales all of the timing (0 for none).
+    drop_rate is the chance that a response loses its terminator on the
+    way, for trying out recovery from a bad line.
+    """
+    def __init__(self, model=None, noise=0., noise_floor=0., baudrate=57600,
+                 line_frequency=60., time_scale=1., seed=None, drop_rate=0.):
+        self.model = model if model is not None else Resistor()
+        self.noise = noise
+        self.noise_floor = noise_floor
+        self.baudrate = baudrate
+        self.line_frequency = line_frequency
+        self.time_scale = time_scale
+        self.drop_rate = drop_rate
+        self.random = np.random.RandomState(seed)
+        self.lock = threading.Lock()
+        # Responses waiting to be read, as [release time, bytes] chunks
+        self.output = []
+        self._input = b''
+        # Commands received, handy for checking what the driver sent
+        self.log = []
+        self.reset()
+
+    def reset(self):
+        self.settings = dict(default_settings)
+        self.source_list = {'VOLT': [], 'CURR': []}
+        self.errors = []
+        self.event_status = 0
+        self.event_enable = 0
+        self.opc_armed = False
+        self.readings = None
+        self.trace = []
+        self.busy_until = 0.
+
+    """   The serial side   """
+
+    def byte_time(self):
+        return 10.*self.time_scale/self.baudrate
+
+    """
+    Bytes arriving from the driver. Complete lines are processed straight
+    away, at the time they would have finished arriving.
+    """
+    def receive(self, data):
+        with self.lock:
+            self._input += data
+            while b'\r' in self._input or b'\n' in self._input:
+                line, self._input = re.split(b'[\r\n]', self._input, 1)
+                line = line.decode('ascii').strip()
+                if line:
+                    self.process(line)
+
+    """
+    How many response bytes have arrived by now.
+    """
+    def available(self, now=None):
+        if now is None:
+            now = time.time()
+        count = 0
+        with self.lock:
+            for start, data in self.output:
+                if self.time_scale == 0:
+                    count += len(data)
+                    continue
+                arrived = int((now - start)/self.byte_time())
+                if arrived < len(data):
+                    return count + max(arrived, 0)
+                count += len(data)
+        return count
+
+    """
+    Take up to size response bytes that have arrived.
+    """
+    def take(self, size):
+        size = min(size, self.available())
+        out = bytearray()
+        with self.lock:
+            while size > 0 and self.output:
+                start, data = self.output[0]
+                part = data[:size]
+                out += part
+                size -= len(part)
+                if len(part) == len(data):
+                    self.output.pop(0)
+                else:
+                    self.output[0] = [start + len(part)*self.byte_time(),
+                                      data[len(part):]]
+        return bytes(out)
+
+    """
+    Queue a response, sent after anything already queued and not before
+    ready (the time the instrument has it).
+    """
+    def respond(self, data, ready=None):
+        if self.drop_rate and self.random.random_sample() < self.drop_rate:
+            data = data[:-1]
+        now = time.time()
+        start = max(now, ready or now)
+        if self.output:
+            last_start, last = self.output[-1]
+            start = max(start, last_start + len(last)*self.byte_time())
+        self.output.append([start, data])
+
+    """   The instrument side   """
+
+    def process(self, line):
+        self.log.append(line)
+        for command in line.split(';'):
+            command = command.strip()
+            if not command:
+                continue
+            parts = command.split(None, 1)
+            query = parts[0].endswith('?')
+            header = short_header(parts[0].rstrip('?'))
+            value = parts[1].strip() if len(parts) > 1 else None
+            try:
+                self.execute(header, value, query)
+            except (ValueError, IndexError, KeyError):
+                self.errors.append((-113, 'Undefined header'))
+
+    def execute(self, header, value, query=False):
+        handler = self.handlers.get(header)
+        if handler is not None:
+            return handler(self, header, value, query)
+        if header.split(':')[1] not in known_subsystems:
+            raise KeyError(header)
+        if query:
+            self.respond_text(self.settings.get(header, '0'))
+        elif value is not None:
+            self.settings[header] = value
+
+    def respond_text(self, text, ready=None):
+        self.respond((text + '\r').encode('ascii'), ready)
+
+    """   Common commands   """
+
+    def _rst(self, header, value, query):
+        self.reset()
+
+    def _cls(self, header, value, query):
+        self.errors = []
+        self.event_status = 0
+
+    def _idn(self, header, value, query):
+        self.respond_text('KEITHLEY INSTRUMENTS INC.,MODEL 2400,SIMULATED,'
+                          'C32')
+
+    def _opc(self, header, value, query):
+        if query:
+            self.respond_text('1', ready=self.busy_until)
+        else:
+            self.opc_armed = True
+
+    def _update_opc(self):
+        if self.opc_armed and time.time() >= self.busy_until:
+            self.event_status |= 1
+            self.opc_armed = False
+
+    def _ese(self, header, value, query):
+        if query:
+            self.respond_text('%d' %self.event_enable)
+        else:
+            self.event_enable = int(to_float(value))
+
+    def _esr(self, header, value, query):
+        self._update_opc()
+        self.respond_text('%d' %self.event_status)
+        self.event_status = 0
+
+    def _stb(self, header, value, query):
+        self._update_opc()
+        status = 0
+        if self.event_status & self.event_enable:
+            status |= 32
+        if self.errors:
+            status |= 4
+        if self.output:
+            status |= 16
+        self.respond_text('%d' %status)
+
+    def _wai(self, header, value, query):
+        pass
+
+    """   Errors   """
+
+    def _err(self, header, value, query):
+        if self.errors:
+            code, message = self.errors.pop(0)
+        else:
+            code, message = 0, 'No error'
+        self.respond_text('%d,"%s"' %(code, message))
+
+    def _err_all(self, header, value, query):
+        errors = self.errors or [(0, 'No error')]
+        self.errors = []
+        self.respond_text(','.join('%d,"%s"' %error for error in errors))
+
+    """   Source lists   """
+
+    def _list(self, header, value, query):
+        function = header.split(':')[3]
+        if query:
+            self.respond_text(','.join('%g' %v for v in
+                                       self.source_list[function]))
+        else:
+            self.source_list[function] = []
+            self._list_append(header, value, query)
+
+    def _list_append(self, header, value, query):
+        function = header.split(':')[3]
+        values = [to_float(v) for v in value.split(',')]
+        # At most 100 values a command and 2500 in the list
+        if (len(values) > 100 or
+                len(self.source_list[function]) + len(values) > 2500):
+            self.errors.append((-223, 'Too much data'))
+            return
+        self.source_list[function] += values
+
+    def _list_points(self, header, value, query):
+        function = header.split(':')[3]
+        self.respond_text('%d' %len(self.source_list[function]))
+
+    """   Sweep points follow whichever of STEP and POIN was set last   """
+
+    def _sweep_setting(self, header, value, query):
+        if query:
+            return self.respond_text(self.settings[header])
+        self.settings[header] = value
+        if header.endswith(':STEP'):
+            self.settings['_sweep'] = 'STEP'
+        elif header == ':SOUR:SWE:POIN':
+            self.settings['_sweep'] = 'POIN'
+
+    """   Triggering and data   """
+
+    def _init(self, header, value, query):
+        self.readings = self.acquire()
+        if self.settings[':TRAC:FEED:CONT'].upper().startswith('NEXT'):
+            # Fill the trace buffer, then stop feeding it like the 2400 does
+            size = int(to_float(self.settings[':TRAC:POIN']))
+            self.trace += list(self.readings[:size - len(self.trace)])
+            if len(self.trace) >= size:
+                self.settings[':TRAC:FEED:CONT'] = 'NEV'
+
+    def _abort(self, header, value, query):
+        self.busy_until = min(self.busy_until, time.time())
+
+    def _fetch(self, header, value, query):
+        if self.readings is None:
+            self.errors.append((-230, 'Data corrupt or stale'))
+            return
+        self.respond_data(self.readings, ready=self.busy_until)
+
+    def _read(self, header, value, query):
+        self._init(header, value, query)
+        self._fetch(header, value, query)
+
+    def _trace_clear(self, header, value, query):
+        self.trace = []
+
+    def _trace_data(self, header, value, query):
+        self.respond_data(np.array(self.trace).reshape(-1, 5),
+                          ready=self.busy_until)
+
+    def _trace_points(self, header, value, query):
+        if query:
+            self.respond_text(self.settings[':TRAC:POIN'])
+        else:
+            points = int(to_float(value))
+            if points < 1 or points > 2500:
+                raise ValueError(value)
+            self.settings[':TRAC:POIN'] = '%d' %points
+
+    def _baudrate(self, header, value, query):
+        if query:
+            return self.respond_text('%d' %self.baudrate)
+        baudrate = int(to_float(value))
+        if baudrate not in baudrates:
+            self.errors.append((-222, 'Data out of range'))
+            return
+        self.baudrate = baudrate
+
+    def _output(self, header, value, query):
+        if query:
+            self.respond_text(self.settings[':OUTP'])
+        else:
+            self.settings[':OUTP'] = '%d' %to_float(value)
+
+    handlers = {'*RST': _rst, '*CLS': _cls, '*IDN': _idn, '*OPC': _opc,
+                '*ESE': _ese, '*ESR': _esr, '*STB': _stb, '*WAI': _wai,
+                ':SYST:ERR': _err, ':SYST:ERR:ALL': _err_all,
+                ':SYST:PRES': _rst,
+                ':SOUR:LIST:VOLT': _list, ':SOUR:LIST:CURR': _list,
+                ':SOUR:LIST:VOLT:APP': _list_append,
+                ':SOUR:LIST:CURR:APP': _list_append,
+                ':SOUR:LIST:VOLT:POIN': _list_points,
+                ':SOUR:LIST:CURR:POIN': _list_points,
+                ':SOUR:VOLT:STEP': _sweep_setting,
+                ':SOUR:CURR:STEP': _sweep_setting,
+                ':SOUR:SWE:POIN': _sweep_setting,
+                ':INIT': _init, ':ABOR': _abort, ':FETC': _fetch,
+                ':READ': _read, ':TRAC:CLE': _trace_clear,
+                ':TRAC:DATA': _trace_data, ':TRAC:POIN': _trace_points,
+                ':OUTP': _output, ':SYST:COMM:SER:BAUD': _baudrate}
+
+    """
+    The source values for one trigger each, from the source mode.
+    """
+    def source_values(self, function, count):
+        mode = self.settings[':SOUR:%s:MODE' %function].upper()
+        if mode.startswith('LIST'):
+            values = np.array(self.source_list[function] or [0.])
+        elif mode.startswith('SWE'):
+            start = to_float(self.settings[':SOUR:%s:STAR' %function])
+            stop = to_float(self.settings[':SOUR:%s:STOP' %function])
+            step = to_float(self.settings[':SOUR:%s:STEP' %function])
+            if self.settings.get('_sweep') == 'STEP' and step != 0:
+                points = int(round(abs((stop - start)/step))) + 1
+            else:
+                points = int(to_float(self.settings[':SOUR:SWE:POIN']))
+            if self.settings[':SOUR:SWE:SPAC'].upper().startswith('LOG'):
+                values = np.logspace(np.log10(start), np.log10(stop), points)
+            else:
+                values = np.linspace(start, stop, points)
+        else:
+            values = np.array([to_float(self.settings[':SOUR:%s' %function])])
+        return np.resize(values, count)
+
+    """
+    Time for one reading: integration (twice with auto zero), delays and a
+    little overhead.
+    """
+    def reading_time(self):
+        sense = self.settings[':SENS:FUNC'].strip('"\'').upper()[:4]
+        nplc = to_float(self.settings.get(':SENS:%s:NPLC' %sense, '1'))
+        integration = nplc/self.line_frequency
+        if to_float(self.settings[':SYST:AZER:STAT']):
+            integration *= 2
+        delay = (to_float(self.settings[':SOUR:DEL']) +
+                 to_float(self.settings[':TRIG:DEL']))
+        return (integration + delay + 2e-4)*self.time_scale
+
+    """
+    Take TRIG:COUN readings of the model.
+    Returns: array of (volt, curr, res, time, stat) rows.
+    """
+    def acquire(self):
+        count = int(to_float(self.settings[':TRIG:COUN']))
+        function = 'CURR' if self.settings[':SOUR:FUNC'].upper().startswith(
+            'CURR') else 'VOLT'
+        source = self.source_values(function, count)
+        status = np.zeros(count)
+        if not to_float(self.settings[':OUTP']):
+            volts = np.zeros(count)
+            amps = np.zeros(count)
+        elif function == 'VOLT':
+            volts = source
+            amps = np.asarray(self.model.current(source), dtype=float)
+            limit = to_float(self.settings[':SENS:CURR:PROT'])
+            hit = np.abs(amps) > limit
+            amps = np.clip(amps, -limit, limit)
+            status[hit] = compliance_bit
+        else:
+            amps = source
+            volts = np.asarray(self.model.voltage(source), dtype=float)
+            limit = to_float(self.settings[':SENS:VOLT:PROT'])
+            hit = np.abs(volts) > limit
+            volts = np.clip(volts, -limit, limit)
+            status[hit] = compliance_bit
+        volts = volts + self.measurement_noise(volts)
+        amps = amps + self.measurement_noise(amps)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ohms = np.where(amps != 0, volts/amps, 9.91e37)
+        step = self.reading_time()
+        times = np.arange(1, count + 1)*(step if step else 1e-3)
+        now = time.time()
+        self.busy_until = max(now, self.busy_until) + count*step
+        return np.column_stack([volts, amps, ohms, times, status])
+
+    def measurement_noise(self, values):
+        if not self.noise and not self.noise_floor:
+            return 0.
+        scale = self.noise*np.abs(values) + self.noise_floor
+        return self.random.standard_normal(len(values))*scale
+
+    """
+    Send readings in the format set by :FORM.
+    """
+    def respond_data(self, readings, ready=None):
+        elements = [name[:4] for name in
+                    self.settings[':FORM:ELEM'].upper().replace(' ', '')
+                    .split(',')]
+        columns = [element_order.index(name) for name in element_order
+                   if name in elements]
+        values = np.asarray(readings, dtype=float)[:, columns].ravel()
+        data_format = self.settings[':FORM:DATA'].upper()
+        if data_format.startswith('ASC'):
+            text = ','.join('%+.6E' %value for value in values)
+            return self.respond_text(text, ready)
+        order = '<' if self.settings[':FORM:BORD'].upper().startswith(
+            'SWAP') else '>'
+        size = 'd' if data_format.startswith('DRE') else 'f'
+        block = struct.pack('%s%d%s' %(order, len(values), size), *values)
+        self.respond(b'#0' + block + b'\r', ready)
+
+
+"""
+A pyserial-like port connected to a SimulatedKeithley, so it can stand in
+for the serial.Serial from keithley_serial.start_serial.
+"""
+class SimulatedSerial(object):
+
+    def __init__(self, instrument=None, timeout=None, port='sim://'):
+        self.instrument = instrument or SimulatedKeithley()
+        self.timeout = timeout
+        self.port = port
+        self.is_open = True
+        self._baudrate = self.instrument.baudrate
+
+    """
+    The baud rate of this end. If it is not the instrument's, bytes
+    both ways are garbled and lost.
+    """
+    @property
+    def baudrate(self):
+        return self._baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate):
+        self._baudrate = baudrate
+
+    def _garbled(self):
+        return self._baudrate != self.instrument.baudrate
+
+    def isOpen(self):
+        return self.is_open
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def setRTS(self, level=True):
+        pass
+
+    @property
+    def in_waiting(self):
+        return self.instrument.available()
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def write(self, data):
+        # Writing takes as long as the bytes take at the baud rate
+        delay = len(data)*self.instrument.byte_time()
+        if delay:
+            time.sleep(delay)
+        if not self._garbled():
+            self.instrument.receive(bytes(data))
+        return len(data)
+
+    def read(self, size=1):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        while self.instrument.available() < size:
+            if deadline is not None and time.time() >= deadline:
+                break
+            time.sleep(min(max(self.instrument.byte_time(), 1e-4), 1e-3))
+        data = self.instrument.take(size)
+        return b'' if self._garbled() else data
+
+    def reset_input_buffer(self):
+        self.instrument.take(self.instrument.available())
+
+    def flush(self):
+        pass
+
+
+"""
+Make a SimulatedSerial from a port name like
+'sim://diode?noise=1e-3&time_scale=0'. The host picks the model
+('resistor' or 'diode'); the query sets the model parameters and the
+SimulatedKeithley options.
+"""
+def serial_for_url(url, timeout=None):
+    parsed = urlparse(url)
+    name = parsed.netloc or parsed.path.strip('/') or 'resistor'
+    options = dict((key, float(value)) for key, value in
+                   parse_qsl(parsed.query))
+    instrument_options = {}
+    for key in ['noise', 'noise_floor', 'baudrate', 'line_frequency',
+                'time_scale', 'seed', 'drop_rate']:
+        if key in options:
+            instrument_options[key] = options.pop(key)
+    for key in ['seed', 'baudrate']:
+        if key in instrument_options:
+            instrument_options[key] = int(instrument_options[key])
+    model = models[name.lower()](**options)
+    return SimulatedSerial(SimulatedKeithley(model, **instrument_options),
+                           timeout=timeout, port=url)
+
+
+"""
+Serve a SimulatedKeithley on a pseudo terminal (POSIX only), for anything
+that needs a real port name. The instrument runs in a daemon thread.
+Returns: the name of the port to open, e.g. '/dev/pts/3'.
+"""
+def serve_pty(instrument=None):
+    import pty
+    import tty
+    instrument = instrument or SimulatedKeithley()
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+
+    def run():
+        import select
+        while True:
+            ready = select.select([master], [], [], 1e-3)[0]
+            if ready:
+                try:
+                    data = os.read(master, 4096)
+                except OSError:
+                    return
+                instrument.receive(data)
+            waiting = instrument.available()
+            if waiting:
+                os.write(master, instrument.take(waiting))
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    # Keep the slave end open so the pty stays up between connections
+    instrument.pty_fds = (master, slave)
+    return os.ttyname(slave)
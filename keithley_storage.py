@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import queue
+import threading
+from keithley_lazy import lazy_import
+
+np = lazy_import('numpy')
+# h5py is optional, and only loaded once an HDF5 file is used
+h5py = lazy_import('h5py', optional=True)
+
+"""
+Binary storage of readings, so long runs can be written as they come in
+and opened again without loading them whole. Readings are appended in
+chunks to a .npy file (or an HDF5 dataset, if h5py is installed), with the
+instrument settings kept alongside as JSON metadata:
+
+    with open_writer('soak.npy', metadata=instrument_metadata(keithley)) as f:
+        for chunk in keithley.stream_chunks(chunk_size=1000):
+            f.extend(chunk)
+
+    data, metadata = load('soak.npy')
+    last_hour = data[data['time'] > data['time'][-1] - 3600]
+
+load memory maps the file, so only the parts that are used are read.
+Both writers append to a file that is already there. .npy files are not
+compressed, which is what lets them be memory mapped; for compressed
+storage use HDF5, e.g. open_writer('soak.h5', compression='gzip').
+"""
+
+# Room left in the .npy header for the row count, so it can be rewritten
+# in place as rows are appended
+_shape_digits = 20
+
+"""
+Appends structured readings to a .npy file, which np.load (and load)
+read as a 1-d array. The header is rewritten with the row count on
+flush and close; if the writer never gets there the file is still
+readable, see load. metadata (a JSON-able dict) goes in path + '.json'.
+dtype is that of the readings; if None it is taken from the first
+extend, like keithley_buffer.RingBuffer.
+If path is already a .npy file (one written by an NpyWriter, or with a
+header as long) the readings go on the end of it, after its last complete row; they must have its dtype.
+The data are not compressed (see H5Writer for that).
+"""
+class NpyWriter(object):
+
+    def __init__(self, path, dtype=None, metadata=None):
+        self.path = path
+        self.dtype = None
+        self.count = 0
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.file = open(path, 'r+b')
+            try:
+                self._resume(dtype)
+            except Exception:
+                self.file.close()
+                raise
+        else:
+            self.file = open(path, 'wb')
+            if dtype is not None:
+                self._start(np.dtype(dtype))
+        if metadata is not None:
+            write_metadata(path, metadata)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def _start(self, dtype):
+        self.dtype = dtype
+        self.file.write(self._header())
+
+    """
+    Pick up an existing file: take its dtype, count its complete rows
+    and drop any partial one left by a writer that did not close.
+    Raises ValueError if the readings can not go on the end of it.
+    """
+    def _resume(self, dtype):
+        shape, fortran_order, self.dtype, offset = _read_header(self.file)
+        if len(shape) != 1 or fortran_order:
+            raise ValueError("%s is not a 1-d array" %self.path)
+        if dtype is not None and np.dtype(dtype) != self.dtype:
+            raise ValueError("%s holds %s, not %s"
+                             %(self.path, self.dtype, np.dtype(dtype)))
+        # Our header leaves room for the row count to grow
+        if offset != len(self._header()):
+            raise ValueError("The header of %s has no room for more rows"
+                             %self.path)
+        self.count = (os.path.getsize(self.path) - offset)//self.dtype.itemsize
+        self.file.truncate(offset + self.count*self.dtype.itemsize)
+        self.file.seek(0, os.SEEK_END)
+
+    def _header(self):
+        header = ("{'descr': %r, 'fortran_order': False, 'shape': (%d,), }"
+                  %(np.lib.format.dtype_to_descr(self.dtype), self.count))
+        # Same length whatever the count, a multiple of 64 with the magic
+        width = len(header) - len('%d' %self.count) + _shape_digits
+        if width + 11 < 2**16:
+            prefix = b'\x93NUMPY\x01\x00'
+            size = 2
+        else:
+            prefix = b'\x93NUMPY\x02\x00'
+            size = 4
+        total = -(-(len(prefix) + size + width + 1) // 64)*64
+        header = header.ljust(total - len(prefix) - size - 1) + '\n'
+        return (prefix + len(header).to_bytes(size, 'little') +
+                header.encode('latin1'))
+
+    """
+    Append readings (a structured array, or anything that casts to the
+    writer's dtype).
+    """
+    def extend(self, readings):
+        readings = np.asarray(readings)
+        if self.dtype is None:
+            self._start(readings.dtype)
+        if readings.dtype != self.dtype:
+            readings = readings.astype(self.dtype)
+        self.file.write(np.ascontiguousarray(readings).tobytes())
+        self.count += len(readings)
+
+    """
+    Update the header and push everything to the OS; with sync also to
+    the disk.
+    """
+    def flush(self, sync=False):
+        if self.dtype is None:
+            return
+        self.file.seek(0)
+        self.file.write(self._header())
+        self.file.seek(0, os.SEEK_END)
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.close()
+
+
+"""
+Appends structured readings to a resizable, chunked HDF5 dataset. If the
+file already has the dataset the readings go on the end of it (they must
+have its dtype); other datasets in the file are left alone.
+metadata is stored in the attributes of the dataset (as JSON).
+compression is passed on to h5py, e.g. 'gzip' or 'lzf'.
+Needs h5py.
+"""
+class H5Writer(object):
+
+    def __init__(self, path, dtype=None, metadata=None, dataset='readings',
+                 chunk_rows=2500, compression=None):
+        if h5py is None:
+            raise ImportError("h5py is needed for HDF5 storage")
+        self.path = path
+        self.name = dataset
+        self.dtype = None
+        self.dataset = None
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.metadata = metadata
+        self.file = h5py.File(path, 'a')
+        if dataset in self.file:
+            self._start(self.file[dataset].dtype)
+        elif dtype is not None:
+            self._start(np.dtype(dtype))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return 0 if self.dataset is None else len(self.dataset)
+
+    def _start(self, dtype):
+        self.dtype = dtype
+        if self.name in self.file:
+            self.dataset = self.file[self.name]
+            if self.dataset.maxshape != (None,):
+                raise ValueError("Dataset %s of %s can not be appended to"
+                                 %(self.name, self.path))
+        else:
+            self.dataset = self.file.create_dataset(
+                self.name, shape=(0,), maxshape=(None,), dtype=dtype,
+                chunks=(self.chunk_rows,), compression=self.compression)
+        if self.metadata is not None:
+            self.dataset.attrs['metadata'] = json.dumps(self.metadata)
+
+    def extend(self, readings):
+        readings = np.asarray(readings)
+        if self.dataset is None:
+            self._start(readings.dtype)
+        if readings.dtype.names != self.dtype.names:
+            raise ValueError("Readings with fields %s do not go in %s"
+                             %(readings.dtype.names, self.name))
+        count = len(self.dataset)
+        self.dataset.resize((count + len(readings),))
+        self.dataset[count:] = readings.astype(self.dtype, copy=False)
+
+    def flush(self, sync=False):
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.id.get_vfd_handle())
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+"""
+Hands readings to a writer (NpyWriter, H5Writer, or anything with extend,
+flush and close) on a thread of its own, so writing to disk never holds up
+the acquisition. extend only queues the readings; the thread writes what
+has queued up in one go (up to batch_rows readings) and syncs the file to
+disk every sync_interval seconds (None for never).
+The queue holds at most max_blocks blocks. When it is full, extend waits
+for room (backpressure) if drop is False, or drops the block if it is True.
+Either way it is counted in stats: 'queued', 'written', 'dropped' and
+'late' blocks (late ones waited more than late_after seconds for room),
+'max_depth' of the queue, 'rows' and 'write_time' spent in the writer.
+"""
+class BackgroundWriter(object):
+
+    def __init__(self, writer, max_blocks=64, batch_rows=25000, drop=False,
+                 late_after=.01, sync_interval=1.):
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=max_blocks)
+        self.batch_rows = batch_rows
+        self.drop = drop
+        self.late_after = late_after
+        self.sync_interval = sync_interval
+        self.stats = {'queued': 0, 'written': 0, 'dropped': 0, 'late': 0,
+                      'max_depth': 0, 'rows': 0, 'write_time': 0.}
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def extend(self, readings):
+        if self.error is not None:
+            raise self.error
+        if self.drop:
+            try:
+                self.queue.put_nowait(readings)
+            except queue.Full:
+                self.stats['dropped'] += 1
+                return
+        else:
+            start = time.time()
+            self.queue.put(readings)
+            if time.time() - start > self.late_after:
+                self.stats['late'] += 1
+        self.stats['queued'] += 1
+        self.stats['max_depth'] = max(self.stats['max_depth'],
+                                      self.queue.qsize())
+
+    def _run(self):
+        last_sync = time.time()
+        done = False
+        while not done:
+            blocks = [self.queue.get()]
+            rows = 0 if blocks[0] is None else len(blocks[0])
+            while rows < self.batch_rows:
+                try:
+                    blocks.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+                if blocks[-1] is not None:
+                    rows += len(blocks[-1])
+            done = blocks[-1] is None
+            blocks = [block for block in blocks if block is not None]
+            if not blocks or self.error is not None:
+                continue
+            start = time.time()
+            try:
+                self.writer.extend(np.concatenate(blocks))
+                sync = (self.sync_interval is not None and
+                        start - last_sync > self.sync_interval)
+                self.writer.flush(sync=sync)
+                if sync:
+                    last_sync = start
+            except Exception as error:
+                # Given back to the acquisition by the next extend or close
+                self.error = error
+                continue
+            self.stats['write_time'] += time.time() - start
+            self.stats['written'] += len(blocks)
+            self.stats['rows'] += rows
+
+    """
+    Write out what is still queued, sync and close the writer.
+    """
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+            if self.error is None and self.sync_interval is not None:
+                self.writer.flush(sync=True)
+            self.writer.close()
+        if self.error is not None:
+            raise self.error
+
+
+"""
+A writer for path, an H5Writer for .h5/.hdf5 files and an NpyWriter for
+anything else. The keyword arguments are passed on (NpyWriter takes none,
+it does not compress).
+"""
+def open_writer(path, dtype=None, metadata=None, **kwargs):
+    if os.path.splitext(path)[1].lower() in ('.h5', '.hdf5'):
+        return H5Writer(path, dtype, metadata, **kwargs)
+    return NpyWriter(path, dtype, metadata, **kwargs)
+
+"""
+Write readings to path in one go, see open_writer. Like the writers it
+appends if path already has readings.
+"""
+def save(path, readings, metadata=None, **kwargs):
+    with open_writer(path, metadata=metadata, **kwargs) as f:
+        f.extend(readings)
+
+"""
+Open readings written by open_writer or save.
+With mmap the data are memory mapped, so large files can be sliced
+without reading them whole. For an HDF5 file that gives the h5py dataset
+itself, read lazily, and its file stays open until data.file.close();
+without mmap the readings are read in and the file closed.
+A .npy file whose writer did not get to close is read up to its last
+complete row.
+Returns: (readings, metadata), metadata is None if there is none.
+"""
+def load(path, mmap=True, dataset='readings'):
+    if os.path.splitext(path)[1].lower() in ('.h5', '.hdf5'):
+        if h5py is None:
+            raise ImportError("h5py is needed for HDF5 storage")
+        f = h5py.File(path, 'r')
+        try:
+            data = f[dataset]
+            metadata = data.attrs.get('metadata')
+            if metadata is not None:
+                metadata = json.loads(metadata)
+            if not mmap:
+                data = data[()]
+        except Exception:
+            f.close()
+            raise
+        if not mmap:
+            f.close()
+        return data, metadata
+
+    with open(path, 'rb') as f:
+        shape, fortran_order, dtype, offset = _read_header(f)
+    rows = (os.path.getsize(path) - offset) // dtype.itemsize
+    if rows == 0:
+        data = np.zeros(0, dtype=dtype)
+    elif mmap:
+        data = np.memmap(path, dtype=dtype, mode='r', offset=offset,
+                         shape=(rows,))
+    else:
+        data = np.fromfile(path, dtype=dtype, count=rows, offset=offset)
+    return data, read_metadata(path)
+
+"""
+Read the header of the .npy file f from its start.
+Returns: (shape, fortran_order, dtype, offset of the data).
+"""
+def _read_header(f):
+    f.seek(0)
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        header = np.lib.format.read_array_header_1_0(f)
+    else:
+        header = np.lib.format.read_array_header_2_0(f)
+    return header + (f.tell(),)
+
+def write_metadata(path, metadata):
+    with open(path + '.json', 'w') as f:
+        json.dump(metadata, f, indent=2, default=_jsonable)
+
+def read_metadata(path):
+    if not os.path.exists(path + '.json'):
+        return None
+    with open(path + '.json') as f:
+        return json.load(f)
+
+def _jsonable(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+"""
+The settings of a Keithley worth keeping with its data: port, data format,
+elements and the settings sent so far (from its StateCache).
+"""
+def instrument_metadata(keithley, **extra):
+    metadata = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'port': keithley.port,
+                'data_format': keithley.data_format,
+                'byte_order': keithley.byte_order,
+                'elements': keithley.elements,
+                'settings': dict(keithley.cache.settings)}
+    metadata.update(extra)
+    return metadata
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import serial
+from keithley_lazy import lazy_import
+
+# pyvisa is optional, it is only needed (and loaded) for GPIB and VXI-11
+# links
+pyvisa = lazy_import('pyvisa', optional=True)
+
+"""
+The links a Keithley can be driven over. The driver only uses a few
+pyserial methods on its port (write, read, in_waiting,
+reset_input_buffer, flush, isOpen, open, close and baudrate), so
+anything with those can stand in for a serial port. open_transport picks
+one from the port name:
+
+    '/dev/ttyUSB0', 'COM3'              RS-232, through pyserial
+    'socket://host:port'                a TCP serial server (raw socket)
+    'rfc2217://host:port'               a serial server with RFC 2217
+                                        port control (baud rate and all)
+    'sim://diode'                       the simulated Keithley (keithley_sim)
+    'GPIB0::24::INSTR',
+    'TCPIP::host::gpib0,24::INSTR'      GPIB or a VXI-11 gateway (pyvisa)
+
+and a LoopbackTransport, an in-memory port for tests, can be handed to
+Keithley in place of a port name.
+"""
+
+# Baud rates the 2400 can be set to with :SYST:COMM:SER:BAUD
+baudrates = [300, 600, 1200, 2400, 4800, 9600, 19200, 38400, 57600]
+# Links whose baud rate is set at the far end, not from here
+fixed_rate_schemes = ['socket://']
+
+"""
+Open the link for port (a name as above, or an already made transport,
+which is opened again if it was closed). timeout is how long one read
+waits for bytes, write_timeout how long one write may block.
+Returns: the transport.
+Raises OSError or serial.SerialException if the port can not be opened.
+"""
+def open_transport(port, baudrate=57600, timeout=.05, write_timeout=2.):
+    if not isinstance(port, str):
+        if not port.isOpen():
+            port.open()
+        return port
+    if port.startswith('sim://'):
+        import keithley_sim
+        return keithley_sim.serial_for_url(port, timeout=timeout)
+    if '::' in port:
+        return VisaTransport(port, timeout=timeout)
+
+    # Configure the serial connections.
+    # These are specific to the Keithley 2400 SourceMeter.
+    # This device is configurable, but these are default (except for BAUD).
+    # Using a carriage return only for termination.
+    # The read timeout is only a poll interval, so that waits with an
+    # overall timeout can give up; read() keeps polling until it is done.
+    settings = dict(baudrate=baudrate,
+                    parity=serial.PARITY_NONE,
+                    bytesize=serial.EIGHTBITS,
+                    stopbits=serial.STOPBITS_ONE,
+                    timeout=timeout,
+                    write_timeout=write_timeout)
+    if '://' in port:
+        return serial.serial_for_url(port, **settings)
+    ser = serial.Serial(port=port, **settings)
+
+    # Need to set the "request to send" pin low
+    # (pseudo terminals, e.g. keithley_sim.serve_pty, have no RTS pin)
+    try:
+        ser.setRTS(False)
+    except (OSError, serial.SerialException):
+        pass
+    return ser
+
+"""
+Whether the baud rate of the link to port can be changed from this end,
+so that it can follow the Keithley's (see Keithley.set_baudrate).
+"""
+def can_set_baudrate(port):
+    return (isinstance(port, str) and '::' not in port and
+            not port.startswith(tuple(fixed_rate_schemes)))
+
+
+"""
+A port that lives in memory, for trying out code that talks to a
+Keithley. responder(line) is called with every line written (without the
+terminator) and returns the response, str or bytes without the
+terminator, or None if there is none. Lines written are kept in written.
+"""
+class LoopbackTransport(object):
+
+    def __init__(self, responder=None, terminator=b'\r', timeout=.01):
+        self.responder = responder
+        self.terminator = terminator
+        self.timeout = timeout
+        self.written = []
+        self.buffer = bytearray()
+        self._input = b''
+        self.baudrate = 57600
+        self.port = 'loopback'
+        self.is_open = True
+
+    def isOpen(self):
+        return self.is_open
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    @property
+    def in_waiting(self):
+        return len(self.buffer)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def write(self, data):
+        self._input += bytes(data)
+        while self.terminator in self._input:
+            line, self._input = self._input.split(self.terminator, 1)
+            line = line.decode('ascii')
+            self.written.append(line)
+            if self.responder is not None:
+                self.feed(self.responder(line))
+        return len(data)
+
+    """
+    Queue a response as if the Keithley had sent it.
+    """
+    def feed(self, response):
+        if response is None:
+            return
+        if isinstance(response, str):
+            response = response.encode('ascii')
+        self.buffer += response + self.terminator
+
+    def read(self, size=1):
+        if not self.buffer and self.timeout:
+            # Nothing more can arrive, but don't spin
+            time.sleep(self.timeout)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def reset_input_buffer(self):
+        del self.buffer[:]
+
+    def flush(self):
+        pass
+
+
+"""
+A GPIB (or VXI-11, through a LAN/GPIB gateway) link through pyvisa,
+made to look like a serial port. The 2400 ends GPIB messages with a line
+feed (and EOI); these are turned into the carriage returns the driver
+expects, both ways. Needs pyvisa and a VISA library.
+"""
+class VisaTransport(object):
+
+    baudrate = None
+
+    def __init__(self, resource_name, timeout=.05, terminator=b'\r'):
+        if pyvisa is None:
+            raise ImportError("pyvisa is needed for GPIB/VXI-11 links")
+        self.port = resource_name
+        self.terminator = terminator
+        self.buffer = bytearray()
+        self.manager = pyvisa.ResourceManager()
+        self.resource = None
+        self.timeout = timeout
+        self.open()
+
+    def isOpen(self):
+        return self.resource is not None
+
+    def open(self):
+        if self.resource is None:
+            self.resource = self.manager.open_resource(self.port)
+            self.resource.timeout = max(int(self.timeout*1000), 1)
+
+    def close(self):
+        if self.resource is not None:
+            self.resource.close()
+            self.resource = None
+
+    @property
+    def in_waiting(self):
+        return len(self.buffer)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def write(self, data):
+        data = bytes(data).replace(self.terminator, b'\n')
+        try:
+            self.resource.write_raw(data)
+        except pyvisa.errors.VisaIOError as error:
+            raise OSError(str(error))
+        return len(data)
+
+    """
+    Reads a whole message whenever the buffer runs out; a VISA timeout
+    just gives no bytes, like a serial port.
+    """
+    def read(self, size=1):
+        if not self.buffer:
+            try:
+                message = self.resource.read_raw()
+            except pyvisa.errors.VisaIOError as error:
+                if error.error_code != pyvisa.constants.StatusCode.error_timeout:
+                    raise OSError(str(error))
+                message = b''
+            if message.endswith(b'\n'):
+                message = message[:-1] + self.terminator
+            self.buffer += message
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def reset_input_buffer(self):
+        del self.buffer[:]
+
+    def flush(self):
+        pass
@@ -0,0 +1,22 @@
+import numpy as np
+import keithley_analysis as ka
+
+def readings(volts, amps):
+    data = np.zeros(len(volts), dtype=[('volt', float), ('curr', float)])
+    data['volt'] = volts
+    data['curr'] = amps
+    return data
+
+def test_resistance_without_current():
+    data = readings([2., -2., 0., 1.], [0., 0., 0., 1e-3])
+    r = ka.resistance(data)
+    assert r[0] == np.inf and r[1] == -np.inf and np.isnan(r[2])
+    assert r[3] == 1e3
+    g = ka.conductance(readings([0., 0., 0.], [1., -1., 0.]))
+    assert g[0] == np.inf and g[1] == -np.inf and np.isnan(g[2])
+
+def test_differential_conductance():
+    slope = ka.differential_conductance(readings([1., 1., 2., 3.],
+                                                 [1., 2., 3., 4.]))
+    assert np.isnan(slope[0])
+    assert list(slope[1:]) == [2., 1., 1.]
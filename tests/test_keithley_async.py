@@ -0,0 +1,83 @@
+import os
+import asyncio
+import pytest
+import keithley_sim
+import keithley_async as ka
+
+pytestmark = pytest.mark.skipif(os.name != 'posix',
+                                reason='the simulator is served on a pty')
+
+def run(coroutine, timeout=10.):
+    return asyncio.run(asyncio.wait_for(coroutine, timeout))
+
+def test_query_in_batch_with_verify_cache():
+    port = keithley_sim.serve_pty(keithley_sim.SimulatedKeithley(
+        keithley_sim.Resistor(), time_scale=0))
+
+    async def measure():
+        keithley = await ka.AsyncKeithley.open(port, verify_cache=True,
+                                               timeout=2.)
+        await keithley.send_command(':SOUR:DEL 0.1')
+        async with keithley.batch():
+            # Cached already, so checked against the Keithley with a query
+            await keithley.send_command(':SOUR:DEL 0.1')
+            await keithley.send_command(':TRIG:COUN 3')
+            response = await keithley.get_response(':TRIG:COUN?')
+        await keithley.close_serial()
+        return response
+
+    assert run(measure(), timeout=5.) == '3'
+
+def test_read_binary_after_sweep():
+    port = keithley_sim.serve_pty(keithley_sim.SimulatedKeithley(
+        keithley_sim.Resistor(), time_scale=0))
+
+    async def measure():
+        keithley = await ka.AsyncKeithley.open(port, timeout=2.,
+                                               data_format='sreal')
+        await keithley.sweep(start=0, stop=1, step=.5, delay=0.)
+        count = await keithley.get_num_triggers()
+        data = await keithley.read()
+        await keithley.close_serial()
+        return count, data
+
+    count, data = run(measure())
+    assert len(data) == count
+
+def test_back_in_step_after_timeout():
+    port = keithley_sim.serve_pty(keithley_sim.SimulatedKeithley(
+        keithley_sim.Resistor(), time_scale=1))
+
+    async def measure():
+        keithley = await ka.AsyncKeithley.open(port, timeout=2.)
+        await keithley.configure_sweep(start=0, stop=1, step=.25, delay=.1)
+        await keithley.send_command(':OUTP ON')
+        await keithley.send_command(':INIT')
+        done = await keithley.wait_for_completion(timeout=.1)
+        # The late '1' from *OPC? must not be taken for these
+        elements = await keithley.get_response(':FORM:ELEM?')
+        count = await keithley.get_num_triggers()
+        await keithley.close_serial()
+        return done, elements, count
+
+    done, elements, count = run(measure())
+    assert not done
+    assert elements.startswith('VOLT')
+    assert count == 4
+
+def test_sim_url_adaptive_sweep_and_reconnect():
+    async def measure():
+        keithley = await ka.AsyncKeithley.open('sim://diode?time_scale=0',
+                                               timeout=2.)
+        await keithley.set_current_compliance(.01)
+        data = await keithley.adaptive_sweep(0, 1, max_points=40, delay=0.)
+        back = await keithley.reconnect()
+        compliance = await keithley.get_response(':SENS:CURR:PROT?')
+        await keithley.close_serial()
+        return data, back, compliance
+
+    data, back, compliance = run(measure())
+    assert 21 < len(data) <= 40
+    assert (data['volt'][1:] >= data['volt'][:-1]).all()
+    assert back
+    assert float(compliance) == .01
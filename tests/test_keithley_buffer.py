@@ -0,0 +1,36 @@
+import numpy as np
+import keithley_buffer as kb
+
+dtype = [('volt', float), ('time', float)]
+
+def readings(start, count):
+    data = np.zeros(count, dtype=dtype)
+    data['volt'] = np.arange(start, start + count)
+    return data
+
+def test_grows_then_wraps():
+    buffer = kb.RingBuffer(100)
+    buffer.extend(readings(0, 10))
+    assert len(buffer.data) == 10
+    buffer.extend(readings(10, 5))
+    assert len(buffer.data) == 20
+    assert list(buffer.latest()['volt']) == list(range(15))
+    for start in range(15, 250, 7):
+        buffer.extend(readings(start, 7))
+    assert len(buffer.data) == 100
+    assert list(buffer.latest()['volt']) == list(range(153, 253))
+    assert list(buffer.latest(3)['volt']) == [250, 251, 252]
+
+def test_larger_than_size():
+    buffer = kb.RingBuffer(10, dtype=dtype)
+    buffer.extend(readings(0, 25))
+    assert list(buffer.latest()['volt']) == list(range(15, 25))
+
+def test_decimate_minmax_keeps_peaks():
+    y = np.zeros(10000)
+    y[1234] = 5.
+    y[8765] = -5.
+    x, y_plot = kb.decimate_minmax(np.arange(10000), y, 100)
+    assert len(y_plot) <= 200
+    assert 5. in y_plot and -5. in y_plot
+    assert np.all(np.diff(x) >= 0)
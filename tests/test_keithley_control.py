@@ -0,0 +1,189 @@
+import numpy as np
+import pytest
+import keithley_control as kc
+
+def deaf_above(keithley, max_baudrate):
+    # Answers are lost above max_baudrate, commands still get through
+    ser = keithley.ser
+    read = ser.read
+    ser.read = lambda size=1: (b'' if ser.baudrate > max_baudrate
+                               else read(size))
+
+def test_set_baudrate():
+    keithley = kc.Keithley('sim://resistor?time_scale=0&baudrate=9600')
+    assert keithley.baudrate == 9600
+    assert keithley.set_baudrate(19200)
+    assert keithley.ser.instrument.baudrate == 19200
+    assert keithley.get_response('*OPC?') == '1'
+
+def test_set_baudrate_goes_back():
+    keithley = kc.Keithley('sim://resistor?time_scale=0&baudrate=9600')
+    deaf_above(keithley, 19200)
+    assert keithley.set_baudrate(57600) is False
+    assert keithley.baudrate == 9600
+    assert keithley.ser.instrument.baudrate == 9600
+    assert keithley.get_response('*OPC?') == '1'
+
+def test_negotiate_baudrate():
+    keithley = kc.Keithley('sim://resistor?time_scale=0&baudrate=9600')
+    deaf_above(keithley, 19200)
+    assert keithley.negotiate_baudrate() == 19200
+    assert keithley.ser.instrument.baudrate == 19200
+
+def test_find_baudrate():
+    keithley = kc.Keithley('sim://resistor?time_scale=0&baudrate=4800')
+    keithley.ser.baudrate = 57600
+    assert keithley.find_baudrate() == 4800
+    assert keithley.baudrate == 4800
+
+def test_iter_sweep_blocks():
+    keithley = kc.Keithley('sim://resistor?time_scale=0')
+    blocks = list(keithley.iter_sweep_blocks(start=-1, stop=1, step=.1,
+                                             num_sweeps=2, block_size=15))
+    assert [len(block) for block in blocks] == [15, 15, 12]
+    volts = np.concatenate(blocks)['volt']
+    assert np.allclose(volts, np.tile(np.linspace(-1, 1, 21), 2))
+
+def test_refine_points():
+    x = np.linspace(-1, 1, 21)
+    assert len(kc.refine_points(x, 2*x + 1)) == 0
+    new = kc.refine_points(x, np.abs(x), tolerance=.02)
+    assert len(new) > 0
+    assert np.all(np.diff(new) > 0)
+    # Only around the bend at 0
+    assert np.all(np.abs(new) < .1)
+    assert len(kc.refine_points(x, np.abs(x), tolerance=.02,
+                                min_step=.1)) == 0
+
+def test_adaptive_sweep_resistor():
+    keithley = kc.Keithley('sim://resistor?time_scale=0&resistance=1e6')
+    data = keithley.adaptive_sweep(start=-1, stop=1, coarse_points=21,
+                                   delay=0)
+    # A straight line needs nothing past the coarse pass
+    assert len(data) == 21
+    assert np.allclose(data['curr'], data['volt']/1e6)
+
+def test_adaptive_sweep_diode():
+    keithley = kc.Keithley('sim://diode?time_scale=0')
+    data = keithley.adaptive_sweep(start=1, stop=0, coarse_points=21,
+                                   max_points=60, delay=0)
+    volts = data['volt']
+    assert 21 < len(data) <= 60
+    assert np.all(np.diff(volts) > 0)
+    # The knee (and the compliance limit above it) get the extra points,
+    # the flat part below it none
+    spacing = np.diff(volts)
+    assert spacing[volts[1:] <= .5].min() == pytest.approx(.05)
+    assert spacing[(volts[1:] > .75) & (volts[1:] < .87)].max() < .02
+
+def test_adaptive_sweep_point_budget():
+    keithley = kc.Keithley('sim://diode?time_scale=0')
+    data = keithley.adaptive_sweep(start=0, stop=1, coarse_points=21,
+                                   max_points=30, delay=0)
+    assert len(data) == 30
+    data = keithley.adaptive_sweep(start=0, stop=1e-4, source='CURR',
+                                   max_points=40, delay=0)
+    assert len(data) <= 40
+    assert np.all(np.diff(data['curr']) > 0)
+
+def test_parse_data():
+    data = kc.parse_data('1,2,3,4,5,6,7,8,9,10',
+                         elements=['volt', 'curr', 'res', 'time', 'stat'])
+    assert list(data['volt']) == [1., 6.]
+    assert list(data['stat']) == [5., 10.]
+    data = kc.parse_data('1,2,3,4', elements=['volt', 'time'])
+    assert list(data['time']) == [2., 4.]
+
+def test_parse_data_ragged():
+    with pytest.raises(ValueError):
+        kc.parse_data('1,2,3', elements=['volt', 'time'])
+    with pytest.raises(ValueError):
+        kc.parse_data('1,2,x,4', elements=['volt', 'time'])
+    with pytest.raises(ValueError):
+        kc.parse_binary(b'\x00'*10, data_format='sreal',
+                        elements=['volt', 'time'])
+
+def test_short_header():
+    assert kc.short_header(':SOURce:VOLTage:LEVel') == ':SOUR:VOLT'
+    assert kc.short_header('sour:del') == ':SOUR:DEL'
+    assert kc.short_header(':SYSTem:ERRor:NEXT') == ':SYST:ERR'
+    assert kc.short_header(':FORMat') == ':FORM:DATA'
+    assert kc.short_header('*rst') == '*RST'
+
+def test_state_cache():
+    cache = kc.StateCache()
+    assert cache.update(':SOUR:VOLT 1')
+    assert not cache.update(':SOURce:VOLTage:LEVel 1')
+    assert cache.update(':SOUR:VOLT 2')
+    # Always sent
+    assert cache.update(':OUTP ON') and cache.update(':OUTP ON')
+    assert cache.update(':INIT') and cache.update(':INIT')
+    # Writing the points changes the step on the Keithley
+    assert cache.update(':SOUR:VOLT:STEP .1')
+    assert cache.update(':SOUR:SWE:POIN 11')
+    assert cache.update(':SOUR:VOLT:STEP .1')
+    assert cache.update('*RST')
+    assert cache.update(':SOUR:VOLT 2')
+
+def test_pending_commands():
+    keithley = kc.Keithley('sim://resistor?time_scale=0')
+    commands = [':SOUR:VOLT 1', ':SENS:CURR:PROT .01']
+    assert keithley.pending_commands(commands) == commands
+    assert keithley.pending_commands(commands) == []
+    keithley.reconnect()
+    assert keithley.pending_commands(commands) == []
+    keithley.send_command('*RST')
+    assert keithley.pending_commands(commands) == commands
+
+def test_verify_cache():
+    keithley = kc.Keithley('sim://resistor?time_scale=0', verify_cache=True)
+    keithley.send_command(':SOUR:VOLT 1')
+    assert keithley.pending_commands([':SOUR:VOLT 1']) == []
+    # Changed from the front panel
+    keithley.ser.instrument.receive(b':SOUR:VOLT 3\r')
+    assert keithley.pending_commands([':SOUR:VOLT 1']) == [':SOUR:VOLT 1']
+
+def test_join_commands():
+    assert kc.join_commands([':SOUR:VOLT 1', 'OUTP ON', '*OPC']) == [
+        ':SOUR:VOLT 1;:OUTP ON;*OPC']
+    commands = [':SOUR:VOLT %d' %i for i in range(100)]
+    lines = kc.join_commands(commands, max_length=50)
+    assert all(len(line) <= 50 for line in lines)
+    assert ';'.join(lines).split(';') == commands
+    # Too long for any line, so on its own
+    long = ':SOUR:LIST:VOLT ' + ','.join(['1']*40)
+    assert kc.join_commands([':INIT', long, ':INIT'], 50) == [
+        ':INIT', long, ':INIT']
+    assert kc.join_commands([]) == []
+
+def test_send_commands_one_line():
+    keithley = kc.Keithley('sim://resistor?time_scale=0')
+    writes = []
+    write = keithley.ser.write
+    keithley.ser.write = lambda data: writes.append(data) or write(data)
+    assert keithley.send_commands([':SOUR:VOLT 1', ':SOUR:DEL .01',
+                                   ':TRIG:COUN 3']) == []
+    # The commands and the error check
+    assert len(writes) == 2
+    assert writes[0] == b':SOUR:VOLT 1;:SOUR:DEL .01;:TRIG:COUN 3\r'
+
+def test_list_commands():
+    values = np.linspace(-1, 1, 250)
+    commands = kc.list_commands(values, 'VOLT', max_length=250)
+    assert commands[0].startswith(':SOUR:LIST:VOLT ')
+    assert all(com.startswith(':SOUR:LIST:VOLT:APP ') for com in commands[1:])
+    assert all(len(com) <= 250 for com in commands)
+    sent = [float(value) for com in commands
+            for value in com.split(None, 1)[1].split(',')]
+    assert np.allclose(sent, values)
+    commands = kc.list_commands(np.zeros(250), 'CURR', max_length=10**4)
+    assert [com.count(',') + 1 for com in commands] == [100, 100, 50]
+
+def test_list_sweep():
+    keithley = kc.Keithley('sim://resistor?time_scale=0&resistance=1e3')
+    values = np.linspace(0, .1, 150)
+    data = keithley.list_sweep(values, 'VOLT', delay=0)
+    assert np.allclose(data['volt'], values)
+    assert np.allclose(data['curr'], values/1e3)
+    assert keithley.list_sweep([], 'VOLT') is None
+    assert keithley.get_errors() == []
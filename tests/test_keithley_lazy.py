@@ -0,0 +1,36 @@
+import os
+import sys
+import subprocess
+import keithley_lazy
+
+top = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+# Run in a fresh interpreter, so numpy is not loaded yet
+first_use_in_threads = """
+import threading
+import keithley_control as kc
+errors = []
+barrier = threading.Barrier(8)
+def touch():
+    barrier.wait()
+    try:
+        kc.np.zeros(3)
+    except Exception as error:
+        errors.append(error)
+threads = [threading.Thread(target=touch) for i in range(8)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+assert not errors, errors
+"""
+
+def test_first_use_in_threads():
+    env = dict(os.environ, PYTHONPATH=top)
+    for i in range(3):
+        subprocess.check_call([sys.executable, '-c', first_use_in_threads],
+                              env=env, cwd=top)
+
+def test_optional_missing():
+    assert keithley_lazy.lazy_import('no_such_module', optional=True) is None
+    assert not keithley_lazy.is_loaded('no_such_module')
@@ -0,0 +1,22 @@
+import numpy as np
+import keithley_rack
+
+def test_same_port_names():
+    rack = keithley_rack.KeithleyRack(['sim://resistor?time_scale=0']*4)
+    try:
+        rack.broadcast('set_num_triggers', 4)
+        data = rack.read(data_type='v')
+        assert len(data) == 16
+        assert sorted(set(data['instrument'])) == [0, 1, 2, 3]
+        assert len(rack.last_stats) == 4
+    finally:
+        rack.close()
+
+def test_merge_results_in_time_order():
+    dtype = [('volt', float), ('time', float)]
+    first = np.array([(1., 0.), (2., 1.)], dtype=dtype)
+    second = np.array([(3., 0.)], dtype=[('curr', float), ('time', float)])
+    merged = keithley_rack.merge_results([first, None, second], [10., 0., 10.5])
+    assert list(merged['host_time']) == [10., 10.5, 11.]
+    assert list(merged['instrument']) == [0, 2, 0]
+    assert np.isnan(merged['curr'][0]) and merged['curr'][1] == 3.
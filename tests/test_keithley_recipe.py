@@ -0,0 +1,37 @@
+import pytest
+import keithley_control as kc
+import keithley_recipe as kr
+
+def test_deduplicate():
+    commands = [':SOUR:VOLT 1', ':SENS:CURR:PROT .1', ':SOURce:VOLTage 2',
+                ':SOUR:LIST:VOLT 1,2', ':SOUR:LIST:VOLT:APP 3',
+                ':SOUR:LIST:VOLT:APP 4', ':INIT', ':INIT']
+    assert kr.deduplicate(commands) == [
+        ':SENS:CURR:PROT .1', ':SOURce:VOLTage 2', ':SOUR:LIST:VOLT 1,2',
+        ':SOUR:LIST:VOLT:APP 3', ':SOUR:LIST:VOLT:APP 4', ':INIT', ':INIT']
+
+def test_compile_recipe():
+    settings = {'name': 'iv', 'start': 0, 'stop': 1, 'points': 11,
+                'compliance': .01}
+    plan = kr.compile_recipe(settings)
+    assert kr.compile_recipe(dict(settings)) is plan
+    headers = [kc.short_header(kc.split_command(com)[0])
+               for com in plan.setup]
+    assert len(headers) == len(set(headers))
+    assert all(len(line) <= 250 for line in plan.lines)
+    assert plan.num_readings == 11
+    with pytest.raises(ValueError):
+        kr.Recipe(mode='list')
+    with pytest.raises(ValueError):
+        kr.Recipe.from_dict({'colour': 'red'})
+
+def test_plan_run():
+    keithley = kc.Keithley('sim://resistor?time_scale=0&resistance=1e3')
+    plan = kr.compile_recipe({'name': 'iv', 'start': 0, 'stop': .1,
+                              'points': 11, 'data_format': 'sreal'})
+    data = plan.run(keithley)
+    assert len(data) == 11
+    assert abs(data['curr'][-1] - 1e-4) < 1e-7
+    # Everything is in place the second time
+    assert keithley.pending_commands(plan.setup) == []
+    assert len(plan.run(keithley)) == 11
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import keithley_storage as st
+
+dtype = [('volt', float), ('curr', float), ('time', float)]
+
+def readings(start, count):
+    data = np.zeros(count, dtype=dtype)
+    data['volt'] = np.arange(start, start + count)
+    data['time'] = data['volt']/10.
+    return data
+
+def test_npy_round_trip(tmp_path):
+    path = str(tmp_path / 'run.npy')
+    with st.open_writer(path, metadata={'port': 'sim://resistor'}) as f:
+        f.extend(readings(0, 5))
+        f.extend(readings(5, 5))
+    data, metadata = st.load(path)
+    assert list(data['volt']) == list(range(10))
+    assert metadata == {'port': 'sim://resistor'}
+    assert np.array_equal(np.load(path), data)
+    data, metadata = st.load(path, mmap=False)
+    assert len(data) == 10
+
+def test_npy_append(tmp_path):
+    path = str(tmp_path / 'run.npy')
+    st.save(path, readings(0, 3))
+    with st.NpyWriter(path) as f:
+        assert len(f) == 3
+        f.extend(readings(3, 4))
+    data, metadata = st.load(path)
+    assert list(data['volt']) == list(range(7))
+    assert len(np.load(path)) == 7
+
+def test_npy_append_after_partial_row(tmp_path):
+    path = str(tmp_path / 'run.npy')
+    f = st.NpyWriter(path, dtype=dtype)
+    f.extend(readings(0, 4))
+    f.file.write(b'\x00'*5)
+    f.file.flush()
+    # Never closed: the header still says 0 rows
+    assert len(st.load(path)[0]) == 4
+    with st.NpyWriter(path) as g:
+        g.extend(readings(4, 1))
+    f.file.close()
+    assert list(np.load(path)['volt']) == list(range(5))
+
+def test_npy_append_refused(tmp_path):
+    path = str(tmp_path / 'run.npy')
+    st.save(path, readings(0, 3))
+    with pytest.raises(ValueError):
+        st.NpyWriter(path, dtype=[('volt', float)])
+    other = str(tmp_path / 'other.npy')
+    np.save(other, np.zeros((3, 2)))
+    with pytest.raises(ValueError):
+        st.NpyWriter(other)
+    with pytest.raises(TypeError):
+        st.open_writer(path, compression='gzip')
+
+def test_h5_round_trip(tmp_path):
+    pytest.importorskip('h5py')
+    path = str(tmp_path / 'run.h5')
+    st.save(path, readings(0, 3), metadata={'port': 'sim://diode'},
+            compression='gzip')
+    st.save(path, readings(3, 2))
+    data, metadata = st.load(path, mmap=False)
+    assert list(data['volt']) == list(range(5))
+    assert metadata == {'port': 'sim://diode'}
+
+def test_background_writer(tmp_path):
+    path = str(tmp_path / 'run.npy')
+    with st.BackgroundWriter(st.open_writer(path)) as writer:
+        for start in range(0, 100, 10):
+            writer.extend(readings(start, 10))
+    assert writer.stats['rows'] == 100
+    assert list(st.load(path)[0]['volt']) == list(range(100))
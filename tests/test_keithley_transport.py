@@ -0,0 +1,52 @@
+import numpy as np
+import keithley_control as kc
+import keithley_transport as kt
+
+def responder(line):
+    replies = []
+    for com in line.split(';'):
+        if com == ':SYST:ERR:ALL?':
+            replies.append('0,"No error"')
+        elif com == '*OPC?':
+            replies.append('1')
+        elif com == ':TRIG:COUN?':
+            replies.append('+2')
+        elif com == '*IDN?':
+            replies.append('KEITHLEY INSTRUMENTS INC.,MODEL 2400,0,C30')
+        elif com == ':FETCH?':
+            replies.append('1.0,1e-3,2.0,2e-3')
+    return ';'.join(replies) or None
+
+def test_loopback_keithley():
+    port = kt.LoopbackTransport(responder)
+    keithley = kc.Keithley(port)
+    assert keithley.is_open()
+    assert keithley.get_num_triggers() == 2
+    data = keithley.read(data_type=['volt', 'curr'])
+    assert list(data['volt']) == [1., 2.]
+    assert list(data['curr']) == [1e-3, 2e-3]
+    assert ':INIT' in port.written
+    assert port.written[-1] == ':OUTP OFF'
+    # Not a port name, so its rate is not ours to set
+    assert not kt.can_set_baudrate(port)
+    assert keithley.set_baudrate(9600) is False
+
+def test_loopback_no_answer():
+    port = kt.LoopbackTransport(responder)
+    keithley = kc.Keithley(port, timeout=.1, retries=0)
+    assert keithley.get_response(':SOUR:VOLT?', timeout=.1) is None
+    assert keithley.counters['timeouts'] == 1
+    # A late reply is not taken for the next response
+    port.feed('5')
+    assert keithley.get_response('*OPC?') == '1'
+
+def test_open_transport():
+    port = kt.LoopbackTransport()
+    port.close()
+    assert kt.open_transport(port) is port and port.isOpen()
+    sim = kt.open_transport('sim://diode?baudrate=9600', timeout=.01)
+    assert sim.baudrate == 9600
+    assert kt.can_set_baudrate('sim://diode')
+    assert kt.can_set_baudrate('/dev/ttyUSB0')
+    assert not kt.can_set_baudrate('socket://host:4000')
+    assert not kt.can_set_baudrate('GPIB0::24::INSTR')